@@ -0,0 +1,449 @@
+import asyncio
+import hashlib
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import aiohttp
+from mysql.connector import DatabaseError, InterfaceError
+from mysql.connector.errors import PoolError
+
+from attachment_store import AttachmentStore
+from connection_pool import ConnectionPool
+from database_executor import DatabaseExecutor
+from guild_storage import GuildStorage
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("attachment_downloader")
+
+class Reservation:
+    """
+    The part of a ByteBudget held by a single download.\n
+    budget: The budget the bytes are held from.\n
+    size: How many bytes are held.
+    """
+    def __init__(self, budget: "ByteBudget", size: int):
+        self.budget = budget
+        self.size = size
+
+    def grow(self, size: int):
+        """
+        Holds more of the budget for a download that turned out to be bigger
+        than was reserved. It doesn't wait for room, as the download is
+        already running and waiting could leave every download stuck holding
+        part of the budget. Any new downloads wait until it's back under the
+        limit instead. Must be used from the event loop.\n
+        size: How many more bytes to hold.
+        """
+        self.size += size
+        self.budget._used += size
+
+class ByteBudget:
+    """
+    Limits how many bytes of attachments are downloaded at once, across every
+    worker.\n
+    limit: The most bytes that can be reserved at once.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        """
+        Waits until there's room for a download, then holds that much of the
+        budget until the download is finished. Must be used from the event
+        loop.\n
+        size: How many bytes to reserve. Anything more than the limit is
+        treated as the limit so it can still run once nothing else is.\n
+        Yields the Reservation, which can be grown as the download goes.
+        """
+        size = min(size, self.limit)
+
+        # Made here rather than in __init__ so it belongs to the running loop.
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._used + size <= self.limit)
+            self._used += size
+
+        reservation = Reservation(self, size)
+        try:
+            yield reservation
+
+        finally:
+            async with self._condition:
+                self._used -= reservation.size
+                self._condition.notify_all()
+
+class AttachmentDownloader:
+    """
+    Downloads attachments in the background so that saving a message never
+    waits on its files. Each attachment waiting to be downloaded has a row in
+    its guild's PendingAttachments table, written along with the message, so
+    anything still waiting when the bot stops is picked back up by resume().\n
+    pool: The pool to borrow connections from.\n
+    database: The executor the database work runs on.\n
+    store: The store the downloaded attachments are kept in.\n
+    workers: How many attachments are downloaded at once.\n
+    retries: How many more times a failed download is tried.\n
+    backoff: How many seconds to wait before the first retry. The wait doubles
+    with each retry after that.\n
+    chunk_size: How many bytes are read from a download at a time.\n
+    budget: The most bytes of attachments downloaded at once across all of the
+    workers.\n
+    max_size: The biggest attachment, in bytes, that will be downloaded. 0
+    means there is no limit.\n
+    storage: Where the guilds' tables are kept.\n
+    max_attempts: How many times an attachment can be given up on before it
+    stops being resumed. Its row is kept in PendingAttachments as a record of
+    what couldn't be downloaded.
+    """
+    def __init__(self, pool: ConnectionPool, database: DatabaseExecutor,
+                 store: AttachmentStore, workers: int, retries: int,
+                 backoff: float, chunk_size: int, budget: int, max_size: int,
+                 storage: GuildStorage = None, max_attempts: int = 5):
+        self.pool = pool
+        self.database = database
+        self.store = store
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.budget = ByteBudget(budget)
+        self.max_size = max_size
+        self.storage = storage or GuildStorage(False)
+        self.max_attempts = max_attempts
+
+        self._queue = None
+        self._session = None
+        self._tasks = []
+
+    def enqueue(self, guild_id: int, attachment_id: int, url: str):
+        """
+        Queues an attachment to be downloaded. Must be called from the event
+        loop.\n
+        guild_id: The ID of the guild the attachment was posted in.\n
+        attachment_id: The ID of the attachment.\n
+        url: Where the attachment can be downloaded from.
+        """
+        # Start the workers the first time anything is queued.
+        if not self._tasks:
+            self._queue = asyncio.Queue()
+            self._session = aiohttp.ClientSession()
+            self._tasks = [asyncio.create_task(self._run())
+                           for _ in range(self.workers)]
+
+        self._queue.put_nowait((guild_id, attachment_id, url))
+
+    async def resume(self, guild_id: int):
+        """
+        Queues the attachments a guild was still waiting on when the bot last
+        stopped, other than any that have been given up on too many times. Any
+        files an older version of the bot saved for the guild are moved into
+        the store first.\n
+        guild_id: The ID of the guild.
+        """
+        await self.database.run(self._adopt_legacy, guild_id)
+
+        pending = await self.database.run(self._execute, guild_id,
+                                          "SELECT attachmentID,url FROM "+
+                                          "PendingAttachments WHERE "+
+                                          "attempts<%s", (self.max_attempts,),
+                                          True)
+
+        if pending:
+            logger.info(f"Resuming {len(pending)} attachment downloads for "+
+                        f"server{guild_id}.")
+
+        for attachment_id, url in pending:
+            self.enqueue(guild_id, attachment_id, url)
+
+    async def close(self):
+        """
+        Stops the workers. Anything not yet downloaded stays pending for the
+        next time the bot starts.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        """
+        Downloads attachments as they're queued.
+        """
+        while True:
+            guild_id, attachment_id, url = await self._queue.get()
+
+            try:
+                await self._download(guild_id, attachment_id, url)
+
+            # Keep the worker alive no matter what goes wrong with a single
+            # attachment.
+            except Exception as err:
+                logger.critical(f"Could not download attachment "+
+                                f"{attachment_id}.\n{err}")
+
+            finally:
+                self._queue.task_done()
+
+    async def _download(self, guild_id: int, attachment_id: int, url: str):
+        """
+        Downloads a single attachment, retrying with an increasing wait if it
+        fails, then adds it to the store and marks it as no longer pending.\n
+        guild_id: The ID of the guild the attachment was posted in.\n
+        attachment_id: The ID of the attachment.\n
+        url: Where the attachment can be downloaded from.
+        """
+        attempt = 0
+        while True:
+            # Write to a temporary file first so a partial download is never
+            # mistaken for a finished one.
+            path = self.store.temporary_file()
+
+            try:
+                result = await self._fetch(attachment_id, url, path)
+                break
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                os.remove(path)
+
+                if attempt >= self.retries:
+                    logger.error(f"Giving up on attachment {attachment_id} "+
+                                 f"after {attempt + 1} attempts. It's "+
+                                 f"retried on the next start until it has "+
+                                 f"been given up on {self.max_attempts} "+
+                                 f"times.\n{err}")
+                    await self.database.run(self._execute, guild_id,
+                                            "UPDATE PendingAttachments SET "+
+                                            "attempts=attempts+1 WHERE "+
+                                            "attachmentID=%s",
+                                            (attachment_id,))
+                    return
+
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                logger.warning(f"Downloading attachment {attachment_id} "+
+                               f"failed. Retrying in {delay}s.\n{err}")
+                await asyncio.sleep(delay)
+
+            except BaseException:
+                os.remove(path)
+                raise
+
+        # There's no point retrying something that is gone or too big, so it
+        # stops being pending.
+        if result is None:
+            os.remove(path)
+            await self.database.run(self._execute, guild_id,
+                                    "DELETE FROM PendingAttachments WHERE "+
+                                    "attachmentID=%s", (attachment_id,))
+            return
+
+        digest, size = result
+
+        name = self.store.add(path, digest)
+        logger.debug(f"Saved {attachment_id} as {name}")
+
+        await self.database.run(self._stored, guild_id, attachment_id, digest,
+                                size, name)
+
+    async def _fetch(self, attachment_id: int, url: str, path: str) -> tuple:
+        """
+        Streams an attachment into a file a chunk at a time, hashing it as it
+        goes, so only one chunk is ever held in memory however big it is.\n
+        attachment_id: The ID of the attachment.\n
+        url: Where the attachment can be downloaded from.\n
+        path: The file to write the attachment to.\n
+        Returns the hex SHA-256 hash and size of the attachment, or None if it
+        is gone or bigger than max_size.
+        """
+        async with self._session.get(url) as response:
+            if response.status in (404, 410):
+                logger.warning(f"Attachment {attachment_id} is no longer "+
+                               "available.")
+                return None
+
+            response.raise_for_status()
+
+            # Skip anything that says up front it's too big.
+            expected = response.content_length
+            if self.max_size and expected and expected > self.max_size:
+                logger.warning(f"Attachment {attachment_id} is {expected} "+
+                               f"bytes, over the {self.max_size} byte limit. "+
+                               "Skipping.")
+                return None
+
+            # Hold back until there's room for the whole file. If the server
+            # didn't say how big it is, only a chunk is reserved to start with
+            # and the reservation grows as the file arrives, rather than
+            # holding the whole budget.
+            async with self.budget.reserve(expected or
+                                           self.chunk_size) as reservation:
+                digest = hashlib.sha256()
+                size = 0
+
+                with open(path, 'wb') as part:
+                    async for chunk in response.content.iter_chunked(
+                            self.chunk_size):
+                        size += len(chunk)
+
+                        # The file may be bigger than was reserved for it.
+                        if size > reservation.size:
+                            reservation.grow(size - reservation.size)
+
+                        # The length the server gave may have been wrong.
+                        if self.max_size and size > self.max_size:
+                            logger.warning(f"Attachment {attachment_id} is "+
+                                           f"over the {self.max_size} byte "+
+                                           "limit. Skipping.")
+                            return None
+
+                        digest.update(chunk)
+                        part.write(chunk)
+
+        return digest.hexdigest(), size
+
+    def _stored(self, guild_id: int, attachment_id: int, digest: str,
+                size: int, name: str):
+        """
+        Points an attachment's Messages rows at its file in the store, counts
+        the reference, and marks it as no longer pending, all in one
+        transaction. Runs on a database worker.\n
+        guild_id: The ID of the guild the attachment was posted in.\n
+        attachment_id: The ID of the attachment.\n
+        digest: The hex SHA-256 hash of the file's content.\n
+        size: The size of the file in bytes.\n
+        name: The name of the file relative to attach_path.
+        """
+        def work(cursor):
+            # Only count the reference the first time, in case the download
+            # was repeated after the bot stopped part way through.
+            cursor.execute("DELETE FROM PendingAttachments WHERE "+
+                           "attachmentID=%s", (attachment_id,))
+
+            if cursor.rowcount > 0:
+                self.store.reference(cursor, digest, size)
+                cursor.execute("UPDATE Messages SET qualifiedName=%s WHERE "+
+                               "attachmentID=%s", (name, attachment_id))
+
+        self._transaction(guild_id, work)
+
+    def _adopt_legacy(self, guild_id: int):
+        """
+        Moves the files older versions of the bot saved in a directory for each
+        guild, named after the attachment's ID and file name, into the store,
+        and points their Messages rows at them. Each file is only removed once
+        its rows point at the copy in the store, so it's safe to stop part way
+        through. The directory is removed once it's empty. Runs on a database
+        worker.\n
+        guild_id: The ID of the guild.
+        """
+        directory = os.path.join(self.store.attach_path, f"server{guild_id}")
+        if not os.path.isdir(directory):
+            return
+
+        attachments = self._execute(guild_id, "SELECT DISTINCT attachmentID,"+
+                                    "filename FROM Messages WHERE "+
+                                    "hasAttachment=1 AND (qualifiedName IS "+
+                                    "NULL OR LEFT(qualifiedName, 6)<>'blobs/')",
+                                    (), True)
+
+        moved = 0
+        for attachment_id, filename in attachments:
+            path = os.path.join(directory, f"{attachment_id}{filename}")
+            if not os.path.isfile(path):
+                continue
+
+            name, digest, size = self.store.adopt(path)
+
+            def work(cursor):
+                # Only count the reference if the rows weren't pointed at the
+                # file before the bot stopped part way through.
+                cursor.execute("UPDATE Messages SET qualifiedName=%s WHERE "+
+                               "attachmentID=%s", (name, attachment_id))
+
+                if cursor.rowcount > 0:
+                    self.store.reference(cursor, digest, size)
+
+                cursor.execute("DELETE FROM PendingAttachments WHERE "+
+                               "attachmentID=%s", (attachment_id,))
+
+            if self._transaction(guild_id, work):
+                os.remove(path)
+                moved += 1
+
+        if moved:
+            logger.info(f"Moved {moved} attachments of server{guild_id} into "+
+                        "the attachment store.")
+
+        if os.listdir(directory):
+            logger.warning(f"Some files were left in {directory} as they "+
+                           "couldn't be moved or don't belong to any "+
+                           f"attachment of server{guild_id}.")
+        else:
+            os.rmdir(directory)
+
+    def _execute(self, guild_id: int, sql: str, val: tuple,
+                 fetch: bool = False) -> list:
+        """
+        Runs a single statement against a guild's database. Runs on a database
+        worker.\n
+        guild_id: The ID of the guild.\n
+        sql: The statement to run.\n
+        val: The values for the statement.\n
+        fetch: Whether to return the rows the statement selects.
+        """
+        records = []
+
+        def work(cursor):
+            cursor.execute(sql, val)
+            if fetch:
+                records.extend(cursor.fetchall())
+
+        self._transaction(guild_id, work)
+
+        return records
+
+    def _transaction(self, guild_id: int, work):
+        """
+        Runs some work against a guild's database in a single transaction.
+        Runs on a database worker.\n
+        guild_id: The ID of the guild.\n
+        work: A function that is given the cursor to run its statements on.\n
+        Returns whether the work was committed.
+        """
+        try:
+            mydb = self.pool.get_connection()
+
+        except (PoolError, DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not get a connection to server{guild_id}."+
+                            f"\n{err}")
+            return False
+
+        cursor = mydb.cursor()
+
+        try:
+            if mydb.database != f"server{guild_id}":
+                self.storage.use(cursor, guild_id)
+
+            work(self.storage.cursor(cursor, guild_id))
+            mydb.commit()
+            return True
+
+        # Returning the connection to the pool rolls the work back.
+        except (DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not update server{guild_id}.\n{err}")
+            return False
+
+        finally:
+            cursor.close()
+            mydb.close()
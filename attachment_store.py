@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from mysql.connector import DatabaseError
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("attachment_store")
+
+class AttachmentStore:
+    """
+    Stores attachments by the SHA-256 hash of their content, so a file that is
+    posted many times is only kept once. Files are spread over two levels of
+    subdirectories named after the start of the hash so no directory gets too
+    big. How many attachments use each file is counted in the
+    guildList.AttachmentBlobs table, with each attachment counted once however
+    many times it's downloaded.\n
+    attach_path: The directory the attachments are saved under. The store
+    keeps its files in a "blobs" directory inside it.
+    """
+    def __init__(self, attach_path: str):
+        self.attach_path = attach_path
+        self.root = os.path.join(attach_path, "blobs")
+        self._temporary = os.path.join(self.root, "tmp")
+
+        os.makedirs(self._temporary, exist_ok=True)
+
+    def prepare(self, cursor):
+        """
+        Creates the table that counts the references to each file, if it
+        doesn't exist yet.\n
+        cursor: The cursor for the MySQL connection.
+        """
+        with open("sql/attachment_store_creator.sql", 'rt') as sql_comm:
+            command = sql_comm.read()
+
+        try:
+            cursor.execute(command)
+
+        except DatabaseError as err:
+            logger.critical("There was an issue creating the attachment store "+
+                            f"table.\n{err}")
+
+    def blob_name(self, digest: str) -> str:
+        """
+        Gets where a file is kept, relative to attach_path. This is what the
+        qualifiedName of its Messages rows is set to.\n
+        digest: The hex SHA-256 hash of the file's content.
+        """
+        return f"blobs/{digest[0:2]}/{digest[2:4]}/{digest}"
+
+    def temporary_file(self) -> str:
+        """
+        Creates an empty temporary file to download into, on the same disk as
+        the store so it can be moved into place without copying.
+        """
+        handle, path = tempfile.mkstemp(dir=self._temporary, suffix=".part")
+        os.close(handle)
+        return path
+
+    def add(self, path: str, digest: str) -> str:
+        """
+        Moves a downloaded file into the store. If the store already has a
+        file with the same content the download is thrown away instead.\n
+        path: The temporary file holding the download.\n
+        digest: The hex SHA-256 hash of the file's content.\n
+        Returns the name of the file relative to attach_path.
+        """
+        name = self.blob_name(digest)
+        destination = os.path.join(self.attach_path, name)
+
+        if os.path.isfile(destination):
+            logger.debug(f"Already have {digest}. Discarding the download.")
+            os.remove(path)
+
+        else:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(path, destination)
+
+        return name
+
+    def adopt(self, path: str, chunk_size: int = 1048576) -> tuple:
+        """
+        Copies a file saved outside the store into it. The original is left
+        where it is, so it can be removed once whatever points at it points at
+        the copy instead.\n
+        path: The file to copy.\n
+        chunk_size: How many bytes are read from the file at a time.\n
+        Returns the name of the copy relative to attach_path, along with the
+        hex SHA-256 hash and size of its content.
+        """
+        digest = hashlib.sha256()
+        size = 0
+
+        with open(path, 'rb') as original:
+            for chunk in iter(lambda: original.read(chunk_size), b""):
+                digest.update(chunk)
+                size += len(chunk)
+
+        digest = digest.hexdigest()
+
+        # Only copy the file if the store doesn't have its content already.
+        name = self.blob_name(digest)
+        if not os.path.isfile(os.path.join(self.attach_path, name)):
+            copy = self.temporary_file()
+            shutil.copyfile(path, copy)
+            self.add(copy, digest)
+
+        return name, digest, size
+
+    def reference(self, cursor, digest: str, size: int):
+        """
+        Counts another attachment as using a file. Meant to be run in the same
+        transaction as the Messages rows being pointed at it, and only when
+        they weren't pointed at it already, so each attachment is counted
+        once.\n
+        cursor: The cursor for the MySQL connection.\n
+        digest: The hex SHA-256 hash of the file's content.\n
+        size: The size of the file in bytes.
+        """
+        cursor.execute("INSERT INTO guildList.AttachmentBlobs (contentHash,"+
+                       "size) VALUES (%s,%s) ON DUPLICATE KEY UPDATE "+
+                       "refCount=refCount+1", (digest, size))
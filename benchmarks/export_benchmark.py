@@ -0,0 +1,134 @@
+"""
+Compares how long each gimme export format takes to write and read back, and
+how big the files come out.\n
+Usage: python benchmarks/export_benchmark.py [--sizes 10000 100000 ...]
+[--part-size 8000000]\n
+The messages are made up, with a mix of short chat, longer paragraphs, links
+and attachments. Parquet is skipped if pyarrow isn't installed.
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_export import export_formats, export_writer, pyarrow
+
+words = ("the a to and of is it that you in for this on what was just like "+
+         "lol yeah no but have with not they so be are can do at get if we "+
+         "game server tonight anyone played patch build raid stream").split()
+
+def build_rows(size: int) -> list:
+    """
+    Builds the rows a gimme query would return for a guild.\n
+    size: How many messages to make.
+    """
+    rng = random.Random(size)
+
+    channels = [f"channel-{index}" for index in range(20)]
+    authors = [(300000000000000000 + index, f"member{index}#{1000 + index}")
+               for index in range(max(size // 100, 1))]
+    start = datetime(2020, 1, 1)
+
+    rows = []
+    for index in range(size):
+        author_id, author_name = rng.choice(authors)
+        created = start + timedelta(seconds=index * 30)
+        length = rng.choice((3, 8, 15, 60))
+        message = " ".join(rng.choice(words) for _ in range(length))
+
+        edited = created + timedelta(minutes=5) if rng.random() < 0.05 else None
+        deleted = created + timedelta(hours=1) if rng.random() < 0.02 else None
+
+        filename = url = None
+        if rng.random() < 0.05:
+            filename = f"image{index}.png"
+            url = ("https://cdn.discordapp.com/attachments/"+
+                   f"{800000000000000000 + index}/{index}/{filename}")
+
+        rows.append((800000000000000000 + index * 4194304, rng.choice(channels),
+                     author_id, author_name, created, edited, deleted, message,
+                     filename, url))
+
+    return rows
+
+def read_back(export_format: str, paths: list) -> int:
+    """
+    Reads an export back in the way an analysis tool would and returns how
+    many rows it had.
+    """
+    count = 0
+
+    for path in paths:
+        if export_format == "parquet":
+            count += pyarrow.parquet.read_table(path).num_rows
+            continue
+
+        opener = gzip.open if export_format.endswith(".gz") else open
+        with opener(path, 'rt', encoding="utf-8", newline="") as export:
+            if export_format.startswith("csv"):
+                count += sum(1 for _ in csv.reader(export)) - 1
+            else:
+                count += sum(1 for line in export if json.loads(line))
+
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 500000])
+    parser.add_argument("--part-size", type=int, default=8000000)
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} {'format':>10} {'write':>9} {'read':>9} "+
+          f"{'size':>10} {'files':>6} {'vs csv':>8}")
+
+    for size in args.sizes:
+        rows = build_rows(size)
+        csv_size = None
+
+        for export_format in export_formats:
+            if export_format == "parquet" and pyarrow is None:
+                print(f"{size:>10} {export_format:>10} skipped, pyarrow is "+
+                      "not installed")
+                continue
+
+            directory = tempfile.mkdtemp(prefix="export_benchmark_")
+
+            try:
+                start = time.perf_counter()
+                writer = export_writer(export_format, directory, "export",
+                                       args.part_size)
+                for row in rows:
+                    writer.write(row)
+                paths = writer.close()
+                write_time = time.perf_counter() - start
+
+                total = sum(os.path.getsize(path) for path in paths)
+                assert all(os.path.getsize(path) <= args.part_size
+                           for path in paths)
+
+                start = time.perf_counter()
+                assert read_back(export_format, paths) == size
+                read_time = time.perf_counter() - start
+
+            finally:
+                shutil.rmtree(directory)
+
+            if csv_size is None:
+                csv_size = total
+
+            print(f"{size:>10} {export_format:>10} {write_time:>8.2f}s "+
+                  f"{read_time:>8.2f}s {total / 1048576:>8.1f}MB "+
+                  f"{len(paths):>6} {total / csv_size:>7.0%}")
+
+if __name__ == "__main__":
+    main()
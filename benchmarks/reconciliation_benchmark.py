@@ -0,0 +1,169 @@
+"""
+Compares the original message_check reconciliation, which scanned lists for
+every message, against the MessageIndex it was replaced with.\n
+Usage: python benchmarks/reconciliation_benchmark.py [--sizes 10000 100000 ...]
+[--legacy-limit 10000]\n
+The original version is only run up to --legacy-limit messages as it takes
+hours on the larger sizes. Above that its time is estimated from the largest
+size it was run on, scaling with the square of the size.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconciliation import EDITED, NEW, MessageIndex
+
+def build_guild(size: int) -> tuple:
+    """
+    Builds a fake guild where 90% of the messages are already in the database,
+    5% are new, 2% have been edited, and 5% of the database has been deleted.\n
+    size: The number of messages fetched from the guild.
+    """
+    rng = random.Random(size)
+
+    # Snowflakes for messages sent a few milliseconds apart.
+    first_id = 800000000000000000
+    ids = [first_id + index * 4194304 for index in range(size + size // 20)]
+    authors = [SimpleNamespace(id=first_id // 2 + author)
+               for author in range(max(size // 50, 1))]
+
+    fetched = []
+    records = []
+    for index, message_id in enumerate(ids):
+        content = f"message {message_id}"
+        author = rng.choice(authors)
+        roll = rng.random()
+
+        # The last of the IDs are only in the database, so they're deleted.
+        if index >= size:
+            records.append((message_id, content))
+            continue
+
+        fetched.append(SimpleNamespace(id=message_id, content=content,
+                                       author=author))
+
+        if roll < 0.05:
+            continue
+        elif roll < 0.07:
+            records.append((message_id, "the original content"))
+        else:
+            records.append((message_id, content))
+
+    user_records = [(author.id,) for author in authors[::2]]
+
+    return fetched, records, user_records
+
+def legacy(fetched: list, records: list, user_records: list) -> tuple:
+    """
+    The reconciliation message_check used to do.
+    """
+    new, edited, deleted, new_members = [], [], [], []
+
+    for mess in fetched:
+        if not next((value for index,value in enumerate(records) if
+                    value[0]==mess.id),None):
+            new.append(mess.id)
+
+        elif not next((value for index,value in enumerate(records) if
+                    value[1]==mess.content),None):
+            edited.append(mess.id)
+
+        if (not next((value for index,value in enumerate(user_records) if
+                     value[0]==mess.author.id),None) and
+            not next((value for index,value in enumerate(new_members) if
+                      value[0]==mess.author.id),None)):
+            new_members.append((mess.author.id,))
+
+    for row in records:
+        if not next((value for index,value in enumerate(fetched) if
+                    value.id==row[0]),None):
+            deleted.append(row[0])
+
+    return new, edited, deleted, new_members
+
+def indexed(fetched: list, records: list, user_records: list) -> tuple:
+    """
+    The reconciliation message_check does now.
+    """
+    new, edited, new_members = [], [], []
+
+    index = MessageIndex(records)
+    known_members = {row[0] for row in user_records}
+
+    for mess in fetched:
+        state = index.reconcile(mess.id, mess.content)
+        if state == NEW:
+            new.append(mess.id)
+        elif state == EDITED:
+            edited.append(mess.id)
+
+        if mess.author.id not in known_members:
+            known_members.add(mess.author.id)
+            new_members.append((mess.author.id,))
+
+    return new, edited, index.unseen(), new_members
+
+def timed(func, *args) -> tuple:
+    """
+    Runs a function and returns how many seconds it took and its result.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--legacy-limit", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} {'original':>14} {'indexed':>10} "+
+          f"{'speedup':>10} {'index peak':>12}")
+
+    legacy_size = None
+    legacy_time = None
+
+    for size in args.sizes:
+        fetched, records, user_records = build_guild(size)
+
+        index_time, result = timed(indexed, fetched, records, user_records)
+
+        # Measure the memory separately as tracing slows everything down.
+        tracemalloc.start()
+        indexed(fetched, records, user_records)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if size <= args.legacy_limit:
+            legacy_time, legacy_result = timed(legacy, fetched, records,
+                                               user_records)
+            legacy_size = size
+            original = f"{legacy_time:.2f}s"
+
+            # The original matched edits against any message's content, so
+            # only the new and deleted messages are expected to agree.
+            assert legacy_result[0] == result[0]
+            assert sorted(legacy_result[2]) == sorted(result[2])
+
+        elif legacy_time is not None:
+            legacy_time = legacy_time * (size / legacy_size) ** 2
+            legacy_size = size
+            original = f"~{legacy_time:.0f}s"
+
+        else:
+            original = "skipped"
+
+        speedup = f"{legacy_time / index_time:.0f}x" if legacy_time else "-"
+
+        print(f"{size:>10} {original:>14} {index_time:>9.3f}s {speedup:>10} "+
+              f"{peak / 1048576:>10.1f}MB")
+
+if __name__ == "__main__":
+    main()
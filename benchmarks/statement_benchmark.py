@@ -0,0 +1,149 @@
+"""
+Compares how many statements a second the hot write paths get through with
+plain text statements against the server-side prepared statements of the
+StatementRegistry, on a real MySQL server.\n
+Usage: python benchmarks/statement_benchmark.py [--events 5000]
+[--batches 200] [--batch-size 100] [--database statement_benchmark]\n
+Connects with the database_address, user and password environment variables
+the bot uses. A scratch guild database is made for the run, with every
+migration applied, and dropped after it. Each event is its own transaction,
+like the bot's deleted_message and voice_activity, and each batch is one
+transaction like the MessageWriter's. Batches are counted in rows a second.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# The root of the repository, which the SQL files are read from.
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import mysql.connector
+
+from message_writer import message_sql
+from prepared_statements import StatementRegistry
+from schema_migrations import SchemaMigrator
+
+delete_sql = ("UPDATE Messages SET isDeleted=%s, dateDeleted=%s WHERE "+
+              "messageID=%s")
+voice_sql = ("INSERT INTO VoiceActivity (memberID,channelID,dateEntered) "+
+             "VALUES (%s,%s,%s)")
+
+def build_messages(count: int, first_id: int) -> list:
+    """
+    Builds the Messages rows the writer would insert.\n
+    count: How many messages to make.\n
+    first_id: The messageID of the first one.
+    """
+    rng = random.Random(first_id)
+    start = datetime(2020, 1, 1)
+
+    return [(first_id + index * 4194304, rng.randrange(20), rng.randrange(500),
+             start + timedelta(seconds=index), "benchmark message "*
+             rng.choice((1, 4, 16)), False, None, None, None, None)
+            for index in range(count)]
+
+def run_events(mydb, cursor, events: list) -> float:
+    """
+    Runs each (sql, values) event in its own transaction and returns how
+    long it took.
+    """
+    start = time.perf_counter()
+    for sql, values in events:
+        cursor.execute(sql, values)
+        mydb.commit()
+    return time.perf_counter() - start
+
+def run_batches(mydb, cursor, batches: list) -> float:
+    """
+    Writes each batch of messages in its own transaction and returns how long
+    it took.
+    """
+    start = time.perf_counter()
+    for batch in batches:
+        cursor.executemany(message_sql, batch)
+        mydb.commit()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--database", default="statement_benchmark")
+    args = parser.parse_args()
+
+    mydb = mysql.connector.connect(host=os.getenv('database_address'),
+                                   user=os.getenv('user'),
+                                   password=os.getenv('password'))
+    cursor = mydb.cursor()
+
+    cursor.execute(f"DROP DATABASE IF EXISTS {args.database}")
+    cursor.execute(f"CREATE DATABASE {args.database}")
+    cursor.execute(f"USE {args.database}")
+
+    with open(os.path.join(root, "sql", "database_creator.sql"),
+              'rt') as sql_comm:
+        for cmd in cursor.execute(sql_comm.read(), multi=True):
+            cmd
+
+    SchemaMigrator(None, None, path=os.path.join(root, "sql", "migrations")
+                   ).migrate(args.database, cursor)
+
+    # Only the statements are being measured, not the checks of the keys.
+    cursor.execute("SET SESSION foreign_key_checks=0")
+
+    registry = StatementRegistry(mydb, 64)
+    prepared = registry.cursor(args.database)
+
+    print(f"{'statement':>12} {'kind':>9} {'time':>9} {'per second':>12} "+
+          f"{'speedup':>8}")
+
+    try:
+        next_id = 800000000000000000
+        for name in ("deletion", "voice", "batch"):
+            results = {}
+
+            for kind, target in (("text", cursor), ("prepared", prepared)):
+                if name == "batch":
+                    batches = []
+                    for _ in range(args.batches):
+                        batches.append(build_messages(args.batch_size,
+                                                      next_id))
+                        next_id += args.batch_size * 4194304
+                    elapsed = run_batches(mydb, target, batches)
+                    count = args.batches * args.batch_size
+
+                else:
+                    now = datetime.utcnow()
+                    if name == "deletion":
+                        cursor.executemany(message_sql,
+                                           build_messages(args.events,
+                                                          next_id))
+                        mydb.commit()
+                        events = [(delete_sql, (True, now,
+                                                next_id + index * 4194304))
+                                  for index in range(args.events)]
+                        next_id += args.events * 4194304
+                    else:
+                        events = [(voice_sql, (index % 500, index % 20, now))
+                                  for index in range(args.events)]
+                    elapsed = run_events(mydb, target, events)
+                    count = args.events
+
+                results[kind] = count / elapsed
+                speedup = results[kind] / results["text"]
+                print(f"{name:>12} {kind:>9} {elapsed:>8.2f}s "+
+                      f"{results[kind]:>12.0f} {speedup:>7.2f}x")
+
+    finally:
+        registry.clear()
+        cursor.execute(f"DROP DATABASE IF EXISTS {args.database}")
+        cursor.close()
+        mydb.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import logging
+import threading
+import time
+
+from mysql.connector import (DatabaseError, InterfaceError, MySQLConnection,
+                             OperationalError, connect)
+from mysql.connector.errors import PoolError
+
+from prepared_statements import PreparedCursor, StatementRegistry
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("connection_pool")
+
+class PooledConnection:
+    """
+    A borrowed connection from the ConnectionPool. Everything is passed through
+    to the underlying MySQL connection except close(), which hands the
+    connection back to the pool instead of closing it.\n
+    pool: The pool the connection was borrowed from.\n
+    entry: The pool's record of the connection.
+    """
+    def __init__(self, pool: "ConnectionPool", entry: "_PoolEntry"):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name: str):
+        # Only called for attributes the wrapper doesn't have itself.
+        if self._entry is None:
+            raise InterfaceError("The connection has already been returned to "+
+                                 "the pool.")
+        return getattr(self._entry.connection, name)
+
+    def prepared(self, database: str) -> PreparedCursor:
+        """
+        Gets a cursor that runs its statements as server-side prepared
+        statements, which are kept with the connection and reused by every
+        borrower after it. Only for statements that don't return any rows.\n
+        database: The database the connection is using. It must already have
+        been switched to.
+        """
+        if self._entry is None:
+            raise InterfaceError("The connection has already been returned to "+
+                                 "the pool.")
+        return self._entry.statements.cursor(database)
+
+    def close(self):
+        """
+        Returns the connection to the pool. Calling it more than once does
+        nothing.
+        """
+        if self._entry is not None:
+            entry = self._entry
+            self._entry = None
+            self._pool.release(entry)
+
+class _PoolEntry:
+    """
+    The pool's bookkeeping for a single open connection.\n
+    connection: The open MySQL connection.\n
+    statements: The most prepared statements to keep on the connection.
+    """
+    def __init__(self, connection: MySQLConnection, statements: int):
+        self.connection = connection
+        self.statements = StatementRegistry(connection, statements)
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+class ConnectionPool:
+    """
+    A fixed size pool of MySQL connections that are reused between events
+    instead of opening a new connection for each one.\n
+    size: The most connections that can be open at once.\n
+    timeout: How many seconds to wait for a free connection before giving up.\n
+    max_lifetime: How many seconds a connection is used for before it is
+    replaced with a fresh one.\n
+    ping_interval: How many seconds a connection can sit idle before it is
+    checked that it's still alive when borrowed.\n
+    stats_interval: How many seconds between the pool statistics being logged.\n
+    statements: The most prepared statements each connection keeps.\n
+    connect_args: The arguments passed on to mysql.connector.connect().
+    """
+    def __init__(self, size: int, timeout: float, max_lifetime: float,
+                 ping_interval: float, stats_interval: float,
+                 statements: int = 64, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.stats_interval = stats_interval
+        self.statements = statements
+        self._connect_args = connect_args
+
+        # The slots limit how many connections can be borrowed at once, and
+        # the idle list holds the open connections that aren't borrowed.
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+        # Running totals for the statistics that get logged.
+        self._stats = {"borrowed":0,"created":0,"recycled":0,"discarded":0,
+                       "timeouts":0,"wait_time":0.0,"in_use":0}
+        self._last_stats = time.monotonic()
+
+    def get_connection(self) -> PooledConnection:
+        """
+        Borrows a connection, opening a new one if none are idle. Raises a
+        PoolError if none become available within the timeout.
+        """
+        start = time.monotonic()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolError(f"No connection became available within "+
+                            f"{self.timeout} seconds.")
+
+        waited = time.monotonic() - start
+
+        try:
+            entry = self._checkout()
+
+        # If a connection couldn't be made, free the slot back up.
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["borrowed"] += 1
+            self._stats["wait_time"] += waited
+            self._stats["in_use"] += 1
+
+        return PooledConnection(self, entry)
+
+    def release(self, entry: _PoolEntry):
+        """
+        Takes a connection back from a borrower.\n
+        entry: The pool's record of the connection being returned.
+        """
+        try:
+            # Make sure the next borrower doesn't inherit anything left behind.
+            if entry.connection.unread_result:
+                entry.connection.consume_results()
+            if entry.connection.in_transaction:
+                entry.connection.rollback()
+
+            entry.last_used = time.monotonic()
+
+            with self._lock:
+                self._idle.append(entry)
+
+        except (DatabaseError, InterfaceError) as err:
+            logger.warning(f"Discarding a connection that could not be reset."+
+                           f"\n{err}")
+            self._discard(entry)
+
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+        if time.monotonic() - self._last_stats >= self.stats_interval:
+            self.log_stats()
+
+    def log_stats(self):
+        """
+        Writes the current pool statistics to the log.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            idle = len(self._idle)
+            self._last_stats = time.monotonic()
+
+        average_wait = 0.0
+        if stats["borrowed"] > 0:
+            average_wait = stats["wait_time"] / stats["borrowed"] * 1000
+
+        logger.info(f"Connection pool: {stats['in_use']} in use, {idle} idle, "+
+                    f"{self.size} max. {stats['borrowed']} borrowed, "+
+                    f"{stats['created']} created, {stats['recycled']} "+
+                    f"recycled, {stats['discarded']} discarded, "+
+                    f"{stats['timeouts']} timeouts, {average_wait:.2f}ms "+
+                    "average wait.")
+
+    def close_all(self):
+        """
+        Closes every idle connection. Used when the bot is shutting down.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+
+        for entry in idle:
+            self._close(entry)
+
+        self.log_stats()
+
+    def _checkout(self) -> _PoolEntry:
+        """
+        Gets a healthy connection, either an idle one or a brand new one.
+        """
+        while True:
+            with self._lock:
+                # Take the most recently used connection so the rest can age
+                # out if the pool is bigger than it needs to be.
+                entry = self._idle.pop() if self._idle else None
+
+            if entry is None:
+                return self._open()
+
+            now = time.monotonic()
+
+            # Replace connections that have been around for too long.
+            if now - entry.created >= self.max_lifetime:
+                logger.debug("Recycling a connection past its lifetime.")
+                with self._lock:
+                    self._stats["recycled"] += 1
+                self._close(entry)
+                continue
+
+            # Check connections that have been sitting for a while are alive.
+            if now - entry.last_used >= self.ping_interval:
+                try:
+                    entry.connection.ping(reconnect=False)
+
+                except (InterfaceError, OperationalError) as err:
+                    logger.warning(f"Discarding a dead connection.\n{err}")
+                    self._discard(entry)
+                    continue
+
+            return entry
+
+    def _open(self) -> _PoolEntry:
+        """
+        Opens a new connection to the database server.
+        """
+        logger.debug("Establishing a connection to the database server.")
+        connection = connect(**self._connect_args)
+        logger.debug("Database server connection established.")
+
+        with self._lock:
+            self._stats["created"] += 1
+
+        return _PoolEntry(connection, self.statements)
+
+    def _discard(self, entry: _PoolEntry):
+        """
+        Throws away a connection that is no longer usable.\n
+        entry: The pool's record of the connection.
+        """
+        with self._lock:
+            self._stats["discarded"] += 1
+        self._close(entry)
+
+    def _close(self, entry: _PoolEntry):
+        """
+        Closes a connection, ignoring any errors from it already being gone.\n
+        entry: The pool's record of the connection.
+        """
+        # The statements go with the connection.
+        entry.statements.clear()
+
+        try:
+            entry.connection.close()
+
+        except (DatabaseError, InterfaceError):
+            pass
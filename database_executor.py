@@ -0,0 +1,50 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("database_executor")
+
+class DatabaseExecutor:
+    """
+    Runs blocking database work on a bounded set of worker threads so that the
+    discord event loop never has to wait on MySQL.\n
+    workers: The number of worker threads. There's no point in this being
+    larger than the connection pool as the extra workers would only wait on it.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="database")
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on a worker thread and waits for the result
+        without blocking the event loop.\n
+        func: The function to run.\n
+        args: The arguments to pass to the function.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(func, *args,
+                                                            **kwargs))
+
+    def task(self, func):
+        """
+        A decorator that turns a blocking database function into a coroutine
+        that runs it on the worker threads.\n
+        func: The blocking function to wrap.
+        """
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+
+        return wrapper
+
+    def shutdown(self):
+        """
+        Waits for any queued database work to finish and stops the workers.
+        """
+        logger.debug("Waiting for the database workers to finish.")
+        self._executor.shutdown(wait=True)
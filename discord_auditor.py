@@ -1,20 +1,59 @@
+import asyncio
 import logging
 import os
+import re
 
 import discord
 from discord.ext import commands
 
-from sql_interface import (channel_check, command_gimme, delete_channel,
-                           deleted_message, edited_message, guild_check,
-                           guild_join, guild_leave, guild_update, logger,
-                           member_check, member_join, member_update,
-                           message_check, new_channel, new_message,
-                           update_channel, user_update, voice_activity)
+from sql_interface import (attachment_downloader, command_gimme,
+                           command_search, compact_revisions, database,
+                           delete_channel, deleted_message, edited_message,
+                           export_queue, guild_check, guild_join, guild_leave,
+                           guild_update, logger, member_join, member_update,
+                           message_check, message_partitions, message_writer,
+                           new_channel, new_message, pool, search_backfill,
+                           update_channel, upgrade_schema, user_update,
+                           voice_activity)
+from startup_scheduler import startup_check
 
 logger.info("Initializing discord bot.")
 
+# Get how many guilds are checked at once on startup and which go first.
+startup_workers = int(os.getenv("startup_workers") or 4)
+startup_priority = [int(guild) for guild in
+                    (os.getenv("startup_priority") or "").split(",") if guild]
+
+# Get how many hours there are between each run of the partition maintenance.
+partition_interval = float(os.getenv("partition_interval") or 24)
+
+# The background migration of the guild databases, started on the first login.
+migration_task = None
+
+# The partition maintenance that runs in the background once the migrations
+# are done, also started on the first login.
+partition_task = None
+
+# The background indexing of old messages for searching, also started on the
+# first login.
+search_task = None
+
+class AuditorBot(commands.Bot):
+    """
+    The bot, which writes out everything it still has queued whenever it's
+    closed, whether by $quit, a signal, or losing its connection for good.
+    """
+    async def close(self):
+        # Write any messages that are still queued before going offline. Any
+        # attachments still downloading are picked back up on the next start,
+        # while any unfinished exports are dropped.
+        await message_writer.close()
+        await attachment_downloader.close()
+        await export_queue.close()
+        await super().close()
+
 bot_prefix="$"
-bot = commands.Bot(command_prefix=bot_prefix)
+bot = AuditorBot(command_prefix=bot_prefix)
 bot.owner_id = int(os.getenv('bot_owner'))
 
 @bot.command(name="quit",help="Shuts the bot down. Only the bot owner can "+
@@ -25,8 +64,90 @@ async def quit(ctx: commands.Context):
     # If the command came from the owner's guild and it was from the owner.
     logger.info("Bot was told to close by owner. Shutting down.")
     await ctx.send('Quitting!')
+
+    # Closing the bot writes out anything still queued.
     await bot.logout()
 
+@bot.command(name="reconcile",help="Fetches every message in a guild to find "+
+             "any edits and deletions that were missed while the bot was "+
+             "offline. Only the bot owner can use this.",
+             usage="<guild ID>",hidden=True)
+@commands.dm_only()
+@commands.is_owner()
+async def reconcile(ctx: commands.Context, guild_id: int):
+    guild = bot.get_guild(guild_id)
+
+    if guild is None:
+        await ctx.send(f"I'm not in a guild with the ID {guild_id}.")
+        return
+
+    logger.info(f"Owner requested a full message check of \'{guild.name}\'.")
+    await ctx.send(f"Checking every message in {guild.name}.")
+    await message_check(guild, full=True)
+    await ctx.send(f"Finished checking {guild.name}.")
+
+@bot.command(name="compact",help="Turns the extra copies of edited messages "+
+             "that older versions of the bot saved into revisions. Only the "+
+             "bot owner can use this.",usage="<guild ID/all>",hidden=True)
+@commands.dm_only()
+@commands.is_owner()
+async def compact(ctx: commands.Context, guild_id: str):
+    if guild_id.lower() == "all":
+        guilds = bot.guilds
+
+    else:
+        guild = bot.get_guild(int(guild_id))
+
+        if guild is None:
+            await ctx.send(f"I'm not in a guild with the ID {guild_id}.")
+            return
+
+        guilds = [guild]
+
+    for guild in guilds:
+        logger.info(f"Owner requested compaction of \'{guild.name}\'.")
+        await message_writer.flush(guild.id)
+        messages, removed = await compact_revisions(guild)
+        await ctx.send(f"Compacted {messages} edited messages in {guild.name}, "+
+                       f"removing {removed} extra rows.")
+
+@bot.command(name="partition",help="Splits the messages of a guild into "+
+             "monthly partitions, however many there are. Writes to the guild "+
+             "wait until it's done. Only the bot owner can use this.",
+             usage="<guild ID/all>",hidden=True)
+@commands.dm_only()
+@commands.is_owner()
+async def partition(ctx: commands.Context, guild_id: str):
+    if guild_id.lower() == "all":
+        guild_ids = [guild.id for guild in bot.guilds]
+
+    else:
+        guild = bot.get_guild(int(guild_id))
+
+        if guild is None:
+            await ctx.send(f"I'm not in a guild with the ID {guild_id}.")
+            return
+
+        guild_ids = [guild.id]
+
+    logger.info(f"Owner requested partitioning of {len(guild_ids)} guilds.")
+    await ctx.send(f"Partitioning {len(guild_ids)} guilds.")
+    await message_partitions.maintain_all(guild_ids, convert=True)
+    await ctx.send("Finished partitioning.")
+
+async def partition_maintenance():
+    """
+    Keeps the monthly partitions of every guild's messages up to date, and
+    archives the old ones, every partition_interval hours. Waits for the
+    migrations first as they drop the foreign keys partitioning can't have.
+    """
+    await migration_task
+
+    while True:
+        await message_partitions.maintain_all([guild.id for guild in
+                                               bot.guilds])
+        await asyncio.sleep(partition_interval * 3600)
+
 @bot.command(name="leave",help="Used by guild owners to remove the bot from "+
              "their guild.")
 async def leave(ctx: commands.Context):
@@ -42,47 +163,75 @@ async def leave(ctx: commands.Context):
              f"<before/after> <date>\n{bot_prefix}gimme <user/all> from "+
              "<guild> latest <number>\nAll dates must be in either the "+
              "YYYY/MM/DD or YYYY/MM/DD HH:MM:SS time formats. All times are "+
-             "in UTC.")
+             "in UTC. End the request with \"as <format>\" to get the "+
+             "messages as csv.gz, jsonl, jsonl.gz or parquet rather than csv.")
 @commands.dm_only()
 async def gimme(ctx: commands.Context, *args: str):
     request = ()
 
+    # The format can be picked by ending the request with "as <format>".
+    export_format = "csv"
+    if len(args)>=2 and args[-2].lower()=="as":
+        export_format = args[-1]
+        args = args[:-2]
+
     if len(args)==7:
         request = (args[0],args[2],args[3],args[4],args[6])
-        await command_gimme(ctx,request)
+        await command_gimme(ctx,request,export_format)
     elif len(args)==5:
         request = (args[0],args[2],args[3],args[4])
-        await command_gimme(ctx,request)
+        await command_gimme(ctx,request,export_format)
     elif len(args)==4:
         request = (args[0],args[2],args[3])
-        await command_gimme(ctx,request)
+        await command_gimme(ctx,request,export_format)
     else:
         await ctx.send(f"That command was invalid, please type {bot_prefix}"+
                       "gimme help for more information and proper formatting.")
-    
+
+@bot.command(name="search",brief="Used to search a server's messages.",
+             help="Finds the messages in a server with every one of the "+
+             "words. Put a phrase in double quotes to find it exactly. The "+
+             "newest messages are sent first, a page at a time.",
+             usage="<guild> <words>\nEnd the search with \"page <number>\" "+
+             "to see more results.")
+@commands.dm_only()
+async def search(ctx: commands.Context, guild: str, *, query: str):
+    # A page can be picked by ending the search with "page <number>".
+    page = 1
+    match = re.fullmatch(r"(.*?)\s+page\s+(\d+)", query, re.IGNORECASE)
+    if match:
+        query = match[1]
+        page = int(match[2])
+
+    await command_search(ctx,guild,query,page)
+
 @bot.event
 async def on_ready():
     # Inform the bot that the login was successful.
     logger.info(f'bot is logged in as {bot.user}.')
 
     # Check for any new guilds since the bot had been restarted.
-    guild_check(bot)
+    await guild_check(bot)
 
-    for guild in bot.guilds:
-        logger.info(f"Checking the \'{guild.name}\' guild.")
-        # Check for any new channels within the enrolled guilds since the bot
-        # was restarted.
-        channel_check(guild)
+    # Bring older guild databases up to date in the background. The bot keeps
+    # auditing while this runs as the indexes are built online.
+    global migration_task
+    if migration_task is None:
+        migration_task = asyncio.create_task(upgrade_schema(
+            [guild.id for guild in bot.guilds]))
 
-        # Check for any new members within the enrolled guilds since the bot was
-        # restarted.
-        member_check(guild)
+    global partition_task
+    if partition_task is None:
+        partition_task = asyncio.create_task(partition_maintenance())
 
-        # Check for any new messages within the enrolled guilds since the bot
-        # was restarted.
-        await message_check(guild)
+    # Index the messages saved before searching was added in the background.
+    global search_task
+    if search_task is None:
+        search_task = asyncio.create_task(search_backfill(
+            [guild.id for guild in bot.guilds]))
 
-        logger.info(f"Guild check of \'{guild.name}\' complete.")
+    # Check several guilds at once so they're all being audited sooner.
+    await startup_check(bot.guilds, startup_workers, startup_priority)
 
     # Inform the log that the updates completed and that the bot is waiting.
     logger.info("Update complete. Waiting.")
@@ -99,33 +248,35 @@ async def on_message(message: discord.Message):
 
 @bot.event
 async def on_message_edit(before: discord.Message, after: discord.Message):
-    # Make note that the message was edited.
-    edited_message(after)
+    # Discord also sends edits for things like links getting their previews,
+    # which leave the content alone and aren't worth keeping.
+    if before.content == after.content:
+        return
 
-    # Add the edited message as a new one to ensure message integrity.
-    await new_message(after)
+    # Keep the new content as a revision of the original message.
+    await edited_message(after)
 
 @bot.event
 async def on_message_delete(message: discord.Message):
     # Note that a message was deleted.
-    deleted_message(message)
+    await deleted_message(message)
 
 @bot.event
 async def on_member_join(member: discord.Member):
     # Add the new member to the Members table.
-    member_join(member)
+    await member_join(member)
 
 @bot.event
 async def on_member_update(before: discord.Member, after: discord.Member):
     # If the user's nickname is changed, update the member in the table.
     if before.nick != after.nick:
-        member_update(before, after)
+        await member_update(before, after)
 
 @bot.event
 async def on_user_update(before: discord.User, after: discord.User):
     # If the user's name or discriminator changes, update them in the table.
     if before.name != after.name or before.discriminator != after.discriminator:
-        user_update(before, after)
+        await user_update(before, after)
 
 @bot.event
 async def on_voice_state_update(member: discord.Member,
@@ -134,23 +285,23 @@ async def on_voice_state_update(member: discord.Member,
     # Since we only care about who was in what channel and when, we only look to
     # see if the channels before and after are different.
     if before.channel != after.channel:
-        voice_activity(member, before, after)
+        await voice_activity(member, before, after)
 
 @bot.event
 async def on_guild_channel_create(channel: discord.TextChannel):
     # Add a new channel to the guild.
-    new_channel(channel)
+    await new_channel(channel)
 
 @bot.event
 async def on_guild_channel_update(before: discord.TextChannel,
                                   after: discord.TextChannel):
     # Update the channel.
-    update_channel(after)
+    await update_channel(after)
 
 @bot.event
 async def on_guild_channel_delete(channel: discord.TextChannel):
     # Mark a channel as deleted.
-    delete_channel(channel)
+    await delete_channel(channel)
 
 @bot.event
 async def on_guild_join(guild: discord.Guild):
@@ -161,11 +312,16 @@ async def on_guild_join(guild: discord.Guild):
 @bot.event
 async def on_guild_update(before: discord.Guild, after: discord.Guild):
     # If the name of the guild is changed make note of it.
-    guild_update(after)
+    await guild_update(after)
 
 @bot.event
 async def on_guild_remove(guild: discord.Guild):
     # Note if a guild is left for whatever reason.
-    guild_leave(guild)
+    await guild_leave(guild)
 
 bot.run(os.getenv('credentials'))
+
+# Let any outstanding database work finish, then close the pooled database
+# connections now that the bot has stopped.
+database.shutdown()
+pool.close_all()
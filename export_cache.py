@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("export_cache")
+
+class _CacheEntry:
+    """
+    A cached export, as tracked in memory.
+    """
+    def __init__(self, watermark: list, files: list, size: int,
+                 last_used: float):
+        self.watermark = watermark
+        self.files = files
+        self.size = size
+        self.last_used = last_used
+        self.pins = 0
+
+class ExportCache:
+    """
+    Keeps the files of recent gimme exports on disk so asking for the same
+    thing again can be answered straight away. Each export is stored along
+    with the guild's watermark, which changes whenever messages are added,
+    edited or deleted, so an export is only reused while nothing it could
+    include has changed. Name changes of members and channels don't change the
+    watermark. Once the cache is over max_bytes the exports used least recently
+    are removed.\n
+    path: The directory the exports are kept in.\n
+    max_bytes: The most the cached exports can take up in total.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._entries = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Builds the key an export is cached under from everything that decides
+        what's in it.
+        """
+        return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")
+                              ).hexdigest()
+
+    def checkout(self, key: str, watermark: list) -> list:
+        """
+        Gets the files of a cached export. The export is kept from being
+        removed until release() is called.\n
+        key: The key from key().\n
+        watermark: The guild's current watermark.\n
+        Returns the paths of the files, or None if nothing usable is cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            # Something has changed since, so the export is out of date.
+            if entry.watermark != watermark:
+                if not entry.pins:
+                    self._remove(key)
+                return None
+
+            entry.last_used = time.time()
+            entry.pins += 1
+
+            directory = os.path.join(self.path, key)
+            os.utime(os.path.join(directory, "meta.json"))
+
+            return [os.path.join(directory, name) for name in entry.files]
+
+    def release(self, key: str):
+        """
+        Lets a checked out export be removed again.\n
+        key: The key from key().
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.pins -= 1
+
+    def put(self, key: str, watermark: list, paths: list) -> list:
+        """
+        Moves the files of a finished export into the cache and checks it out.
+        Can be slow if the files have to be copied, so it's best run off the
+        event loop.\n
+        key: The key from key().\n
+        watermark: The guild's watermark from before the export was run.\n
+        paths: The files of the export.\n
+        Returns where the files are now, or None if the export wasn't cached
+        as it's too big or the export it would replace is being sent.
+        """
+        size = sum(os.path.getsize(path) for path in paths)
+        if size > self.max_bytes:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.pins:
+                return None
+
+        directory = os.path.join(self.path, key)
+        partial = directory+".part"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+
+        files = []
+        for path in paths:
+            files.append(os.path.basename(path))
+            shutil.move(path, os.path.join(partial, files[-1]))
+
+        with open(os.path.join(partial, "meta.json"), 'wt') as meta:
+            json.dump({"watermark": watermark, "files": files}, meta)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+
+            os.replace(partial, directory)
+
+            entry = _CacheEntry(watermark, files, size, time.time())
+            entry.pins = 1
+            self._entries[key] = entry
+            self._size += size
+
+            self._evict()
+
+        return [os.path.join(directory, name) for name in files]
+
+    def _evict(self):
+        """
+        Removes the least recently used exports until the cache fits in
+        max_bytes. Exports that are checked out are skipped.
+        """
+        for key, entry in sorted(self._entries.items(),
+                                 key=lambda item: item[1].last_used):
+            if self._size <= self.max_bytes:
+                break
+
+            if not entry.pins:
+                logger.debug(f"Evicting cached export {key}.")
+                self._remove(key)
+
+    def _remove(self, key: str):
+        """
+        Removes an export from the cache.
+        """
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    def _load(self):
+        """
+        Picks back up the exports cached before the bot was restarted.
+        """
+        for key in os.listdir(self.path):
+            directory = os.path.join(self.path, key)
+            meta_path = os.path.join(directory, "meta.json")
+
+            try:
+                if key.endswith(".part"):
+                    raise ValueError("Unfinished export.")
+
+                with open(meta_path, 'rt') as meta:
+                    meta_data = json.load(meta)
+
+                size = sum(os.path.getsize(os.path.join(directory, name))
+                           for name in meta_data["files"])
+
+            # Anything unfinished or unreadable is thrown away.
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+
+            self._entries[key] = _CacheEntry(meta_data["watermark"],
+                                             meta_data["files"], size,
+                                             os.path.getmtime(meta_path))
+            self._size += size
+
+        self._evict()
+
+        logger.info(f"Loaded {len(self._entries)} cached exports "+
+                    f"({self._size / 1048576:.1f}MB).")
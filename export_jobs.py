@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+
+import discord
+
+from export_cache import ExportCache
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("export_jobs")
+
+# The script each export is run in.
+worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "export_worker.py")
+
+async def send_export(send, export_paths: list):
+    """
+    Sends the files of an export, each on its own as Discord limits the size of
+    a message.\n
+    send: The coroutine function used to message the user, such as ctx.send.\n
+    export_paths: The files of the export.
+    """
+    content = "Here's the content you requested!"
+    if len(export_paths) > 1:
+        content += f" It's split over {len(export_paths)} files."
+
+    for export_path in export_paths:
+        await send(content=content, file=discord.File(export_path))
+        content = None
+
+class ExportQueue:
+    """
+    Runs gimme exports in their own processes, a few at a time, so that a big
+    export never holds up the bot. The requester is sent how far along their
+    export is as it goes, and the files once it's done.\n
+    workers: How many exports run at once. The rest wait their turn.\n
+    user_jobs: How many exports each user can have waiting or running at once.\n
+    user_daily: How many exports each user can ask for in a day. 0 means there
+    is no limit.\n
+    progress_interval: The fewest seconds between progress messages.\n
+    cache: Where finished exports are kept to be reused, if anywhere.
+    """
+    def __init__(self, workers: int, user_jobs: int, user_daily: int,
+                 progress_interval: float, cache: ExportCache = None):
+        self.workers = workers
+        self.user_jobs = user_jobs
+        self.user_daily = user_daily
+        self.progress_interval = progress_interval
+        self.cache = cache
+
+        self._limiter = None
+        self._waiting = 0
+        self._running = 0
+        self._active = {}
+        self._history = {}
+        self._tasks = set()
+
+    def submit(self, user_id: int, job: dict, send) -> tuple:
+        """
+        Queues an export. Must be called from the event loop.\n
+        user_id: The ID of the user asking for the export.\n
+        job: What to export, as read by export_worker. If it has a
+        "cache_key" and "watermark" the finished export is cached under them.\n
+        send: The coroutine function used to message the user, such as
+        ctx.send.\n
+        Returns how many exports need to finish before it can start, or the
+        reason it can't be queued.
+        """
+        if self._active.get(user_id, 0) >= self.user_jobs:
+            return None, ("You already have as many exports on the way as you "+
+                          "can. Please wait for them to finish first.")
+
+        # Forget the exports from more than a day ago.
+        history = self._history.setdefault(user_id, deque())
+        while history and history[0] < time.monotonic() - 86400:
+            history.popleft()
+
+        if self.user_daily and len(history) >= self.user_daily:
+            return None, (f"You've asked for {self.user_daily} exports in the "+
+                          "last day, which is as many as you can. Please try "+
+                          "again later.")
+
+        # Made here rather than in __init__ so it belongs to the running loop.
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.workers)
+
+        history.append(time.monotonic())
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+
+        ahead = max(self._waiting + self._running + 1 - self.workers, 0)
+        self._waiting += 1
+
+        task = asyncio.create_task(self._run(user_id, job, send))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return ahead, None
+
+    async def close(self):
+        """
+        Stops every export, waiting or running.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, user_id: int, job: dict, send):
+        """
+        Waits for a free worker, runs the export, then sends the files.
+        """
+        directory = tempfile.mkdtemp(prefix="gimme_")
+        waiting = True
+        cached = None
+
+        try:
+            async with self._limiter:
+                self._waiting -= 1
+                self._running += 1
+                waiting = False
+                started = time.monotonic()
+
+                result = await self._export(dict(job, directory=directory),
+                                            send)
+
+                # If the request couldn't be filled, let the requester know why.
+                if result.get("error"):
+                    await send(result["error"])
+                    return
+
+                export_paths = result["paths"]
+                logger.info(f"Export for {user_id} finished in "+
+                            f"{time.monotonic() - started:.1f}s.")
+
+                # Keep the files for anyone asking the same thing again. Moving
+                # them can mean copying, so it's done off the event loop.
+                if self.cache is not None and "cache_key" in job:
+                    cached_paths = await asyncio.get_running_loop(
+                        ).run_in_executor(None, self.cache.put,
+                                          job["cache_key"], job["watermark"],
+                                          export_paths)
+
+                    if cached_paths is not None:
+                        cached = job["cache_key"]
+                        export_paths = cached_paths
+
+                await send_export(send, export_paths)
+
+        except asyncio.CancelledError:
+            raise
+
+        # One export going wrong shouldn't stop the rest.
+        except Exception as err:
+            logger.critical(f"Export for {user_id} failed.\n{err}")
+            await send("Sorry, something went wrong while making your export.")
+
+        finally:
+            if waiting:
+                self._waiting -= 1
+            else:
+                self._running -= 1
+            self._active[user_id] -= 1
+
+            if cached is not None:
+                self.cache.release(cached)
+
+            # Delete the files from the hard drive.
+            shutil.rmtree(directory, ignore_errors=True)
+
+    async def _export(self, job: dict, send) -> dict:
+        """
+        Runs an export in a new process, passing its progress on to the
+        requester.\n
+        Returns the result export_worker sent back.
+        """
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, worker_script, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+        errors = asyncio.create_task(self._log(process.stderr))
+        result = {"error": "Sorry, something went wrong while making your "+
+                  "export."}
+
+        try:
+            process.stdin.write(json.dumps(job).encode("utf-8")+b"\n")
+            await process.stdin.drain()
+            process.stdin.close()
+
+            await send("Your export has started.")
+            reported = time.monotonic()
+
+            async for line in process.stdout:
+                message = json.loads(line)
+
+                if "progress" not in message:
+                    result = message
+
+                elif time.monotonic() - reported >= self.progress_interval:
+                    reported = time.monotonic()
+                    await send(f"Exported {message['progress']:,} messages "+
+                               "so far.")
+
+            await process.wait()
+            await errors
+
+        # Don't leave the export running if the bot is stopping.
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            errors.cancel()
+
+        return result
+
+    async def _log(self, stream: asyncio.StreamReader):
+        """
+        Passes on what an export logs.
+        """
+        async for line in stream:
+            logger.info(f"Export: {line.decode('utf-8', 'replace').rstrip()}")
@@ -0,0 +1,83 @@
+"""
+Runs a single gimme export in its own process, so however big it is the bot
+keeps auditing without waiting on it. Started by ExportQueue, which sends the
+job as a line of JSON on stdin. Progress and the result are sent back as lines
+of JSON on stdout, and anything logged goes to stderr.
+"""
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+import mysql.connector
+
+from message_archive import MessageArchive
+from message_export import gimme_export
+
+# The format the dates in a job are sent in.
+time_format = "%Y-%m-%d %H:%M:%S"
+
+logger = logging.getLogger("sql_interface").getChild("export_worker")
+
+def report(**message):
+    """
+    Sends a message back to the bot.
+    """
+    sys.stdout.write(json.dumps(message)+"\n")
+    sys.stdout.flush()
+
+def parse_date(value):
+    """
+    Turns a date sent as text back into a datetime. Anything else, such as the
+    number of messages for "latest", is left as it is.
+    """
+    if isinstance(value, str) and value:
+        return datetime.strptime(value, time_format)
+
+    return value
+
+def main():
+    logging.basicConfig(stream=sys.stderr,
+                        level=os.getenv("log_level") or "INFO",
+                        format="%(levelname)s; %(filename)s; %(funcName)s; "+
+                        "%(message)s")
+
+    job = json.loads(sys.stdin.readline())
+
+    try:
+        mydb = mysql.connector.connect(host=os.getenv('database_address'),
+                                       user=os.getenv('user'),
+                                       password=os.getenv('password'))
+
+    except mysql.connector.Error as err:
+        logger.critical(f"Could not connect to the database server.\n{err}")
+        report(error="Sorry, I couldn't reach the database to make your "+
+               "export. Please try again later.")
+        return
+
+    try:
+        export_paths, error = gimme_export(mydb, job["directory"],
+                                           job["format"], tuple(job["request"]),
+                                           job["requesting_user"], job["user"],
+                                           job["guild"], job["range"],
+                                           parse_date(job["date1"]),
+                                           parse_date(job["date2"]),
+                                           job["part_size"], job["fetch_size"],
+                                           lambda rows: report(progress=rows),
+                                           MessageArchive(
+                                               os.getenv("archive_path") or
+                                               "archive/"))
+
+    except Exception as err:
+        logger.critical(f"The export failed.\n{err}")
+        report(error="Sorry, something went wrong while making your export.")
+        return
+
+    finally:
+        mydb.close()
+
+    report(paths=export_paths, error=error)
+
+if __name__ == "__main__":
+    main()
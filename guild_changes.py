@@ -0,0 +1,47 @@
+import logging
+
+from mysql.connector import DatabaseError
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("guild_changes")
+
+def prepare_changes(cursor):
+    """
+    Creates the table that counts the changes to each guild's messages, if it
+    doesn't exist yet.\n
+    cursor: The cursor for the MySQL connection.
+    """
+    with open("sql/guild_changes_creator.sql", 'rt') as sql_comm:
+        command = sql_comm.read()
+
+    try:
+        cursor.execute(command)
+
+    except DatabaseError as err:
+        logger.critical("There was an issue creating the guild changes "+
+                        f"table.\n{err}")
+
+def count_change(cursor, guild_id: int):
+    """
+    Counts a change to a guild's messages, such as messages being added,
+    edited or deleted. It's counted in the same transaction as the change, so
+    the count goes up exactly when the change is committed, however close
+    together two changes come.\n
+    cursor: The cursor for the MySQL connection.\n
+    guild_id: The ID of the guild.
+    """
+    cursor.execute("INSERT INTO guildList.GuildChanges (guildID,changes) "+
+                   "VALUES (%s,1) ON DUPLICATE KEY UPDATE changes=changes+1",
+                   (guild_id,))
+
+def guild_changes(cursor, guild_id: int) -> int:
+    """
+    Gets how many changes have been made to a guild's messages.\n
+    cursor: The cursor for the MySQL connection.\n
+    guild_id: The ID of the guild.
+    """
+    cursor.execute("SELECT changes FROM guildList.GuildChanges WHERE "+
+                   "guildID=%s", (guild_id,))
+    records = cursor.fetchall()
+
+    return records[0][0] if records else 0
@@ -0,0 +1,236 @@
+import logging
+import re
+from functools import lru_cache
+
+from mysql.connector import DatabaseError
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("guild_storage")
+
+# The database every guild's rows are kept in when the storage is shared.
+shared_database = "guildData"
+
+# The tables each guild has. When the storage is shared each one has a guildID
+# column in front of the rest.
+guild_tables = ("Channels", "Members", "VoiceActivity", "Messages",
+                "ChannelCheckpoints", "PendingAttachments", "MessageRevisions",
+                "MessageTerms", "SearchIndexState", "ArchivedDeletions")
+
+# The shapes of statement that write to a guild's tables, picked apart so they
+# can be pointed at the shared table of the same name instead.
+insert_statement = re.compile(r"^\s*(INSERT(?:\s+IGNORE)?\s+INTO)\s+"+
+                              r"([\w.]+)\s*\(([^)]*)\)\s*"+
+                              r"(VALUES\s*\(|SELECT\s)(.*)$",
+                              re.IGNORECASE | re.DOTALL)
+update_statement = re.compile(r"^\s*UPDATE\s+([\w.]+)\s+SET\s+(.*?)\s+"+
+                              r"WHERE\s+(.*)$", re.IGNORECASE | re.DOTALL)
+delete_statement = re.compile(r"^\s*DELETE\s+FROM\s+([\w.]+)\s+WHERE\s+"+
+                              r"(.*)$", re.IGNORECASE | re.DOTALL)
+
+# The table any other statement writes to, so one that can't be pointed at
+# the shared tables is caught rather than run.
+write_target = re.compile(r"^\s*(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE(?:\s+"+
+                          r"INTO)?|UPDATE|DELETE\s+FROM)\s+([\w.]+)",
+                          re.IGNORECASE)
+
+@lru_cache(maxsize=256)
+def shared_statement(sql: str) -> tuple:
+    """
+    Points a statement that writes to one of a guild's tables at the shared
+    table instead, with the guild given by an extra value rather than by the
+    view it would otherwise go through.\n
+    sql: The statement, written for a guild's own database.\n
+    Returns the statement to run and where in its values the guild's ID goes,
+    which is None if the statement doesn't write to a guild's table and is
+    run as it is.
+    """
+    match = insert_statement.match(sql)
+    if match and match[2] in guild_tables:
+        # The guild's ID goes in front of the row, or of the selected columns.
+        return (f"{match[1]} {shared_database}.{match[2]} (guildID,{match[3]})"+
+                f" {match[4]}%s,{match[5]}", 0)
+
+    match = update_statement.match(sql)
+    if match and match[1] in guild_tables:
+        # The guild's ID comes after the values being set.
+        return (f"UPDATE {shared_database}.{match[1]} SET {match[2]} WHERE "+
+                f"guildID=%s AND ({match[3]})", match[2].count("%s"))
+
+    match = delete_statement.match(sql)
+    if match and match[1] in guild_tables:
+        return (f"DELETE FROM {shared_database}.{match[1]} WHERE guildID=%s "+
+                f"AND ({match[2]})", 0)
+
+    match = write_target.match(sql)
+    if match and match[1] in guild_tables:
+        raise ValueError(f"Can't write to the shared {match[1]} table with: "+
+                         f"{sql}")
+
+    return sql, None
+
+class GuildCursor:
+    """
+    Runs a guild's statements when the storage is shared. Anything that
+    writes to one of the guild's tables goes straight to the shared table with
+    the guild's ID as a value, so the statement is the same for every guild.
+    Everything else, such as reading through the guild's views, is run as it
+    is, and anything else asked of the cursor is passed through to it.\n
+    cursor: The cursor to run the statements on.\n
+    guild_id: The ID of the guild.
+    """
+    def __init__(self, cursor, guild_id: int):
+        self.cursor = cursor
+        self.guild_id = int(guild_id)
+
+    def __getattr__(self, name: str):
+        # Only called for attributes the wrapper doesn't have itself.
+        return getattr(self.cursor, name)
+
+    def execute(self, sql: str, params: tuple = None):
+        """
+        Runs a statement once.\n
+        sql: The statement, with %s for each of its values.\n
+        params: The values.
+        """
+        sql, position = shared_statement(sql)
+        if position is not None:
+            params = self._with_guild(params, position)
+
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql: str, rows: list):
+        """
+        Runs a statement for each row of values.\n
+        sql: The statement, with %s for each of its values.\n
+        rows: The values for each run of it.
+        """
+        sql, position = shared_statement(sql)
+        if position is not None:
+            rows = [self._with_guild(params, position) for params in rows]
+
+        return self.cursor.executemany(sql, rows)
+
+    def _with_guild(self, params, position: int) -> list:
+        """
+        Adds the guild's ID to a statement's values.
+        """
+        params = list(params or ())
+        params.insert(position, self.guild_id)
+        return params
+
+class GuildStorage:
+    """
+    Decides where each guild's tables are kept. By default every guild has a
+    server{id} database of its own. When shared, every guild's rows are kept
+    together in the tables of the guildData database instead, keyed by guildID,
+    so the guilds share one set of table files and indexes in the buffer pool
+    and one connection and transaction can write to any of them.\n
+    Each guild still has a server{id} database when shared, but it only holds
+    views of the guild's rows in the shared tables, so every query written for
+    a guild's database works the same either way. The views are only read
+    from. A guild's rows are written to the shared tables directly, through
+    the cursor() or prepared() of the guild, which also keeps the statements
+    the same for every guild.\n
+    shared: Whether every guild's rows are kept in the shared tables.
+    """
+    def __init__(self, shared: bool):
+        self.shared = shared
+
+    def use(self, cursor, guild_id: int):
+        """
+        Switches to a guild's database.\n
+        cursor: The cursor for the MySQL connection.\n
+        guild_id: The ID of the guild.
+        """
+        cursor.execute(f"USE server{int(guild_id)}")
+
+    def cursor(self, cursor, guild_id: int):
+        """
+        Gets the cursor to run a guild's statements on, which writes to the
+        shared tables if the storage is shared.\n
+        cursor: The cursor for the MySQL connection, already using the guild's
+        database.\n
+        guild_id: The ID of the guild.
+        """
+        if not self.shared:
+            return cursor
+
+        return GuildCursor(cursor, guild_id)
+
+    def prepared(self, connection, guild_id: int):
+        """
+        Gets a cursor that runs a guild's writes as prepared statements. When
+        the storage is shared they're prepared against the shared tables, so
+        every guild's writes reuse the same statements. Only for statements
+        that write to a single table and don't return any rows.\n
+        connection: The pooled connection, already using the guild's
+        database.\n
+        guild_id: The ID of the guild.
+        """
+        if not self.shared:
+            return connection.prepared(f"server{int(guild_id)}")
+
+        return GuildCursor(connection.prepared(shared_database), guild_id)
+
+    def databases(self, guild_ids: list) -> list:
+        """
+        Gets the databases that hold the tables of some guilds, which is the
+        one shared database if the storage is shared. Used for the work done
+        to the tables themselves, such as migrations and partitioning.\n
+        guild_ids: The IDs of the guilds.
+        """
+        if self.shared:
+            return [shared_database]
+
+        return [f"server{guild_id}" for guild_id in guild_ids]
+
+    def prepare(self, cursor):
+        """
+        Creates the shared tables, if the storage is shared and they don't
+        exist yet. They're created as they are after every migration so far,
+        so those are recorded as already applied.\n
+        cursor: The cursor for the MySQL connection.
+        """
+        if not self.shared:
+            return
+
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {shared_database}")
+        cursor.execute(f"USE {shared_database}")
+
+        with open("sql/shared_database_creator.sql", 'rt') as sql_comm:
+            command = sql_comm.read()
+
+        try:
+            for cmd in cursor.execute(command, multi=True):
+                # Ignore this. It's only here so 'cmd' doesn't throw as a
+                # problem by the linter.
+                cmd
+
+            cursor.execute("COMMIT")
+
+        except DatabaseError as err:
+            logger.critical(f"There was an issue creating the "+
+                            f"{shared_database} database.\n{err}")
+
+    def build_views(self, cursor, guild_id: int):
+        """
+        Creates a guild's database of views onto the shared tables, or brings
+        the views up to date with any columns the shared tables have gained.\n
+        cursor: The cursor for the MySQL connection.\n
+        guild_id: The ID of the guild.
+        """
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS server{guild_id}")
+
+        cursor.execute("SELECT TABLE_NAME,COLUMN_NAME FROM information_schema."+
+                       "COLUMNS WHERE TABLE_SCHEMA=%s AND COLUMN_NAME<>"+
+                       "'guildID' ORDER BY TABLE_NAME,ORDINAL_POSITION",
+                       (shared_database,))
+        columns = {}
+        for table, column in cursor.fetchall():
+            columns.setdefault(table, []).append(column)
+
+        for table in guild_tables:
+            cursor.execute(f"CREATE OR REPLACE VIEW server{guild_id}.{table} "+
+                           "AS SELECT "+",".join(columns[table])+" FROM "+
+                           f"{shared_database}.{table} WHERE "+
+                           f"guildID={int(guild_id)}")
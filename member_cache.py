@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+class MemberCache:
+    """
+    A bounded, least recently used cache of the Members rows that have been
+    written to each guild's database, keyed by (guildID, memberID). Rows are in
+    the same form as "SELECT * FROM Members" returns them.\n
+    size: The most rows to keep before the least recently used are dropped.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, guild_id: int, member_id: int) -> tuple:
+        """
+        Gets the last written row for a member, or None if it isn't cached.\n
+        guild_id: The ID of the guild the member is in.\n
+        member_id: The ID of the member.
+        """
+        key = (guild_id, member_id)
+
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+
+        return row
+
+    def put(self, guild_id: int, row: tuple):
+        """
+        Records the row that was written for a member.\n
+        guild_id: The ID of the guild the member is in.\n
+        row: The Members row, starting with the member's ID.
+        """
+        key = (guild_id, row[0])
+
+        with self._lock:
+            self._rows[key] = row
+            self._rows.move_to_end(key)
+
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def update_user(self, member_id: int, name: str, discriminator: int):
+        """
+        Updates the name and discriminator of a user in every guild they're
+        cached for, as those are shared between guilds.\n
+        member_id: The ID of the user.\n
+        name: The user's new name.\n
+        discriminator: The user's new discriminator.
+        """
+        with self._lock:
+            for key, row in self._rows.items():
+                if key[1] == member_id:
+                    self._rows[key] = (row[0], name, discriminator, row[3],
+                                       row[4])
+
+    def discard(self, guild_id: int, member_id: int):
+        """
+        Forgets a member, so the next time they're seen they're written again.\n
+        guild_id: The ID of the guild the member is in.\n
+        member_id: The ID of the member.
+        """
+        with self._lock:
+            self._rows.pop((guild_id, member_id), None)
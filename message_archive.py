@@ -0,0 +1,284 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("message_archive")
+
+# The columns of Messages, in the order they're written to an archive.
+archive_columns = ("ID", "messageID", "channelID", "authorID", "dateCreated",
+                   "isEdited", "dateEdited", "isDeleted", "dateDeleted",
+                   "message", "hasAttachment", "attachmentID", "filename",
+                   "qualifiedName", "url")
+
+class MessageArchive:
+    """
+    The cold tier of the message store. Messages old enough to be moved out of
+    a guild's database are kept here instead, in a gzipped file of JSON lines
+    for each channel and month, in order of messageID. Each guild has a
+    manifest listing its files along with the range of IDs and the authors in
+    each, so a lookup only opens the files that can have what it wants.\n
+    Everything older than a guild's archived_before() is in the archive, and
+    everything newer is in the database, so the two can be read one after the
+    other without any overlap.\n
+    path: The directory the archive is kept in.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def manifest(self, guild_id: int) -> dict:
+        """
+        Gets a guild's manifest, which is cached until the file changes.\n
+        guild_id: The ID of the guild.\n
+        Returns the manifest, which is empty if nothing has been archived.
+        """
+        manifest_path = os.path.join(self.path, f"server{guild_id}",
+                                     "manifest.json")
+        try:
+            modified = os.path.getmtime(manifest_path)
+        except OSError:
+            return {"archivedBefore": None, "months": {}}
+
+        with self._lock:
+            cached = self._manifests.get(guild_id)
+            if cached is not None and cached[0] == modified:
+                return cached[1]
+
+        with open(manifest_path, 'rt') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        with self._lock:
+            self._manifests[guild_id] = (modified, manifest)
+
+        return manifest
+
+    def archived_before(self, guild_id: int) -> int:
+        """
+        Gets the first messageID that's still in the database rather than the
+        archive.\n
+        guild_id: The ID of the guild.\n
+        Returns the ID, or None if nothing has been archived.
+        """
+        return self.manifest(guild_id)["archivedBefore"]
+
+    def write_month(self, guild_id: int, month: str, less_than: int,
+                    rows) -> int:
+        """
+        Archives a month of a guild's messages. The files are all written
+        before the manifest is updated to include them, so an archive that's
+        cut off part way through is just written again next time.\n
+        guild_id: The ID of the guild.\n
+        month: The month, in the YYYY-MM format.\n
+        less_than: The first messageID after the month.\n
+        rows: The messages, as tuples of archive_columns, ordered by channelID
+        then messageID.\n
+        Returns how many messages were archived.
+        """
+        guild_path = os.path.join(self.path, f"server{guild_id}")
+        channels = {}
+        count = 0
+
+        channel_id = None
+        archive = None
+        partial = None
+
+        try:
+            for row in rows:
+                record = dict(zip(archive_columns, row))
+
+                # Each channel's messages go in their own file.
+                if record["channelID"] != channel_id:
+                    if archive is not None:
+                        self._finish(archive, partial)
+
+                    channel_id = record["channelID"]
+                    file_name = os.path.join(str(channel_id),
+                                             f"{month}.jsonl.gz")
+                    channels[str(channel_id)] = {"file": file_name,
+                                                 "messages": 0,
+                                                 "first": record["messageID"],
+                                                 "authors": set()}
+
+                    os.makedirs(os.path.join(guild_path, str(channel_id)),
+                                exist_ok=True)
+                    partial = os.path.join(guild_path, file_name)+".part"
+                    archive = gzip.open(partial, 'wt', encoding="utf-8")
+
+                archive.write(json.dumps(record, default=str)+"\n")
+
+                entry = channels[str(channel_id)]
+                entry["messages"] += 1
+                entry["last"] = record["messageID"]
+                entry["authors"].add(record["authorID"])
+                count += 1
+
+            if archive is not None:
+                self._finish(archive, partial)
+                archive = None
+
+        finally:
+            if archive is not None:
+                archive.close()
+
+        for entry in channels.values():
+            entry["authors"] = sorted(entry["authors"])
+
+        manifest = self.manifest(guild_id)
+        manifest = {"archivedBefore": max(less_than,
+                                          manifest["archivedBefore"] or 0),
+                    "months": dict(manifest["months"])}
+        manifest["months"][month] = {"lessThan": less_than,
+                                     "channels": channels}
+
+        os.makedirs(guild_path, exist_ok=True)
+        manifest_path = os.path.join(guild_path, "manifest.json")
+        with open(manifest_path+".part", 'wt') as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(manifest_path+".part", manifest_path)
+
+        return count
+
+    def convert_month(self, guild_id: int, month: str, less_than: int,
+                      file_name: str) -> int:
+        """
+        Moves a month archived by older versions of the bot, as a single file
+        of the guild's messages in order of messageID, into a file for each
+        channel. The file is read once for each channel in it, so only one
+        message is held at a time, and only removed once the month is listed
+        in the manifest. A month that's already listed just has its old file
+        removed, so a conversion cut off part way through can be run again.\n
+        guild_id: The ID of the guild.\n
+        month: The month, in the YYYY-MM format.\n
+        less_than: The first messageID after the month.\n
+        file_name: The old file, relative to the archive's directory.\n
+        Returns how many messages were converted.
+        """
+        path = os.path.join(self.path, file_name)
+        count = 0
+
+        if month not in self.manifest(guild_id)["months"]:
+            channels = []
+            if os.path.isfile(path):
+                channels = sorted({record["channelID"]
+                                   for record in self._records(path)})
+
+            # The month is still listed, so it's known to be archived.
+            else:
+                logger.warning(f"The archive of server{guild_id} from {month} "+
+                               f"is missing from {path}.")
+
+            def rows():
+                for channel_id in channels:
+                    for record in self._records(path):
+                        if record["channelID"] == channel_id:
+                            yield tuple(record[column]
+                                        for column in archive_columns)
+
+            count = self.write_month(guild_id, month, less_than, rows())
+
+        if os.path.isfile(path):
+            os.remove(path)
+
+        return count
+
+    def read(self, guild_id: int, first: int = None, last: int = None,
+             author: int = None, descending: bool = False):
+        """
+        Yields a guild's archived messages in order of messageID, across every
+        channel.\n
+        guild_id: The ID of the guild.\n
+        first: The lowest messageID to include, if any.\n
+        last: The highest messageID to include, if any.\n
+        author: Only include the messages from this member, if given.\n
+        descending: Whether to go from the newest message to the oldest.
+        Each month is read into memory to do this.\n
+        Each message is a dict of archive_columns.
+        """
+        guild_path = os.path.join(self.path, f"server{guild_id}")
+        months = sorted(self.manifest(guild_id)["months"].items(),
+                        reverse=descending)
+
+        for _, month in months:
+            files = []
+            for entry in month["channels"].values():
+                if first is not None and entry["last"] < first:
+                    continue
+                if last is not None and entry["first"] > last:
+                    continue
+                if author is not None and author not in entry["authors"]:
+                    continue
+
+                files.append(os.path.join(guild_path, entry["file"]))
+
+            if descending:
+                channels = [list(self._records(path))[::-1] for path in files]
+            else:
+                channels = [self._records(path) for path in files]
+
+            for record in heapq.merge(*channels, reverse=descending,
+                                      key=lambda record: record["messageID"]):
+                if first is not None and record["messageID"] < first:
+                    continue
+                if last is not None and record["messageID"] > last:
+                    continue
+                if author is not None and record["authorID"] != author:
+                    continue
+
+                yield record
+
+    def lookup(self, guild_id: int, message_ids: list) -> dict:
+        """
+        Finds archived messages by their IDs. Only the files covering each ID
+        are opened.\n
+        guild_id: The ID of the guild.\n
+        message_ids: The IDs of the messages.\n
+        Returns the messages that were found, as dicts of archive_columns,
+        by messageID. Only the first row of a message with several
+        attachments is kept.
+        """
+        guild_path = os.path.join(self.path, f"server{guild_id}")
+        wanted = set(message_ids)
+        found = {}
+
+        files = set()
+        for month in self.manifest(guild_id)["months"].values():
+            for entry in month["channels"].values():
+                if any(entry["first"] <= message_id <= entry["last"]
+                       for message_id in wanted):
+                    files.add(os.path.join(guild_path, entry["file"]))
+
+        for path in files:
+            for record in self._records(path):
+                if (record["messageID"] in wanted and
+                        record["messageID"] not in found):
+                    found[record["messageID"]] = record
+
+        return found
+
+    def _records(self, path: str):
+        """
+        Yields the messages in an archive file.
+        """
+        with gzip.open(path, 'rt', encoding="utf-8") as archive:
+            for line in archive:
+                yield json.loads(line)
+
+    def _finish(self, archive, partial: str):
+        """
+        Closes a finished archive file and puts it in place. It's written under
+        another name first so a file that's there is always complete, and made
+        sure to be on the disk as its rows are about to be dropped.
+        """
+        archive.close()
+
+        with open(partial, 'rb') as written:
+            os.fsync(written.fileno())
+        os.replace(partial, partial[:-len(".part")])
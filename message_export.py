@@ -0,0 +1,707 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+from datetime import datetime
+
+# Parquet exports need pyarrow, which the other formats don't.
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from message_archive import MessageArchive
+from snowflake import first_snowflake, last_snowflake
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("message_export")
+
+# The columns of an export, in the order the gimme query selects them.
+export_columns = ("Message ID", "Channel Name", "Author ID", "Author Name",
+                  "Date Created", "Date Edited", "Date Deleted", "Message",
+                  "Filename", "URL")
+
+# How dates are written to a CSV export.
+export_time_format = "%Y/%m/%d %H:%M:%S"
+
+class ExportWriter:
+    """
+    Writes the rows of an export to files one at a time, so memory use stays
+    the same no matter how many messages are exported. Once a file would go
+    over max_bytes a new one is started so every file can be uploaded to
+    Discord. Each format is a subclass.\n
+    directory: The directory the files are written to.\n
+    base_name: The name of the files, without the extension.\n
+    max_bytes: The biggest any one file is allowed to be.
+    """
+    extension = ""
+
+    def __init__(self, directory: str, base_name: str, max_bytes: int):
+        self.directory = directory
+        self.base_name = base_name
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.paths = []
+
+        self._part_rows = 0
+
+    def write(self, row: tuple):
+        """
+        Adds a row to the export.\n
+        row: The row as selected by the gimme query.
+        """
+        record = self._record(row)
+
+        # Start a new file if this row won't fit in the current one. Every file
+        # gets at least one row, however big it is.
+        if not self.paths or (self._part_rows and not self._fits(record)):
+            self._next_part()
+
+        self._write(record)
+        self._part_rows += 1
+        self.rows += 1
+
+    def close(self) -> list:
+        """
+        Finishes the export.\n
+        Returns the paths of the files written, in order.
+        """
+        # An export with nothing in it still gets a file.
+        if not self.paths:
+            self._next_part()
+
+        self._finish_part()
+
+        # Only number the files if there's more than one of them.
+        if len(self.paths) == 1:
+            path = os.path.join(self.directory, self.base_name+self.extension)
+            os.replace(self.paths[0], path)
+            self.paths[0] = path
+
+        return self.paths
+
+    def _next_part(self):
+        """
+        Finishes the current file, if there is one, and starts the next.
+        """
+        if self.paths:
+            self._finish_part()
+
+        path = os.path.join(self.directory, f"{self.base_name}_part"+
+                            f"{len(self.paths) + 1}{self.extension}")
+        self.paths.append(path)
+        self._part_rows = 0
+        self._start_part(path)
+
+    def _record(self, row: tuple):
+        """
+        Turns a row from the query into whatever the format writes.
+        """
+        raise NotImplementedError
+
+    def _fits(self, record) -> bool:
+        """
+        Whether a record can go in the current file without taking it over
+        max_bytes.
+        """
+        raise NotImplementedError
+
+    def _write(self, record):
+        """
+        Writes a record to the current file.
+        """
+        raise NotImplementedError
+
+    def _start_part(self, path: str):
+        """
+        Opens a new file.
+        """
+        raise NotImplementedError
+
+    def _finish_part(self):
+        """
+        Finishes and closes the current file.
+        """
+        raise NotImplementedError
+
+class LineExportWriter(ExportWriter):
+    """
+    An export written a line at a time, optionally compressed with gzip.\n
+    directory: The directory the files are written to.\n
+    base_name: The name of the files, without the extension.\n
+    max_bytes: The biggest any one file is allowed to be.\n
+    compress: Whether to gzip the files.
+    """
+    # Room left at the end of a compressed file for the gzip trailer and for
+    # data that doesn't compress.
+    gzip_reserve = 1024
+
+    def __init__(self, directory: str, base_name: str, max_bytes: int,
+                 compress: bool = False):
+        super().__init__(directory, base_name, max_bytes)
+        self.compress = compress
+        if compress:
+            self.extension += ".gz"
+
+        self._raw = None
+        self._file = None
+        self._pending = 0
+
+    def _record(self, row: tuple) -> bytes:
+        return self._line(row)
+
+    def _fits(self, line: bytes) -> bool:
+        if not self.compress:
+            return self._raw.tell() + len(line) <= self.max_bytes
+
+        # Compressed data never comes out much bigger than it went in, so only
+        # when what's still waiting in the compressor might not fit does it
+        # need flushing to find out how big the file really is.
+        room = self.max_bytes - self.gzip_reserve - len(line)
+        if self._raw.tell() + self._pending <= room:
+            return True
+
+        self._file.flush()
+        self._pending = 0
+        return self._raw.tell() <= room
+
+    def _write(self, line: bytes):
+        self._file.write(line)
+        self._pending += len(line)
+
+    def _start_part(self, path: str):
+        self._raw = open(path, 'wb')
+        self._file = self._raw
+        if self.compress:
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='wb',
+                                       compresslevel=6)
+
+        self._file.write(self._header())
+        self._pending = 0
+
+    def _finish_part(self):
+        self._file.close()
+        self._raw.close()
+
+    def _header(self) -> bytes:
+        """
+        What goes at the start of every file.
+        """
+        return b""
+
+    def _line(self, row: tuple) -> bytes:
+        """
+        Turns a row into a line of the file.
+        """
+        raise NotImplementedError
+
+class CsvExportWriter(LineExportWriter):
+    """
+    Writes an export as CSV, with the column names at the top of every file.
+    """
+    extension = ".csv"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer)
+
+    def _header(self) -> bytes:
+        return self._encode(export_columns)
+
+    def _line(self, row: tuple) -> bytes:
+        return self._encode(tuple(self._format(value) for value in row))
+
+    def _encode(self, values: tuple) -> bytes:
+        self._csv.writerow(values)
+        line = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return line
+
+    @staticmethod
+    def _format(value):
+        if isinstance(value, datetime):
+            return value.strftime(export_time_format)
+
+        # IDs are written as text so spreadsheets don't round them.
+        elif isinstance(value, int):
+            return str(value)
+
+        return value
+
+class JsonLinesExportWriter(LineExportWriter):
+    """
+    Writes an export as JSON Lines, one object per message keyed by the column
+    names.
+    """
+    extension = ".jsonl"
+
+    def _line(self, row: tuple) -> bytes:
+        return (json.dumps(dict(zip(export_columns, map(self._format, row))),
+                           ensure_ascii=False)+"\n").encode("utf-8")
+
+    @staticmethod
+    def _format(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+
+        # IDs are written as text as they're too big for a JavaScript number.
+        elif isinstance(value, int):
+            return str(value)
+
+        return value
+
+class ParquetExportWriter(ExportWriter):
+    """
+    Writes an export as Parquet, which is compressed by column and keeps the
+    IDs and dates as their proper types. Rows are held until there's a row
+    group's worth, which is the most memory the export ever uses.\n
+    directory: The directory the files are written to.\n
+    base_name: The name of the files, without the extension.\n
+    max_bytes: The biggest any one file is allowed to be.\n
+    group_bytes: Roughly how much data goes in each row group.
+    """
+    extension = ".parquet"
+
+    # Room left at the end of a file for its footer.
+    footer_reserve = 65536
+
+    def __init__(self, directory: str, base_name: str, max_bytes: int,
+                 group_bytes: int = 4194304):
+        if pyarrow is None:
+            raise ValueError("Parquet exports need pyarrow to be installed.")
+
+        super().__init__(directory, base_name, max_bytes)
+        self.group_bytes = group_bytes
+
+        self.schema = pyarrow.schema([
+            (export_columns[0], pyarrow.int64()),
+            (export_columns[1], pyarrow.string()),
+            (export_columns[2], pyarrow.int64()),
+            (export_columns[3], pyarrow.string()),
+            (export_columns[4], pyarrow.timestamp("s")),
+            (export_columns[5], pyarrow.timestamp("s")),
+            (export_columns[6], pyarrow.timestamp("s")),
+            (export_columns[7], pyarrow.string()),
+            (export_columns[8], pyarrow.string()),
+            (export_columns[9], pyarrow.string())])
+
+        self._sink = None
+        self._writer = None
+        self._group = []
+        self._group_size = 0
+        self._last_group = 0
+
+    def _record(self, row: tuple) -> tuple:
+        return row
+
+    def _fits(self, row: tuple) -> bool:
+        # Files can only be split between row groups, so going by the size of
+        # the last group, check there's room for another once this one is full.
+        if self._group:
+            return True
+
+        return (self._sink.tell() + self._last_group + self.footer_reserve <=
+                self.max_bytes)
+
+    def _write(self, row: tuple):
+        self._group.append(row)
+        self._group_size += sum(len(value) for value in row
+                                if isinstance(value, str)) + 64
+
+        if self._group_size >= self.group_bytes:
+            self._write_group()
+
+    def _start_part(self, path: str):
+        self._sink = open(path, 'wb')
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema,
+                                                     compression="zstd")
+
+    def _finish_part(self):
+        self._write_group()
+        self._writer.close()
+        self._sink.close()
+
+    def _write_group(self):
+        """
+        Writes the rows being held as a row group.
+        """
+        if not self._group:
+            return
+
+        start = self._sink.tell()
+        columns = [list(column) for column in zip(*self._group)]
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type)
+             for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+        self._last_group = self._sink.tell() - start
+
+        self._group = []
+        self._group_size = 0
+
+# The formats gimme can export as, and the writer for each.
+export_formats = {
+    "csv": lambda *args: CsvExportWriter(*args),
+    "csv.gz": lambda *args: CsvExportWriter(*args, compress=True),
+    "jsonl": lambda *args: JsonLinesExportWriter(*args),
+    "jsonl.gz": lambda *args: JsonLinesExportWriter(*args, compress=True),
+}
+
+# Parquet is only offered if pyarrow is installed.
+if pyarrow is not None:
+    export_formats["parquet"] = lambda *args: ParquetExportWriter(*args)
+
+def export_writer(export_format: str, directory: str, base_name: str,
+                  max_bytes: int) -> ExportWriter:
+    """
+    Gets the writer for an export.\n
+    export_format: One of the keys of export_formats.\n
+    directory: The directory the files are written to.\n
+    base_name: The name of the files, without the extension.\n
+    max_bytes: The biggest any one file is allowed to be.\n
+    Raises ValueError if the format isn't known or can't be used.
+    """
+    if export_format not in export_formats:
+        raise ValueError(f"Unknown export format \'{export_format}\'. It must "+
+                         "be one of "+", ".join(export_formats)+".")
+
+    return export_formats[export_format](directory, base_name, max_bytes)
+
+def export_rows(cursor, writer: ExportWriter, fetch_size: int = 1000,
+                progress=None):
+    """
+    Writes every row of an executed query to an export. The cursor should be
+    unbuffered so the rows are streamed from the server a batch at a time
+    rather than all being held in memory.\n
+    cursor: The cursor the gimme query was executed on.\n
+    writer: The export to write the rows to.\n
+    fetch_size: How many rows are fetched from the server at a time.\n
+    progress: Called with how many rows have been written after each batch.
+    """
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+
+        for row in rows:
+            writer.write(row)
+
+        if progress is not None:
+            progress(writer.rows)
+
+def export_archived(cursor, archive: MessageArchive, guild_id: int,
+                    writer: ExportWriter, fetch_size: int = 1000,
+                    progress=None, first: int = None, last: int = None,
+                    author: int = None, descending: bool = False,
+                    limit: int = None):
+    """
+    Writes archived messages to an export just as they'd have come from the
+    database. The names, and any edits or deletions made since the messages
+    were archived, are looked up in the database fetch_size messages at a
+    time.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database.\n
+    archive: Where the messages are archived.\n
+    guild_id: The ID of the guild.\n
+    writer: Where the messages are written to.\n
+    fetch_size: How many messages are looked up at a time.\n
+    progress: Called with how many rows have been written after each batch.\n
+    first: The lowest messageID to include, if any.\n
+    last: The highest messageID to include, if any.\n
+    author: Only include the messages from this member, if given.\n
+    descending: Whether to go from the newest message to the oldest.\n
+    limit: The most messages to write, if any.
+    """
+    records = archive.read(guild_id, first, last, author, descending)
+    channels = {}
+    members = {}
+    written = 0
+
+    while limit is None or written < limit:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= fetch_size or (limit is not None and
+                                            written+len(batch) >= limit):
+                break
+
+        if not batch:
+            break
+
+        message_ids = list({record["messageID"] for record in batch})
+        placeholders = ",".join(["%s"] * len(message_ids))
+
+        # Only look up the names that haven't been seen yet.
+        missing = list({record["channelID"] for record in batch} -
+                       channels.keys())
+        if missing:
+            cursor.execute("SELECT channelID,channelName FROM Channels WHERE "+
+                           "channelID IN ("+",".join(["%s"] * len(missing))+")",
+                           missing)
+            channels.update(cursor.fetchall())
+
+        missing = list({record["authorID"] for record in batch} -
+                       members.keys())
+        if missing:
+            cursor.execute("SELECT memberID,CONCAT(memberName,'#',"+
+                           "discriminator) FROM Members WHERE memberID IN ("+
+                           ",".join(["%s"] * len(missing))+")", missing)
+            members.update(cursor.fetchall())
+
+        cursor.execute("SELECT messageID,dateEdited,message FROM "+
+                       f"MessageRevisions WHERE messageID IN ({placeholders}) "+
+                       "ORDER BY ID", message_ids)
+        revisions = {row[0]: row for row in cursor.fetchall()}
+
+        cursor.execute("SELECT messageID,dateDeleted FROM ArchivedDeletions "+
+                       f"WHERE messageID IN ({placeholders})", message_ids)
+        deletions = dict(cursor.fetchall())
+
+        for record in batch:
+            message_id = record["messageID"]
+            revision = revisions.get(message_id)
+
+            writer.write((message_id, channels.get(record["channelID"]),
+                          record["authorID"], members.get(record["authorID"]),
+                          _archived_date(record["dateCreated"]),
+                          revision[1] if revision else
+                          _archived_date(record["dateEdited"]),
+                          deletions.get(message_id,
+                                        _archived_date(record["dateDeleted"])),
+                          revision[2] if revision else record["message"],
+                          record["filename"], record["url"]))
+
+        written += len(batch)
+
+        if progress is not None:
+            progress(writer.rows)
+
+def _archived_date(value):
+    """
+    Turns a date from the archive back into a datetime.
+    """
+    if value is None:
+        return None
+
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+def gimme_export(mydb, directory: str, export_format: str, request: tuple,
+                 requesting_user: int, user: str, guild: str,
+                 request_range: str, date1, date2, part_size: int,
+                 fetch_size: int, progress=None,
+                 archive: MessageArchive = None) -> tuple:
+    """
+    Looks up the messages asked for by gimme and streams them into export
+    files, from the database and the archive alike.\n
+    mydb: The connection to the database server. It should be unbuffered.\n
+    directory: The directory the files are written to.\n
+    export_format: Which of the export_formats to write.\n
+    request: The tuple containing all of the pertinant request information.\n
+    requesting_user: The ID of the user that made the request.\n
+    user: The user the messages are being requested for, or "all".\n
+    guild: The guild the messages are being requested from.\n
+    request_range: Which range of messages to get.\n
+    date1: The first date, or the number of messages for "latest".\n
+    date2: The second date for "between".\n
+    part_size: The biggest any one file is allowed to be.\n
+    fetch_size: How many rows are fetched from the server at a time.\n
+    progress: Called with how many rows have been written as the export goes.\n
+    archive: Where the guild's older messages are archived, if anywhere.\n
+    Returns the paths of the files, or the reason they could not be made.
+    """
+
+    cursor=mydb.cursor()
+
+    # Check if the guild is given as an ID.
+    try:
+        guild=int(guild)
+    except ValueError:
+        # If it isn't, get the guildID from the guildList.
+        cursor.execute("USE guildList")
+        sql="SELECT guildID FROM Guilds WHERE guildName=%s"
+        cursor.execute(sql,(guild,))
+        guild=cursor.fetchall()
+        if len(guild)==0:
+            cursor.close()
+            return None, (f"Sorry, I could not find the {request[1]} server "+
+                          "in my database. Please double check that it's "+
+                          "spelled correctly.")
+        else:
+            guild=guild[0][0]
+
+    # Use the guild.
+    cursor.execute(f"USE server{guild}")
+
+    # Check to see if the requesting user is a current or former member of this
+    # guild.
+    cursor.execute("SELECT memberID FROM Members WHERE memberID="+
+                   f"{requesting_user}")
+    requesting_user=cursor.fetchall()
+
+    # If they are not either a current or previous member of a guild.
+    if len(requesting_user)==0:
+        # Let them know that they can't request that information.
+        cursor.close()
+        return None, ("You must be either a current or former member of the "+
+                      "guild that you are trying to get messages from.")
+
+    # Build the initial SQL statement.
+    sql=("SELECT messageID,Channels.channelName,authorID,"+
+         "CONCAT(Members.memberName,'#',Members.discriminator),dateCreated,"+
+         "dateEdited,dateDeleted,COALESCE((SELECT MessageRevisions.message "+
+         "FROM MessageRevisions WHERE MessageRevisions.messageID="+
+         "Messages.messageID ORDER BY MessageRevisions.ID DESC LIMIT 1),"+
+         "message),filename,url FROM Messages "+
+	    "LEFT JOIN Channels ON (Messages.channelID=Channels.channelID) "+
+	    "LEFT JOIN Members ON (Messages.authorID=Members.memberID) ")
+
+    # If there is some sort of limiting factor, add "WHERE".
+    if str(user).lower()!="all" or isinstance(date1,datetime):
+        sql+="WHERE "
+
+    # Check if the user is given as an ID.
+    try:
+        user=int(user)
+    except ValueError:
+        # If it isn't, get the user's ID from the Members table.
+        if user.lower()!="all":
+            user=user.split("#")
+            user[1]=int(user[1])
+            get_user=("SELECT memberID FROM Members where memberName=%s AND "+
+                "discriminator=%s")
+            cursor.execute(get_user,user)
+            user=cursor.fetchall()
+            if len(user)==0:
+                cursor.close()
+                return None, (f"Sorry, I could not find user {request[0]} in "+
+                              f"{request[1]}. Either the name was misspelled "+
+                              "or they are not in this server.")
+            else:
+                user=user[0][0]
+                sql+="authorID=%s "
+    
+    # If The first date is an actual date (as opposed to being an integer) and
+    # the user is a userID (as opposed to the string "all"), then append "AND"
+    if isinstance(date1,datetime) and isinstance(user,int):
+        sql+="AND "
+    
+    # If the first date is instead an integer, then set the limiting.
+    elif isinstance(date1,int):
+        sql+= "ORDER BY messageID DESC LIMIT %s"
+
+    # Message IDs start with when the message was sent, so the dates are looked
+    # up as a range of IDs, which is a range of the primary key.
+    bound1=date1
+    bound2=date2
+
+    # If the range is "between", then set the ranges.
+    if request_range.lower()=="between":
+        sql+="messageID BETWEEN %s AND %s"
+        bound1=first_snowflake(date1)
+        bound2=last_snowflake(date2)
+    
+    # If the range is "before", set the range to be less than the set date.
+    elif request_range.lower()=="before":
+        sql+="messageID <= %s"
+        date1=date1.replace(hour=23,minute=59,second=59)
+        bound1=last_snowflake(date1)
+    
+    # If the range is "after", set the range to be greater than the set date.
+    elif request_range.lower()=="after":
+        sql=sql+"messageID >= %s"
+        bound1=first_snowflake(date1)
+
+    # If the length is 5.
+    if len(request)==5:
+        # and the user is a number (as opposed to "all").
+        if isinstance(user,int):
+            params=(user,bound1,bound2)
+        # If the user is "all".
+        else:
+            params=(bound1,bound2)
+
+    # If the length is 4.
+    elif len(request)==4:
+        # and the user is a number (as opposed to "all").
+        if isinstance(user,int):
+            params=(user,bound1)
+        # If the user is "all".
+        else:
+            params=(bound1,)
+    
+    # If the length is anything else, there's only the user to limit by.
+    elif isinstance(user,int):
+        params=(user,)
+
+    else:
+        params=()
+
+    # Keep the messages in order so the archived ones can go before them.
+    if not isinstance(date1,int):
+        sql+=" ORDER BY messageID"
+
+    # Build an appropriate name for the file.
+    export_name = str(user)
+
+    # Append the guild and the range.
+    export_name+="_from_"+str(guild)+"_"+request_range+"_"
+
+    # If the range is "between".
+    if request_range.lower()=="between":
+        # Append both of the dates.
+        export_name+=str(date1)+"_and_"+str(date2)
+    
+    # If it's anything else.
+    else:
+        # Append the date or number.
+        export_name+=str(date1)
+
+    # Replace the colons from the datetime and make them hyphens so the text is
+    # appropriate for a filename.
+    export_name=str(export_name).replace(":","-")
+
+    # The range of IDs and the author to look for in the archive.
+    first=bound1 if request_range.lower() in ("between","after") else None
+    last=None
+    if request_range.lower()=="between":
+        last=bound2
+    elif request_range.lower()=="before":
+        last=bound1
+    author=user if isinstance(user,int) else None
+
+    archived=None
+    if archive is not None:
+        archived=archive.archived_before(guild)
+
+    # The cursor is unbuffered, so the rows are written out as they arrive from
+    # the server rather than all being loaded first. Everything archived is
+    # older than what's in the database, so it goes first, or last for
+    # "latest" as that's newest first.
+    writer = export_writer(export_format, directory, export_name, part_size)
+
+    if archived and not isinstance(date1,int) and (first is None or
+                                                    first<archived):
+        export_archived(cursor, archive, guild, writer, fetch_size, progress,
+                        first, last, author)
+
+    cursor.execute(sql,params)
+    export_rows(cursor, writer, fetch_size, progress)
+
+    if archived and isinstance(date1,int) and writer.rows<date1:
+        export_archived(cursor, archive, guild, writer, fetch_size, progress,
+                        author=author, descending=True,
+                        limit=date1-writer.rows)
+
+    export_paths = writer.close()
+
+    logger.info(f"Exported {writer.rows} messages from server{guild} in "+
+                f"{len(export_paths)} files.")
+
+    cursor.close()
+
+    return export_paths, None
@@ -0,0 +1,363 @@
+import logging
+from datetime import datetime
+
+from mysql.connector import DatabaseError, InterfaceError, errorcode
+from mysql.connector.errors import PoolError
+
+from connection_pool import ConnectionPool
+from database_executor import DatabaseExecutor
+from guild_storage import GuildStorage, shared_database
+from message_archive import MessageArchive, archive_columns
+from snowflake import first_snowflake, snowflake_time
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("message_partitions")
+
+def _next_month(month: datetime) -> datetime:
+    """
+    Gets the start of the month after the one given.
+    """
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+
+    return month.replace(month=month.month + 1)
+
+def _month_partition(month: datetime) -> str:
+    """
+    Builds the definition of the partition holding a month's messages. Each
+    partition holds everything sent before the end of its month that isn't in
+    an earlier one.
+    """
+    return (f"PARTITION p{month:%Y%m} VALUES LESS THAN "+
+            f"({first_snowflake(_next_month(month))})")
+
+class MessagePartitions:
+    """
+    Keeps each guild's Messages table split into a partition per month, by
+    messageID. The IDs start with when each message was sent, so a query for a
+    range of dates only reads the months it covers and the indexes of the
+    recent months that are used the most stay small.\n
+    Every run adds the partitions for the next few months, so new messages
+    always have one to go in. Months older than archive_after are moved to
+    the archive and dropped from the database.\n
+    Turning an existing table into partitions copies the whole table, which
+    blocks writes to it while it runs. So that's only done automatically for
+    tables of up to convert_rows messages, and the rest are left for the bot
+    owner to convert when it suits them.\n
+    When every guild is kept in the shared tables, there's only the one
+    Messages table to partition, and each month of it is archived a guild at a
+    time.\n
+    pool: The pool to borrow connections from.\n
+    database: The executor the database work runs on.\n
+    archive: Where the old months are moved to.\n
+    months_ahead: How many months ahead there are partitions for.\n
+    archive_after: How many whole months are kept in the database before
+    being archived. 0 means nothing is archived.\n
+    convert_rows: The most messages a table can have to be converted
+    automatically.\n
+    lock_wait_timeout: How many seconds to wait for the table's metadata lock
+    before giving up until the next run.\n
+    fetch_size: How many rows are fetched at a time while archiving.\n
+    storage: Where the guilds' tables are kept.
+    """
+    def __init__(self, pool: ConnectionPool, database: DatabaseExecutor,
+                 archive: MessageArchive, months_ahead: int = 3,
+                 archive_after: int = 0, convert_rows: int = 1000000,
+                 lock_wait_timeout: int = 5, fetch_size: int = 1000,
+                 storage: GuildStorage = None):
+        self.pool = pool
+        self.database = database
+        self.archive = archive
+        self.months_ahead = months_ahead
+        self.archive_after = archive_after
+        self.convert_rows = convert_rows
+        self.lock_wait_timeout = lock_wait_timeout
+        self.fetch_size = fetch_size
+        self.storage = storage or GuildStorage(False)
+
+    def maintain(self, guildID: str, cursor, convert: bool = False) -> bool:
+        """
+        Partitions a guild's Messages table if it isn't already, adds the
+        partitions for the coming months and archives the old ones.\n
+        guildID: The database, which is the ID for the guild in the
+        "server + ID" format unless the storage is shared.\n
+        cursor: The cursor for the MySQL connection, already using the
+        database.\n
+        convert: Whether to partition the table however big it is.\n
+        Returns False if the table's lock couldn't be had, meaning it should be
+        tried again later.
+        """
+        if guildID != shared_database:
+            self._convert_archive(guildID, cursor)
+
+        cursor.execute("SELECT PARTITION_NAME FROM information_schema."+
+                       "PARTITIONS WHERE TABLE_SCHEMA=DATABASE() AND "+
+                       "TABLE_NAME='Messages' AND PARTITION_NAME IS NOT NULL "+
+                       "ORDER BY PARTITION_ORDINAL_POSITION")
+        partitions = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute("SET SESSION lock_wait_timeout=%s",
+                       (self.lock_wait_timeout,))
+
+        try:
+            if not partitions:
+                return self._convert(guildID, cursor, convert)
+
+            self._roll_forward(guildID, cursor, partitions)
+
+            if self.archive_after:
+                self._archive(guildID, cursor, partitions)
+
+        except DatabaseError as err:
+            if err.errno == errorcode.ER_LOCK_WAIT_TIMEOUT:
+                logger.warning(f"{guildID} is busy. Partitioning it later.")
+                return False
+            raise
+
+        finally:
+            # Don't leave the short timeout on a connection going back to the
+            # pool.
+            cursor.execute("SET SESSION lock_wait_timeout=DEFAULT")
+
+        return True
+
+    def maintain_guild(self, guildID: str, convert: bool = False) -> bool:
+        """
+        Borrows a connection and maintains a single database's partitions.
+        Runs on a database worker.\n
+        guildID: The database, which is the ID for the guild in the
+        "server + ID" format unless the storage is shared.\n
+        convert: Whether to partition the table however big it is.\n
+        Returns False if it should be tried again later.
+        """
+        try:
+            mydb = self.pool.get_connection()
+
+        except (PoolError, DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not get a connection to partition "+
+                            f"{guildID}.\n{err}")
+            return False
+
+        cursor = mydb.cursor()
+
+        try:
+            cursor.execute(f"USE {guildID}")
+
+        # A database that doesn't exist yet is partitioned when it's built.
+        except DatabaseError:
+            cursor.close()
+            mydb.close()
+            return True
+
+        try:
+            return self.maintain(guildID, cursor, convert)
+
+        except (DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not partition {guildID}.\n{err}")
+            return True
+
+        finally:
+            cursor.close()
+            mydb.close()
+
+    async def maintain_all(self, guild_ids: list, convert: bool = False):
+        """
+        Maintains every guild's partitions, one at a time so only one table is
+        ever being changed at once. Guilds that are busy are left until the
+        next run.\n
+        guild_ids: The IDs of the guilds.\n
+        convert: Whether to partition the tables however big they are.
+        """
+        busy = 0
+        for guildID in self.storage.databases(guild_ids):
+            if not await self.database.run(self.maintain_guild, guildID,
+                                           convert):
+                busy += 1
+
+        if busy:
+            logger.warning(f"Could not partition {busy} busy guild databases. "+
+                           "They will be tried again on the next run.")
+
+    def _convert_archive(self, guildID: str, cursor):
+        """
+        Moves the months archived by older versions of the bot, which kept a
+        single file for each month listed in the ArchivedPartitions table,
+        into the archive as it is now. The table is dropped once every month
+        has been moved.
+        """
+        cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE "+
+                       "TABLE_SCHEMA=DATABASE() AND "+
+                       "TABLE_NAME='ArchivedPartitions'")
+        if not cursor.fetchall()[0][0]:
+            return
+
+        cursor.execute("SELECT partitionName,lessThan,fileName FROM "+
+                       "ArchivedPartitions ORDER BY lessThan")
+        months = cursor.fetchall()
+
+        try:
+            for name, less_than, file_name in months:
+                month = f"{datetime.strptime(name, 'p%Y%m'):%Y-%m}"
+                count = self.archive.convert_month(int(guildID[len("server"):]),
+                                                   month, less_than, file_name)
+
+                logger.info(f"Moved {count} archived messages of {guildID} "+
+                            f"from {month} into the current archive format.")
+
+        # The table is kept so the rest are moved on the next run.
+        except OSError as err:
+            logger.critical(f"Could not move the old archive of {guildID}."+
+                            f"\n{err}")
+            return
+
+        cursor.execute("DROP TABLE ArchivedPartitions")
+
+    def _convert(self, guildID: str, cursor, convert: bool) -> bool:
+        """
+        Turns an unpartitioned Messages table into one with a partition for
+        each month from its first message up to months_ahead from now.
+        """
+        cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES "+
+                       "WHERE TABLE_SCHEMA=DATABASE() AND "+
+                       "TABLE_NAME='Messages'")
+        rows = cursor.fetchall()[0][0] or 0
+
+        if rows > self.convert_rows and not convert:
+            logger.warning(f"The Messages table of {guildID} has about {rows} "+
+                           "messages, which is too many to partition "+
+                           "without being asked to.")
+            return True
+
+        # Messages can't be older than the guild, which also makes sure the
+        # history fetched for a new guild is spread over the right months. A
+        # guild of any age can be added to the shared tables, so they start
+        # from when Discord did.
+        cursor.execute("SELECT MIN(messageID) FROM Messages")
+        first_id = cursor.fetchall()[0][0]
+        if guildID == shared_database:
+            guild_id = 0
+        else:
+            guild_id = int(guildID[len("server"):])
+        if first_id is None or first_id > guild_id:
+            first_id = guild_id
+
+        month = snowflake_time(first_id).replace(day=1, hour=0, minute=0,
+                                                 second=0, microsecond=0)
+
+        definitions = []
+        for month in self._months(month):
+            definitions.append(_month_partition(month))
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+        logger.info(f"Partitioning the Messages table of {guildID} into "+
+                    f"{len(definitions)} partitions.")
+
+        cursor.execute("ALTER TABLE Messages PARTITION BY RANGE (messageID) ("+
+                       ",".join(definitions)+")")
+
+        return True
+
+    def _roll_forward(self, guildID: str, cursor, partitions: list):
+        """
+        Adds the partitions for any months up to months_ahead from now that
+        don't have one yet. They're split off the empty pmax partition, so
+        nothing has to be copied.
+        """
+        months = [name for name in partitions if name != "pmax"]
+        last = datetime.strptime(months[-1], "p%Y%m")
+
+        definitions = [_month_partition(month) for month in
+                       self._months(_next_month(last))]
+        if not definitions:
+            return
+
+        logger.info(f"Adding {len(definitions)} monthly partitions to "+
+                    f"{guildID}.")
+
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cursor.execute("ALTER TABLE Messages REORGANIZE PARTITION pmax INTO ("+
+                       ",".join(definitions)+")")
+
+    def _archive(self, guildID: str, cursor, partitions: list):
+        """
+        Moves each month older than archive_after to the archive, then drops
+        it from the database. The newest month before pmax is always kept so
+        there's somewhere for late arrivals to go.
+        """
+        now = datetime.utcnow()
+        months_back = now.year * 12 + now.month - 1 - self.archive_after
+        cutoff = datetime(months_back // 12, months_back % 12 + 1, 1)
+
+        months = [name for name in partitions if name != "pmax"][:-1]
+
+        for name in months:
+            month = datetime.strptime(name, "p%Y%m")
+            if month >= cutoff:
+                break
+
+            less_than = first_snowflake(_next_month(month))
+
+            if guildID == shared_database:
+                count = self._archive_shared(cursor, name, month, less_than)
+
+            else:
+                # Read a channel at a time, so only one file is written at
+                # once.
+                cursor.execute("SELECT "+",".join(archive_columns)+" FROM "+
+                               f"Messages PARTITION ({name}) ORDER BY "+
+                               "channelID,messageID")
+                count = self.archive.write_month(int(guildID[len("server"):]),
+                                                 f"{month:%Y-%m}", less_than,
+                                                 self._rows(cursor))
+
+            # Only dropped once the files are safely written and listed.
+            cursor.execute(f"ALTER TABLE Messages DROP PARTITION {name}")
+
+            logger.info(f"Archived {count} messages of {guildID} from "+
+                        f"{month:%Y-%m}.")
+
+    def _archive_shared(self, cursor, name: str, month: datetime,
+                        less_than: int) -> int:
+        """
+        Moves a month of the shared Messages table to each guild's archive.
+        Every guild with channels gets the month listed, even those without
+        any messages in it, so each one knows it's archived.\n
+        Returns how many messages were archived.
+        """
+        cursor.execute("SELECT DISTINCT guildID FROM Channels")
+        guild_ids = [row[0] for row in cursor.fetchall()]
+
+        count = 0
+        for guild_id in guild_ids:
+            cursor.execute("SELECT "+",".join(archive_columns)+" FROM "+
+                           f"Messages PARTITION ({name}) WHERE guildID=%s "+
+                           "ORDER BY channelID,messageID", (guild_id,))
+            count += self.archive.write_month(guild_id, f"{month:%Y-%m}",
+                                              less_than, self._rows(cursor))
+
+        return count
+
+    def _rows(self, cursor):
+        """
+        Yields the rows of a query fetch_size at a time.
+        """
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+
+            yield from rows
+
+    def _months(self, month: datetime):
+        """
+        Yields the start of each month from the one given up to and including
+        months_ahead from now.
+        """
+        end = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0,
+                                        microsecond=0)
+        for _ in range(self.months_ahead):
+            end = _next_month(end)
+
+        while month <= end:
+            yield month
+            month = _next_month(month)
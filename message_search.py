@@ -0,0 +1,279 @@
+import re
+
+from message_archive import MessageArchive
+
+# What counts as a word, and how long one can be to be searched for.
+word_pattern = re.compile(r"\w+")
+min_term_length = 2
+max_term_length = 64
+
+# How many words of a single message are indexed.
+max_message_terms = 2000
+
+term_sql = ("INSERT IGNORE INTO MessageTerms (term,messageID) VALUES (%s,%s)")
+
+def search_terms(text: str) -> list:
+    """
+    Splits text into the words it's indexed and searched by. Words are
+    lowercased and only counted once.\n
+    text: The content of a message or a search.
+    """
+    terms = []
+    seen = set()
+
+    for match in word_pattern.finditer((text or "").lower()):
+        term = match[0][:max_term_length]
+
+        if len(term) >= min_term_length and term not in seen:
+            seen.add(term)
+            terms.append(term)
+
+            if len(terms) >= max_message_terms:
+                break
+
+    return terms
+
+def index_messages(cursor, messages):
+    """
+    Adds the words of messages to the guild's MessageTerms table, so they can be
+    found by search_messages(). Words that are already indexed for a message are
+    skipped, so a message can safely be indexed again.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database.\n
+    messages: The (messageID, content) of each message. The same message can
+    appear more than once.
+    """
+    rows = []
+    for message_id, content in messages:
+        rows.extend((term, message_id) for term in search_terms(content))
+
+    if rows:
+        cursor.executemany(term_sql, rows)
+
+def parse_search(query: str) -> tuple:
+    """
+    Works out what a search is looking for. Every word has to be in a message
+    for it to match, and anything in double quotes has to appear exactly.\n
+    query: The search as typed.\n
+    Returns the words and the quoted phrases.
+    """
+    phrases = [phrase.strip() for phrase in re.findall(r'"([^"]+)"', query)]
+    phrases = [phrase for phrase in phrases if phrase]
+
+    # Search for the longest words first, as they're usually the rarest.
+    terms = sorted(search_terms(query), key=len, reverse=True)
+
+    return terms, phrases
+
+def search_messages(cursor, terms: list, phrases: list, page: int,
+                    page_size: int, archive: MessageArchive = None,
+                    guild_id: int = None) -> tuple:
+    """
+    Finds the messages with every one of the words in them, any version of
+    them. Each word's messages are read in order straight from the
+    MessageTerms primary key and the rest of the words are looked up one
+    message at a time, so the search doesn't get much slower as the guild gets
+    bigger. Archived messages come after the ones in the database, as they're
+    older, and are only looked at once a page goes past those.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database.\n
+    terms: The words from parse_search(), rarest first.\n
+    phrases: The phrases from parse_search().\n
+    page: Which page of results to get, starting at 1.\n
+    page_size: How many results there are on a page.\n
+    archive: Where the guild's older messages are archived, if anywhere.\n
+    guild_id: The ID of the guild, if there's an archive.\n
+    Returns the results, newest first, and whether there are more after them.
+    Each result is the messageID, channel name, author, date created, whether
+    it has been edited or deleted, and its latest content.
+    """
+    joins = ""
+    term_values = []
+    for index, term in enumerate(terms[1:], 1):
+        joins += (f"JOIN MessageTerms t{index} ON (t{index}.term=%s AND "+
+                  f"t{index}.messageID=t0.messageID) ")
+        term_values.append(term)
+
+    term_values.append(terms[0])
+
+    # Only messages that have every word can have the phrase, so the phrases
+    # are only checked against those.
+    phrase_sql = ""
+    phrase_values = []
+    for phrase in phrases:
+        phrase_sql += ("AND (Messages.message LIKE %s OR EXISTS (SELECT 1 "+
+                       "FROM MessageRevisions WHERE MessageRevisions."+
+                       "messageID=t0.messageID AND MessageRevisions.message "+
+                       "LIKE %s)) ")
+        pattern = ("%"+phrase.replace("\\", "\\\\").replace("%", "\\%")
+                   .replace("_", "\\_")+"%")
+        phrase_values.extend([pattern, pattern])
+
+    # A message with several attachments has a row for each, so only the first
+    # is used.
+    from_sql = (f"FROM MessageTerms t0 {joins}"+
+                "JOIN Messages ON (Messages.ID=(SELECT MIN(first.ID) FROM "+
+                "Messages first WHERE first.messageID=t0.messageID)) ")
+    where_sql = f"WHERE t0.term=%s {phrase_sql}"
+    offset = (page - 1) * page_size
+
+    cursor.execute("SELECT t0.messageID,Channels.channelName,"+
+                   "CONCAT(Members.memberName,'#',Members.discriminator),"+
+                   "Messages.dateCreated,Messages.isEdited,Messages.isDeleted,"+
+                   "COALESCE((SELECT MessageRevisions.message FROM "+
+                   "MessageRevisions WHERE MessageRevisions.messageID="+
+                   "t0.messageID ORDER BY MessageRevisions.ID DESC LIMIT 1),"+
+                   "Messages.message) "+from_sql+
+                   "LEFT JOIN Channels ON (Messages.channelID=Channels.channelID) "+
+                   "LEFT JOIN Members ON (Messages.authorID=Members.memberID) "+
+                   where_sql+"ORDER BY t0.messageID DESC LIMIT %s OFFSET %s",
+                   term_values+phrase_values+[page_size + 1, offset])
+    results = cursor.fetchall()
+
+    archived = None
+    if archive is not None:
+        archived = archive.archived_before(guild_id)
+
+    if len(results) > page_size or not archived:
+        return results[:page_size], len(results) > page_size
+
+    # The page runs past the messages in the database, so it carries on into
+    # the archive.
+    if results:
+        live = offset + len(results)
+    else:
+        cursor.execute("SELECT COUNT(*) "+from_sql+where_sql,
+                       term_values+phrase_values)
+        live = cursor.fetchall()[0][0]
+
+    results.extend(_search_archive(cursor, archive, guild_id, joins,
+                                   term_values, phrases, archived,
+                                   max(offset - live, 0),
+                                   page_size + 1 - len(results)))
+
+    return results[:page_size], len(results) > page_size
+
+def _search_archive(cursor, archive: MessageArchive, guild_id: int, joins: str,
+                    term_values: list, phrases: list, archived: int,
+                    skip: int, wanted: int) -> list:
+    """
+    Finds the archived messages with every one of the words in them for
+    search_messages(). Their words are still in MessageTerms, so only the
+    messages that have them all are read from the archive, a batch at a
+    time.\n
+    Returns up to wanted results, after skipping the first skip of them.
+    """
+    results = []
+    before = archived
+    batch_size = max(wanted, 100)
+
+    while len(results) < wanted:
+        cursor.execute(f"SELECT t0.messageID FROM MessageTerms t0 {joins}"+
+                       "WHERE t0.term=%s AND t0.messageID<%s ORDER BY "+
+                       "t0.messageID DESC LIMIT %s",
+                       term_values+[before, batch_size])
+        message_ids = [row[0] for row in cursor.fetchall()]
+        if not message_ids:
+            break
+        before = message_ids[-1]
+
+        records = archive.lookup(guild_id, message_ids)
+        placeholders = ",".join(["%s"] * len(message_ids))
+
+        # Edits and deletions made since the messages were archived are still
+        # kept in the database.
+        cursor.execute("SELECT messageID,message FROM MessageRevisions WHERE "+
+                       f"messageID IN ({placeholders}) ORDER BY ID",
+                       message_ids)
+        versions = {}
+        for message_id, content in cursor.fetchall():
+            versions.setdefault(message_id, []).append(content)
+
+        cursor.execute("SELECT messageID FROM ArchivedDeletions WHERE "+
+                       f"messageID IN ({placeholders})", message_ids)
+        deleted = {row[0] for row in cursor.fetchall()}
+
+        matches = []
+        for message_id in message_ids:
+            record = records.get(message_id)
+            if record is None:
+                continue
+
+            contents = [record["message"] or ""]+versions.get(message_id, [])
+            if not all(any(phrase.lower() in (content or "").lower()
+                           for content in contents) for phrase in phrases):
+                continue
+
+            if skip:
+                skip -= 1
+                continue
+
+            matches.append((record, contents[-1],
+                            bool(record["isEdited"]) or message_id in versions,
+                            bool(record["isDeleted"]) or message_id in deleted))
+
+        if matches:
+            channel_ids = list({match[0]["channelID"] for match in matches})
+            cursor.execute("SELECT channelID,channelName FROM Channels WHERE "+
+                           "channelID IN ("+",".join(["%s"] * len(channel_ids))+
+                           ")", channel_ids)
+            channels = dict(cursor.fetchall())
+
+            author_ids = list({match[0]["authorID"] for match in matches})
+            cursor.execute("SELECT memberID,CONCAT(memberName,'#',"+
+                           "discriminator) FROM Members WHERE memberID IN ("+
+                           ",".join(["%s"] * len(author_ids))+")", author_ids)
+            members = dict(cursor.fetchall())
+
+            for record, content, is_edited, is_deleted in matches:
+                results.append((record["messageID"],
+                                channels.get(record["channelID"]),
+                                members.get(record["authorID"]),
+                                record["dateCreated"], is_edited, is_deleted,
+                                content))
+
+    return results[:wanted]
+
+def backfill_search(cursor, batch_size: int) -> int:
+    """
+    Indexes the next batch of messages and revisions that were saved before
+    searching was added. Anything saved since is indexed as it's written, so
+    only the rows up to the newest there were on the first run are backfilled.
+    How far it has got is kept in the SearchIndexState table so it carries on
+    where it left off.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database.\n
+    batch_size: The most rows of each table to index.\n
+    Returns how many rows were indexed, which is 0 once everything has been.
+    """
+    cursor.execute("INSERT IGNORE INTO SearchIndexState (ID,endMessageRow,"+
+                   "endRevisionRow) SELECT 1,(SELECT COALESCE(MAX(ID),0) FROM "+
+                   "Messages),(SELECT COALESCE(MAX(ID),0) FROM "+
+                   "MessageRevisions)")
+    cursor.execute("SELECT lastMessageRow,lastRevisionRow,endMessageRow,"+
+                   "endRevisionRow FROM SearchIndexState WHERE ID=1 FOR UPDATE")
+    last_message, last_revision, end_message, end_revision = (
+        cursor.fetchall()[0])
+
+    cursor.execute("SELECT ID,messageID,message FROM Messages WHERE ID>%s AND "+
+                   "ID<=%s ORDER BY ID LIMIT %s",
+                   (last_message, end_message, batch_size))
+    messages = cursor.fetchall()
+
+    cursor.execute("SELECT ID,messageID,message FROM MessageRevisions WHERE "+
+                   "ID>%s AND ID<=%s ORDER BY ID LIMIT %s",
+                   (last_revision, end_revision, batch_size))
+    revisions = cursor.fetchall()
+
+    index_messages(cursor, [(row[1], row[2]) for row in messages+revisions])
+
+    if messages:
+        last_message = messages[-1][0]
+    if revisions:
+        last_revision = revisions[-1][0]
+
+    cursor.execute("UPDATE SearchIndexState SET lastMessageRow=%s,"+
+                   "lastRevisionRow=%s WHERE ID=1",
+                   (last_message, last_revision))
+
+    return len(messages) + len(revisions)
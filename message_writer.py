@@ -0,0 +1,669 @@
+import asyncio
+import logging
+import time
+
+from mysql.connector import DatabaseError, InterfaceError
+from mysql.connector.errors import PoolError
+
+from attachment_downloader import AttachmentDownloader
+from connection_pool import ConnectionPool
+from database_executor import DatabaseExecutor
+from guild_changes import count_change
+from guild_storage import GuildStorage
+from member_cache import MemberCache
+from message_search import index_messages
+from voice_sessions import VoiceSessions
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("message_writer")
+
+# Adds new members, or brings existing ones up to date.
+member_sql = ("INSERT INTO Members (memberID,memberName,discriminator,isBot,"+
+              "nickname) VALUES (%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE "+
+              "memberName=VALUES(memberName),"+
+              "discriminator=VALUES(discriminator),nickname=VALUES(nickname)")
+
+# Adds new messages. Messages without attachments leave the attachment columns
+# empty so every row can go in the same statement.
+message_sql = ("INSERT INTO Messages (messageID,channelID,authorID,dateCreated,"+
+               "message,hasAttachment,attachmentID,filename,qualifiedName,url) "+
+               "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
+
+# Records the attachments that still need downloading, in case the bot stops
+# before they are. Tables that haven't had their qualifiedName column dropped
+# yet get it left empty, as IGNORE lets it fall back to an empty string.
+pending_sql = ("INSERT IGNORE INTO PendingAttachments (attachmentID,url) "+
+               "VALUES (%s,%s)")
+
+# Moves each channel's checkpoint up to the newest message that was written,
+# never back.
+checkpoint_sql = ("INSERT INTO ChannelCheckpoints (channelID,lastMessageID) "+
+                  "VALUES (%s,%s) ON DUPLICATE KEY UPDATE "+
+                  "lastMessageID=GREATEST(lastMessageID,VALUES(lastMessageID))")
+
+# Opens voice sessions, with the IDs VoiceSessions gave them. A session that
+# was also left before the batch was written has its dateLeft filled in too.
+voice_sql = ("INSERT INTO VoiceActivity (ID,memberID,channelID,dateEntered,"+
+             "dateLeft) VALUES (%s,%s,%s,%s,%s)")
+
+# Closes the voice sessions opened in earlier batches.
+voice_left_sql = "UPDATE VoiceActivity SET dateLeft=%s WHERE ID=%s"
+
+class _GuildBatch:
+    """
+    The rows waiting to be written to a single guild's database.
+    """
+    def __init__(self):
+        self.members = {}
+        self.messages = []
+        self.message_ids = set()
+        self.attachments = []
+        self.checkpoints = {}
+        self.voice = {}
+        self.voice_left = {}
+        self.voice_dropped = False
+        self.dropped = {}
+        self.attempts = 0
+        self.started = time.monotonic()
+
+    def __len__(self) -> int:
+        return (len(self.members) + len(self.messages) + len(self.voice) +
+                len(self.voice_left))
+
+    def merge(self, newer: "_GuildBatch"):
+        """
+        Adds the rows of a batch queued after this one, keeping this batch's
+        rows first so they're still written in the order they were queued.\n
+        newer: The batch queued after this one.
+        """
+        self.members.update(newer.members)
+        self.messages.extend(newer.messages)
+        self.message_ids.update(newer.message_ids)
+        self.attachments.extend(newer.attachments)
+
+        for channel, message_id in newer.checkpoints.items():
+            if message_id > self.checkpoints.get(channel, 0):
+                self.checkpoints[channel] = message_id
+
+        # A session opened in this batch and left in the newer one is still
+        # written already closed.
+        self.voice.update(newer.voice)
+        for row_id, date_left in newer.voice_left.items():
+            if row_id in self.voice:
+                self.voice[row_id][4] = date_left
+            else:
+                self.voice_left[row_id] = date_left
+
+class MessageWriter:
+    """
+    Collects new messages and their authors for each guild and writes them to
+    the guild's database in batches, each batch in a single transaction along
+    with the checkpoint of the newest message in each channel and the voice
+    sessions opened and closed since the last batch. A guild's batch
+    is written once it holds batch_size rows or once it is batch_interval
+    seconds old, whichever comes first. Messages that are already saved are
+    skipped, so the same message can safely be queued more than once.\n
+    When every guild is kept in the shared tables, the batches of all the
+    guilds that are due are written together in one transaction instead, so
+    the writes of many quiet guilds share a single commit. A guild whose batch
+    fails is rolled back to its own savepoint, so the others are still
+    written.\n
+    A batch that can't be written at all, such as while the database is
+    down, is put back in front of anything queued since and tried again
+    after retry_delay seconds, twice as long each time. One that still can't
+    be written after retries attempts is dropped. A channel's checkpoint is
+    never moved past a message that was dropped, so it's fetched again from
+    the channel's history the next time the bot starts.\n
+    pool: The pool to borrow connections from.\n
+    database: The executor the writes run on.\n
+    member_cache: The cache that written members are recorded in.\n
+    downloader: The downloader that written attachments are handed to.\n
+    batch_size: The number of rows that causes a batch to be written.\n
+    batch_interval: The most seconds a row waits before being written.\n
+    storage: Where the guilds' tables are kept.\n
+    voice_sessions: The open voice sessions that the voice rows come from,
+    which are forgotten for a guild whose voice rows couldn't be written.\n
+    retries: How many more times a batch that couldn't be written is tried.\n
+    retry_delay: How many seconds to wait before trying a batch that couldn't
+    be written again the first time.
+    """
+    def __init__(self, pool: ConnectionPool, database: DatabaseExecutor,
+                 member_cache: MemberCache, downloader: AttachmentDownloader,
+                 batch_size: int, batch_interval: float,
+                 storage: GuildStorage = None,
+                 voice_sessions: VoiceSessions = None, retries: int = 5,
+                 retry_delay: float = 5):
+        self.pool = pool
+        self.database = database
+        self.member_cache = member_cache
+        self.downloader = downloader
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.storage = storage or GuildStorage(False)
+        self.voice_sessions = voice_sessions or VoiceSessions()
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._batches = {}
+        self._holds = {}
+        self._retry_at = 0
+        self._locks = {}
+        self._full = None
+        self._task = None
+
+    def add(self, guild_id: int, messages: list, member: tuple = None,
+            checkpoint: bool = True):
+        """
+        Queues rows to be written to a guild's database. Must be called from
+        the event loop.\n
+        guild_id: The ID of the guild the rows belong to.\n
+        messages: The Messages rows to add.\n
+        member: The Members row for the author, if it needs writing.\n
+        checkpoint: Whether the messages move their channels' checkpoints.
+        """
+        batch = self._batch(guild_id)
+
+        # Only the newest version of each member needs to be written.
+        if member is not None:
+            batch.members[member[0]] = member
+        batch.messages.extend(messages)
+
+        for row in messages:
+            batch.message_ids.add(row[0])
+
+            # Keep track of the newest message in each channel, short of any
+            # message in it that was dropped.
+            if (checkpoint and row[0] > batch.checkpoints.get(row[1], 0) and
+                    row[0] < self._holds.get(row[1], row[0] + 1)):
+                batch.checkpoints[row[1]] = row[0]
+
+            # Keep track of the attachments that need downloading.
+            if row[5]:
+                batch.attachments.append((row[6], row[9]))
+
+        if len(batch) >= self.batch_size:
+            self._full.set()
+
+    def add_voice(self, guild_id: int, closed: list, opened: list):
+        """
+        Queues voice sessions to be opened and closed in a guild's database.
+        Must be called from the event loop.\n
+        guild_id: The ID of the guild the sessions belong to.\n
+        closed: The (ID, dateLeft) of each session that was left.\n
+        opened: The (ID, memberID, channelID, dateEntered) of each new
+        session.
+        """
+        batch = self._batch(guild_id)
+
+        for row in opened:
+            batch.voice[row[0]] = list(row)+[None]
+
+        # A session opened in this same batch is written already closed.
+        for row_id, date_left in closed:
+            if row_id in batch.voice:
+                batch.voice[row_id][4] = date_left
+            else:
+                batch.voice_left[row_id] = date_left
+
+        if len(batch) >= self.batch_size:
+            self._full.set()
+
+    def _batch(self, guild_id: int) -> _GuildBatch:
+        """
+        Gets the batch that rows for a guild are being queued on.
+        """
+        # Start the writer the first time anything is queued.
+        if self._task is None or self._task.done():
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+        batch = self._batches.get(guild_id)
+        if batch is None:
+            batch = self._batches[guild_id] = _GuildBatch()
+
+        return batch
+
+    async def flush(self, guild_id: int = None):
+        """
+        Writes the queued rows straight away rather than waiting.\n
+        guild_id: The guild to write the rows for. Every guild is written if
+        this is None.
+        """
+        if guild_id is None:
+            guild_ids = list(self._batches)
+        else:
+            guild_ids = [guild_id]
+
+        if self.storage.shared:
+            await self._flush_guilds(guild_ids)
+            return
+
+        for guild in guild_ids:
+            await self._flush_guilds([guild])
+
+    async def ensure_written(self, guild_id: int, message_id: int):
+        """
+        Makes sure a message is in the database before it's changed. The
+        guild's batch is only written early if the message is queued on it,
+        and a batch of the guild that's already being written is waited on in
+        case the message is in that one.\n
+        guild_id: The ID of the guild the message was sent in.\n
+        message_id: The ID of the message.
+        """
+        batch = self._batches.get(guild_id)
+        if batch is not None and message_id in batch.message_ids:
+            await self.flush(guild_id)
+            return
+
+        lock = self._locks.get(guild_id)
+        if lock is not None and lock.locked():
+            async with lock:
+                pass
+
+    async def _flush_guilds(self, guild_ids: list):
+        """
+        Writes the queued rows of some guilds in a single transaction.\n
+        guild_ids: The guilds to write the rows for.
+        """
+        # Only one batch per guild is written at a time so they are always
+        # written in the order they were queued. The locks are always taken
+        # in the same order so two flushes can't wait on each other.
+        locks = []
+        for guild in sorted(set(guild_ids)):
+            lock = self._locks.get(guild)
+            if lock is None:
+                lock = self._locks[guild] = asyncio.Lock()
+            locks.append(lock)
+
+        for lock in locks:
+            await lock.acquire()
+
+        try:
+            batches = {}
+            for guild in guild_ids:
+                batch = self._batches.pop(guild, None)
+                if batch:
+                    batches[guild] = batch
+
+            written = []
+            if batches:
+                written = await self.database.run(self._write, batches)
+
+            # Nothing was written, so every batch is tried again later.
+            if written is None:
+                written = []
+                for guild, batch in batches.items():
+                    self._requeue(guild, batch)
+
+            # Now that the messages are saved, fetch their files.
+            for guild in written:
+                for attachment in batches[guild].attachments:
+                    self.downloader.enqueue(guild, attachment[0],
+                                            attachment[1])
+
+                for channel, message_id in batches[guild].dropped.items():
+                    self._hold(guild, channel, message_id)
+
+                if batches[guild].voice_dropped and (
+                        batches[guild].voice or batches[guild].voice_left):
+                    self._forget_voice(guild)
+
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _requeue(self, guild_id: int, batch: _GuildBatch):
+        """
+        Puts a batch that couldn't be written back in front of anything queued
+        for its guild since, or drops it once it has been tried too many
+        times.\n
+        guild_id: The ID of the guild.\n
+        batch: The rows that couldn't be written.
+        """
+        batch.attempts += 1
+
+        if batch.attempts > self.retries:
+            logger.critical(f"Dropped the batch of {len(batch.messages)} "+
+                            f"messages for server{guild_id} after "+
+                            f"{batch.attempts} attempts to write it.")
+
+            for row in batch.messages:
+                self._hold(guild_id, row[1], row[0])
+
+            if batch.voice or batch.voice_left:
+                self._forget_voice(guild_id)
+            return
+
+        newer = self._batches.get(guild_id)
+        if newer is not None:
+            batch.merge(newer)
+        self._batches[guild_id] = batch
+
+        delay = self.retry_delay * 2 ** (batch.attempts - 1)
+        self._retry_at = max(self._retry_at, time.monotonic() + delay)
+        logger.warning(f"Trying the batch for server{guild_id} again in "+
+                       f"{delay}s.")
+
+    def _hold(self, guild_id: int, channel_id: int, message_id: int):
+        """
+        Keeps a channel's checkpoint from moving past a message that was
+        dropped for the rest of the session.\n
+        guild_id: The ID of the guild.\n
+        channel_id: The ID of the channel the message was sent in.\n
+        message_id: The ID of the dropped message.
+        """
+        if message_id >= self._holds.get(channel_id, message_id + 1):
+            return
+        self._holds[channel_id] = message_id
+
+        # Anything queued since may already be past it.
+        batch = self._batches.get(guild_id)
+        if batch is not None and batch.checkpoints.get(channel_id,
+                                                       0) >= message_id:
+            batch.checkpoints[channel_id] = message_id - 1
+
+    def _forget_voice(self, guild_id: int):
+        """
+        Forgets a guild's voice sessions after some of its voice rows couldn't
+        be written, so they're loaded again from what is actually in the
+        database rather than handing out IDs that don't match it.\n
+        guild_id: The ID of the guild.
+        """
+        logger.warning(f"Reloading the voice sessions of server{guild_id} as "+
+                       "some of their changes couldn't be written.")
+        self.voice_sessions.forget(guild_id)
+
+        # Anything queued since was based on the sessions being forgotten.
+        batch = self._batches.get(guild_id)
+        if batch is not None:
+            batch.voice.clear()
+            batch.voice_left.clear()
+
+    async def close(self):
+        """
+        Stops the writer and writes anything still queued.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self.flush()
+
+    async def _run(self):
+        """
+        Writes batches as they fill up or grow old.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(),
+                                       timeout=self.batch_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            # Give the database a moment after a batch couldn't be written.
+            now = time.monotonic()
+            if now < self._retry_at:
+                continue
+
+            due = [guild for guild, batch in list(self._batches.items())
+                   if len(batch) >= self.batch_size or
+                   now - batch.started >= self.batch_interval]
+
+            # Every guild that's due is written at once when they share the
+            # same tables.
+            if self.storage.shared and due:
+                try:
+                    await self._flush_guilds(due)
+
+                # Keep the writer alive no matter what goes wrong.
+                except Exception as err:
+                    logger.critical(f"Could not write the batches for "+
+                                    f"{len(due)} guilds.\n{err}")
+                continue
+
+            for guild in due:
+                try:
+                    await self.flush(guild)
+
+                # Keep the writer alive no matter what goes wrong with a
+                # single guild.
+                except Exception as err:
+                    logger.critical(f"Could not write the batch for "+
+                                    f"server{guild}.\n{err}")
+
+    def _write(self, batches: dict) -> list:
+        """
+        Writes the batches of one or more guilds in one transaction. Runs on a
+        database worker. Each guild's batch is written under a savepoint of its
+        own, so a batch that fails is rolled back on its own without losing
+        the batches of the other guilds.\n
+        batches: The rows to write, by the ID of the guild they belong to.\n
+        Returns the IDs of the guilds whose batches were written, or None if
+        none of them could be.
+        """
+        messages = sum(len(batch.messages) for batch in batches.values())
+        databases = ", ".join(f"server{guild_id}" for guild_id in batches)
+
+        try:
+            mydb = self.pool.get_connection()
+
+        except (PoolError, DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not get a connection to write "+
+                            f"{messages} messages to {databases}.\n{err}")
+            return None
+
+        cursor = mydb.cursor()
+
+        try:
+            written = []
+            for guild_id, batch in batches.items():
+                if mydb.database != f"server{guild_id}":
+                    self.storage.use(cursor, guild_id)
+
+                self._drop_saved(cursor, batch)
+
+                prepared = self.storage.prepared(mydb, guild_id)
+                cursor.execute("SAVEPOINT guild_batch")
+
+                try:
+                    self._write_batch(prepared, batch)
+
+                # A single bad row fails the whole batch, so the batch is
+                # written again a row at a time to only lose the rows that
+                # actually fail.
+                except DatabaseError as err:
+                    cursor.execute("ROLLBACK TO SAVEPOINT guild_batch")
+                    logger.warning(f"Could not write the batch for "+
+                                   f"server{guild_id} in one go. Writing it a "+
+                                   f"row at a time.\n{err}")
+                    self._write_rows(cursor, prepared, guild_id, batch)
+
+                if batch.messages:
+                    count_change(cursor, guild_id)
+
+                written.append(guild_id)
+
+            mydb.commit()
+
+            # Only remember the members once they're actually written.
+            for guild_id in written:
+                for member in batches[guild_id].members.values():
+                    self.member_cache.put(guild_id, member)
+
+            logger.debug(f"Wrote the batches of {len(written)} of "+
+                         f"{len(batches)} guilds to {databases}.")
+            return written
+
+        except (DatabaseError, InterfaceError) as err:
+            # Returning the connection to the pool rolls the batches back.
+            logger.critical(f"Could not write {messages} messages to "+
+                            f"{databases}.\n{err}")
+            return None
+
+        finally:
+            cursor.close()
+            mydb.close()
+
+    def _drop_saved(self, cursor, batch: _GuildBatch):
+        """
+        Takes the messages that are already saved out of a batch, along with
+        any queued twice, so a message fetched from a channel's history that
+        was also sent live, or fetched again after the bot stopped before its
+        checkpoint moved, is only saved and downloaded once. Nothing else adds
+        messages and only one batch of a guild is written at a time, so none
+        can be saved between the check and the insert. Runs on a database
+        worker.\n
+        cursor: The cursor for the MySQL connection, already using the guild's
+        database.\n
+        batch: The rows to write.
+        """
+        if not batch.messages:
+            return
+
+        saved = set()
+        message_ids = sorted(batch.message_ids)
+        for start in range(0, len(message_ids), 1000):
+            chunk = message_ids[start:start + 1000]
+            cursor.execute("SELECT DISTINCT messageID FROM Messages WHERE "+
+                           "messageID IN ("+",".join(["%s"] * len(chunk))+")",
+                           chunk)
+            saved.update(row[0] for row in cursor.fetchall())
+
+        # A message has a row for each of its attachments, so a row is only a
+        # repeat if both match.
+        rows = []
+        queued = set()
+        for row in batch.messages:
+            if row[0] not in saved and (row[0], row[6]) not in queued:
+                queued.add((row[0], row[6]))
+                rows.append(row)
+
+        if len(rows) < len(batch.messages):
+            logger.debug(f"Skipping {len(batch.messages) - len(rows)} "+
+                         "message rows that are already saved.")
+
+        batch.messages = rows
+        batch.attachments = [(row[6], row[9]) for row in rows if row[5]]
+
+    def _write_batch(self, prepared, batch: _GuildBatch):
+        """
+        Writes a single guild's batch. Runs on a database worker.\n
+        prepared: The prepared cursor of the guild, already using its
+        database. Every batch runs the same few statements, so they're
+        prepared once per connection and their rows sent in chunks.\n
+        batch: The rows to write.
+        """
+        # The members go first as the messages refer to them.
+        if batch.members:
+            prepared.executemany(member_sql, list(batch.members.values()))
+
+        if batch.messages:
+            prepared.executemany(message_sql, batch.messages)
+
+            # Index the words of the messages so they can be searched for.
+            index_messages(prepared, [(row[0], row[4])
+                                      for row in batch.messages])
+
+        if batch.attachments:
+            prepared.executemany(pending_sql, batch.attachments)
+
+        # The checkpoints are written with the messages so they can never get
+        # ahead of what has actually been saved.
+        if batch.checkpoints:
+            prepared.executemany(checkpoint_sql,
+                                 list(batch.checkpoints.items()))
+
+        # New sessions go in before the earlier ones are closed, and each is
+        # closed by its primary key.
+        if batch.voice:
+            prepared.executemany(voice_sql, list(batch.voice.values()))
+
+        if batch.voice_left:
+            prepared.executemany(voice_left_sql,
+                                 [(date_left, row_id) for row_id, date_left in
+                                  batch.voice_left.items()])
+
+    def _write_rows(self, cursor, prepared, guild_id: int, batch: _GuildBatch):
+        """
+        Writes a guild's batch a row at a time, each under a savepoint of its
+        own, after it failed to be written all at once. Any row that still
+        fails is dropped and logged, and the batch is left holding only the
+        members and attachments that were written. Runs on a database
+        worker.\n
+        cursor: The cursor for the MySQL connection.\n
+        prepared: The prepared cursor of the guild, already using its
+        database.\n
+        guild_id: The ID of the guild.\n
+        batch: The rows to write.
+        """
+        def attempt(write, what: str) -> bool:
+            cursor.execute("SAVEPOINT batch_row")
+
+            try:
+                write()
+                return True
+
+            except DatabaseError as err:
+                cursor.execute("ROLLBACK TO SAVEPOINT batch_row")
+                logger.critical(f"Dropped {what} from the batch for "+
+                                f"server{guild_id}.\n{err}")
+                return False
+
+        batch.members = {member_id: member for member_id, member in
+                         batch.members.items() if
+                         attempt(lambda member=member:
+                                 prepared.execute(member_sql, member),
+                                 f"member {member_id}")}
+
+        # A message with several attachments has a row for each, so they're
+        # written or dropped together, along with its pending attachments.
+        messages = {}
+        for row in batch.messages:
+            messages.setdefault(row[0], []).append(row)
+
+        attachments = set()
+        for message_id, rows in messages.items():
+            def write(rows=rows):
+                prepared.executemany(message_sql, rows)
+                index_messages(prepared, [(row[0], row[4]) for row in rows])
+
+                pending = [(row[6], row[9]) for row in rows if row[5]]
+                if pending:
+                    prepared.executemany(pending_sql, pending)
+
+            if attempt(write, f"message {message_id}"):
+                attachments.update(row[6] for row in rows if row[5])
+            elif message_id < batch.dropped.get(rows[0][1], message_id + 1):
+                batch.dropped[rows[0][1]] = message_id
+
+        batch.attachments = [attachment for attachment in batch.attachments
+                             if attachment[0] in attachments]
+
+        # The checkpoints stop short of the dropped messages, so they're
+        # fetched again from the channels' history the next time the bot
+        # starts.
+        for channel, message_id in batch.dropped.items():
+            if batch.checkpoints.get(channel, 0) >= message_id:
+                batch.checkpoints[channel] = message_id - 1
+
+        if batch.checkpoints:
+            attempt(lambda: prepared.executemany(
+                        checkpoint_sql, list(batch.checkpoints.items())),
+                    "the channel checkpoints")
+
+        for row_id, row in batch.voice.items():
+            if not attempt(lambda row=row: prepared.execute(voice_sql, row),
+                           f"voice session {row_id}"):
+                batch.voice_dropped = True
+
+        for row_id, date_left in batch.voice_left.items():
+            if not attempt(lambda row_id=row_id, date_left=date_left:
+                           prepared.execute(voice_left_sql,
+                                            (date_left, row_id)),
+                           f"the end of voice session {row_id}"):
+                batch.voice_dropped = True
@@ -0,0 +1,162 @@
+import logging
+import re
+from collections import OrderedDict
+
+from mysql.connector import Error
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("prepared_statements")
+
+# Splits an INSERT into what comes before its row of values, the row, and what
+# comes after it.
+insert_pattern = re.compile(r"^(\s*INSERT\s.*?\bVALUES\s*)(\([^)]*\))(.*)$",
+                            re.IGNORECASE | re.DOTALL)
+
+# The most rows a single prepared INSERT adds. Fewer rows than this are added
+# with the statements for the powers of two below it, so each INSERT only
+# ever needs a handful of statements prepared however many rows there are.
+insert_chunk = 64
+
+class StatementRegistry:
+    """
+    The server-side prepared statements of a single connection, kept for as
+    long as the connection is open so the same statement is only ever parsed
+    by MySQL once per connection rather than on every event. Statements are
+    kept for each database, as the tables in a statement are looked up in the
+    database that was in use when it was prepared. Once more than size
+    statements are kept, the one used least recently is deallocated.\n
+    connection: The MySQL connection the statements are prepared on.\n
+    size: The most statements to keep prepared.
+    """
+    def __init__(self, connection, size: int):
+        self.connection = connection
+        self.size = size
+
+        self._cursors = OrderedDict()
+
+    def cursor(self, database: str) -> "PreparedCursor":
+        """
+        Gets a cursor that runs its statements through the registry.\n
+        database: The database the connection is using, which the statements
+        are prepared against.
+        """
+        return PreparedCursor(self, database)
+
+    def statement(self, database: str, sql: str):
+        """
+        Gets the prepared cursor for a statement, preparing it if it isn't
+        already.\n
+        database: The database the connection is using.\n
+        sql: The statement, with %s for each of its values.
+        """
+        key = (database, sql)
+
+        cursor = self._cursors.get(key)
+        if cursor is not None:
+            self._cursors.move_to_end(key)
+            return cursor
+
+        # The statement is actually prepared when it's first executed, and
+        # only prepared again if the cursor is given a different one.
+        cursor = self.connection.cursor(prepared=True)
+        self._cursors[key] = cursor
+
+        while len(self._cursors) > self.size:
+            _, oldest = self._cursors.popitem(last=False)
+            self._close(oldest)
+
+        return cursor
+
+    def discard(self, database: str, sql: str):
+        """
+        Deallocates a statement that failed, so it's prepared from scratch the
+        next time it's used.\n
+        database: The database the connection is using.\n
+        sql: The statement.
+        """
+        cursor = self._cursors.pop((database, sql), None)
+        if cursor is not None:
+            self._close(cursor)
+
+    def clear(self):
+        """
+        Forgets every statement, such as when the connection is closed.
+        """
+        self._cursors.clear()
+
+    def _close(self, cursor):
+        """
+        Deallocates a statement on the server, ignoring any errors from the
+        connection already being gone.
+        """
+        try:
+            cursor.close()
+
+        except Error as err:
+            logger.debug(f"Could not deallocate a prepared statement.\n{err}")
+
+class PreparedCursor:
+    """
+    Runs statements against a database through a StatementRegistry. It's used
+    like a regular cursor for statements that don't return any rows, so it can
+    be handed to anything that only calls execute() and executemany(). It
+    doesn't need closing as the statements belong to the connection.\n
+    registry: The registry of the connection.\n
+    database: The database the connection is using.
+    """
+    def __init__(self, registry: StatementRegistry, database: str):
+        self.registry = registry
+        self.database = database
+        self.rowcount = 0
+
+    def execute(self, sql: str, params: tuple = ()):
+        """
+        Runs a statement once.\n
+        sql: The statement, with %s for each of its values.\n
+        params: The values.
+        """
+        self.rowcount = self._execute(sql, params)
+
+    def executemany(self, sql: str, rows: list):
+        """
+        Runs a statement for each row of values. An INSERT adds its rows
+        insert_chunk at a time, the way a text cursor rewrites it into a single
+        statement with many rows.\n
+        sql: The statement, with %s for each of its values.\n
+        rows: The values for each run of it.
+        """
+        rows = list(rows)
+        self.rowcount = 0
+
+        match = insert_pattern.match(sql)
+        if match is None:
+            for params in rows:
+                self.rowcount += self._execute(sql, params)
+            return
+
+        start = 0
+        while start < len(rows):
+            count = insert_chunk
+            while count > len(rows) - start:
+                count //= 2
+
+            chunk = rows[start:start + count]
+            self.rowcount += self._execute(
+                match[1]+",".join([match[2]] * count)+match[3],
+                [value for params in chunk for value in params])
+            start += count
+
+    def _execute(self, sql: str, params) -> int:
+        """
+        Runs a prepared statement and returns how many rows it changed.
+        """
+        cursor = self.registry.statement(self.database, sql)
+
+        try:
+            cursor.execute(sql, tuple(params))
+
+        except Error:
+            self.registry.discard(self.database, sql)
+            raise
+
+        return cursor.rowcount
@@ -0,0 +1,47 @@
+# What reconcile() found out about a fetched message.
+NEW = 1
+EDITED = 2
+UNCHANGED = 3
+
+class MessageIndex:
+    """
+    An index of the messages already in a guild's database, used to work out
+    which of the messages fetched from the guild are new or edited, and which
+    messages in the database have since been deleted. Each lookup is a single
+    dictionary access, so comparing a whole guild is linear in its size.\n
+    records: The (messageID, message) rows from the database, oldest first. If
+    a message has more than one row the newest content wins.
+    """
+    def __init__(self, records):
+        # Only a hash of the content is kept so the index stays small no matter
+        # how long the messages are.
+        self._contents = {}
+        for message_id, content in records:
+            self._contents[message_id] = hash(content)
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def reconcile(self, message_id: int, content: str) -> int:
+        """
+        Compares a fetched message against the database and marks it as seen.
+        Returns NEW, EDITED or UNCHANGED.\n
+        message_id: The ID of the fetched message.\n
+        content: The current content of the fetched message.
+        """
+        stored = self._contents.pop(message_id, None)
+
+        if stored is None:
+            return NEW
+
+        elif stored != hash(content):
+            return EDITED
+
+        return UNCHANGED
+
+    def unseen(self) -> list:
+        """
+        Gets the IDs of the messages in the database that were never passed to
+        reconcile(), meaning they have been deleted from the guild.
+        """
+        return list(self._contents)
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import re
+
+from mysql.connector import DatabaseError, InterfaceError, errorcode
+from mysql.connector.errors import PoolError
+
+from connection_pool import ConnectionPool
+from database_executor import DatabaseExecutor
+from guild_storage import GuildStorage
+
+# Log through the handlers that sql_interface has already set up.
+logger = logging.getLogger("sql_interface").getChild("schema_migrations")
+
+# Errors that mean a statement's change is already there, which happens when a
+# migration was cut off part way through and is being run again.
+already_applied = (errorcode.ER_DUP_KEYNAME, errorcode.ER_DUP_FIELDNAME,
+                   errorcode.ER_CANT_DROP_FIELD_OR_KEY,
+                   errorcode.ER_TABLE_EXISTS_ERROR)
+
+class Migration:
+    """
+    A single change to the guild databases, read from a file in the migrations
+    directory named like "0001_description.sql".\n
+    version: The number the file name starts with. Migrations run in order of
+    this.\n
+    name: The rest of the file name.\n
+    statements: The statements in the file, in order.
+    """
+    def __init__(self, version: int, name: str, statements: list):
+        self.version = version
+        self.name = name
+        self.statements = statements
+
+def load_migrations(path: str) -> list:
+    """
+    Reads every migration in a directory, sorted by version.\n
+    path: The directory holding the migration files.
+    """
+    migrations = []
+
+    for file_name in os.listdir(path):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", file_name)
+        if not match:
+            continue
+
+        with open(os.path.join(path, file_name), 'rt') as sql_comm:
+            # Drop the comment lines so the statements can be split apart.
+            command = "\n".join(line for line in sql_comm.read().splitlines()
+                                if not line.lstrip().startswith("--"))
+
+        statements = [statement.strip() for statement in command.split(";")
+                      if statement.strip()]
+        migrations.append(Migration(int(match[1]), match[2], statements))
+
+    migrations.sort(key=lambda migration: migration.version)
+
+    return migrations
+
+class SchemaMigrator:
+    """
+    Keeps every guild database up to date with the migrations in
+    sql/migrations. Each guild database records the migrations it has had in
+    its SchemaVersion table, so each one only ever runs once per database.\n
+    Migrations are written as online DDL (ALGORITHM=INPLACE, LOCK=NONE) so the
+    tables can still be written to while they run. The statements are also
+    only allowed to wait lock_wait_timeout seconds for a table's metadata lock,
+    as a DDL statement waiting on that lock holds up every write queued behind
+    it. A guild that can't get the lock is tried again later.\n
+    pool: The pool to borrow connections from.\n
+    database: The executor the database work runs on.\n
+    path: The directory holding the migration files.\n
+    lock_wait_timeout: How many seconds a migration waits for a table's
+    metadata lock before giving up.\n
+    retry_delay: How many seconds to wait before trying the guilds that
+    couldn't get a lock again.\n
+    retries: How many more times a guild that couldn't get a lock is tried.\n
+    storage: Where the guilds' tables are kept. When they're all in the shared
+    tables, only those are migrated.
+    """
+    def __init__(self, pool: ConnectionPool, database: DatabaseExecutor,
+                 path: str = "sql/migrations", lock_wait_timeout: int = 5,
+                 retry_delay: float = 60, retries: int = 5,
+                 storage: GuildStorage = None):
+        self.pool = pool
+        self.database = database
+        self.storage = storage or GuildStorage(False)
+        self.migrations = load_migrations(path)
+        self.lock_wait_timeout = lock_wait_timeout
+        self.retry_delay = retry_delay
+        self.retries = retries
+
+    @property
+    def latest(self) -> int:
+        """
+        The version a fully up to date guild database is at.
+        """
+        return self.migrations[-1].version if self.migrations else 0
+
+    def migrate(self, guildID: str, cursor) -> bool:
+        """
+        Runs any migrations a guild database hasn't had yet.\n
+        guildID: The ID for the guild in the "server + ID" format.\n
+        cursor: The cursor for the MySQL connection, already using the guild's
+        database.\n
+        Returns False if a table's lock couldn't be had, meaning it should be
+        tried again later.
+        """
+        cursor.execute("CREATE TABLE IF NOT EXISTS SchemaVersion (version int "+
+                       "NOT NULL, name varchar(255) NOT NULL, appliedOn "+
+                       "datetime NOT NULL DEFAULT CURRENT_TIMESTAMP, "+
+                       "PRIMARY KEY (version))")
+        cursor.execute("SELECT version FROM SchemaVersion")
+        applied = {row[0] for row in cursor.fetchall()}
+
+        pending = [migration for migration in self.migrations
+                   if migration.version not in applied]
+        if not pending:
+            return True
+
+        cursor.execute("SET SESSION lock_wait_timeout=%s",
+                       (self.lock_wait_timeout,))
+
+        try:
+            for migration in pending:
+                logger.info(f"Migrating {guildID} to version "+
+                            f"{migration.version} ({migration.name}).")
+
+                for statement in migration.statements:
+                    try:
+                        cursor.execute(statement)
+
+                    except DatabaseError as err:
+                        if err.errno == errorcode.ER_LOCK_WAIT_TIMEOUT:
+                            logger.warning(f"{guildID} is busy. Migrating it "+
+                                           "later.")
+                            return False
+
+                        elif err.errno not in already_applied:
+                            raise
+
+                # Schema changes commit on their own, so the version is
+                # recorded once they've all gone through.
+                cursor.execute("INSERT INTO SchemaVersion (version,name) "+
+                               "VALUES (%s,%s)",
+                               (migration.version, migration.name))
+                cursor.execute("COMMIT")
+
+        finally:
+            # Don't leave the short timeout on a connection going back to the
+            # pool.
+            cursor.execute("SET SESSION lock_wait_timeout=DEFAULT")
+
+        return True
+
+    def upgrade(self, guildID: str) -> bool:
+        """
+        Borrows a connection and migrates a single database. Runs on a
+        database worker.\n
+        guildID: The database, which is the ID for the guild in the
+        "server + ID" format unless the storage is shared.\n
+        Returns False if it should be tried again later.
+        """
+        try:
+            mydb = self.pool.get_connection()
+
+        except (PoolError, DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not get a connection to migrate {guildID}."+
+                            f"\n{err}")
+            return False
+
+        cursor = mydb.cursor()
+
+        try:
+            cursor.execute(f"USE {guildID}")
+
+        # A database that doesn't exist yet is migrated when it's built.
+        except DatabaseError:
+            cursor.close()
+            mydb.close()
+            return True
+
+        try:
+            return self.migrate(guildID, cursor)
+
+        except (DatabaseError, InterfaceError) as err:
+            logger.critical(f"Could not migrate {guildID}.\n{err}")
+            return True
+
+        finally:
+            cursor.close()
+            mydb.close()
+
+    async def upgrade_all(self, guild_ids: list):
+        """
+        Migrates every guild's database in the background, one at a time so
+        only one table is ever being rebuilt at once.\n
+        guild_ids: The IDs of the guilds to migrate.
+        """
+        remaining = self.storage.databases(guild_ids)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logger.info(f"Retrying the migration of {len(remaining)} "+
+                            f"busy guild databases in {self.retry_delay}s.")
+                await asyncio.sleep(self.retry_delay)
+
+            busy = []
+            for guildID in remaining:
+                if not await self.database.run(self.upgrade, guildID):
+                    busy.append(guildID)
+
+            remaining = busy
+            if not remaining:
+                logger.info("Every guild database is at schema version "+
+                            f"{self.latest}.")
+                return
+
+        logger.error(f"Could not migrate {len(remaining)} guild databases. "+
+                     "They will be tried again on the next start.")
@@ -0,0 +1,45 @@
+import calendar
+from datetime import datetime, timedelta
+
+# Discord IDs count milliseconds from the start of 2015, in the bits above the
+# lowest 22.
+discord_epoch = 1420070400000
+timestamp_shift = 22
+
+def snowflake_time(snowflake: int) -> datetime:
+    """
+    Gets when something with a Discord ID, such as a message, was created.\n
+    snowflake: The ID.\n
+    Returns the time in UTC, without a timezone like the rest of the database.
+    """
+    milliseconds = (snowflake >> timestamp_shift) + discord_epoch
+
+    return datetime(1970, 1, 1) + timedelta(milliseconds=milliseconds)
+
+def _milliseconds(date: datetime) -> int:
+    """
+    Gets how many milliseconds a UTC time is after the Discord epoch, to the
+    second.
+    """
+    milliseconds = calendar.timegm(date.utctimetuple()) * 1000
+
+    return max(milliseconds - discord_epoch, 0)
+
+def first_snowflake(date: datetime) -> int:
+    """
+    Gets the lowest ID anything created at or after a time can have, so
+    "created at or after" can be looked up as a range of IDs.\n
+    date: The time in UTC. Only the whole seconds are used, as that's what the
+    database keeps.
+    """
+    return _milliseconds(date) << timestamp_shift
+
+def last_snowflake(date: datetime) -> int:
+    """
+    Gets the highest ID anything created at or before a time can have, so
+    "created at or before" can be looked up as a range of IDs. Everything
+    created during the same second counts.\n
+    date: The time in UTC. Only the whole seconds are used, as that's what the
+    database keeps.
+    """
+    return ((_milliseconds(date) + 1000) << timestamp_shift) - 1
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS guildList.AttachmentBlobs (
+	contentHash char(64) NOT NULL,
+	size bigint NOT NULL,
+	refCount int NOT NULL DEFAULT 1,
+	firstSeen datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY (contentHash)
+);
\ No newline at end of file
@@ -1,4 +1,4 @@
-CREATE TABLE Channels (
+CREATE TABLE IF NOT EXISTS Channels (
 	channelID bigint NOT NULL,
 	channelName varchar(255) NOT NULL,
 	channelTopic varchar(1000),
@@ -9,7 +9,7 @@ CREATE TABLE Channels (
 	categoryID bigint,
 	PRIMARY KEY (channelID)
 );
-CREATE TABLE Members (
+CREATE TABLE IF NOT EXISTS Members (
 	memberID bigint NOT NULL,
 	memberName varchar(255) NOT NULL,
 	discriminator bigint NOT NULL,
@@ -17,7 +17,7 @@ CREATE TABLE Members (
 	nickname varchar(255),
 	PRIMARY KEY (memberID)
 );
-CREATE TABLE VoiceActivity (
+CREATE TABLE IF NOT EXISTS VoiceActivity (
 	ID int NOT NULL AUTO_INCREMENT,
 	memberID bigint NOT NULL,
 	channelID bigint NOT NULL,
@@ -27,7 +27,7 @@ CREATE TABLE VoiceActivity (
 	FOREIGN KEY (memberID) REFERENCES Members(memberID),
 	FOREIGN KEY (channelID) REFERENCES Channels(channelID)
 );
-CREATE TABLE Messages (
+CREATE TABLE IF NOT EXISTS Messages (
 	ID int NOT NULL AUTO_INCREMENT,
 	messageID bigint NOT NULL,
 	channelID bigint NOT NULL,
@@ -46,4 +46,41 @@ CREATE TABLE Messages (
 	PRIMARY KEY (ID),
 	FOREIGN KEY (channelID) REFERENCES Channels(channelID),
 	FOREIGN KEY (authorID) REFERENCES Members(memberID)
-);
\ No newline at end of file
+);
+CREATE TABLE IF NOT EXISTS ChannelCheckpoints (
+	channelID bigint NOT NULL,
+	lastMessageID bigint NOT NULL,
+	PRIMARY KEY (channelID)
+);
+CREATE TABLE IF NOT EXISTS PendingAttachments (
+	attachmentID bigint NOT NULL,
+	url varchar(1000) NOT NULL,
+	attempts int NOT NULL DEFAULT 0,
+	PRIMARY KEY (attachmentID)
+);
+CREATE TABLE IF NOT EXISTS MessageRevisions (
+	ID int NOT NULL AUTO_INCREMENT,
+	messageID bigint NOT NULL,
+	dateEdited timestamp NOT NULL,
+	message varchar(10000),
+	PRIMARY KEY (ID),
+	KEY messageRevision (messageID, ID)
+);
+CREATE TABLE IF NOT EXISTS MessageTerms (
+	term varchar(64) NOT NULL,
+	messageID bigint NOT NULL,
+	PRIMARY KEY (term, messageID)
+);
+CREATE TABLE IF NOT EXISTS SearchIndexState (
+	ID int NOT NULL,
+	lastMessageRow int NOT NULL DEFAULT 0,
+	lastRevisionRow int NOT NULL DEFAULT 0,
+	endMessageRow int NOT NULL DEFAULT 0,
+	endRevisionRow int NOT NULL DEFAULT 0,
+	PRIMARY KEY (ID)
+);
+CREATE TABLE IF NOT EXISTS ArchivedDeletions (
+	messageID bigint NOT NULL,
+	dateDeleted timestamp NOT NULL,
+	PRIMARY KEY (messageID)
+);
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS guildList.GuildChanges (
+	guildID bigint NOT NULL,
+	changes bigint NOT NULL DEFAULT 0,
+	PRIMARY KEY (guildID)
+);
@@ -0,0 +1,12 @@
+-- Indexes for the columns the bot looks messages, members and voice activity
+-- up by. Each index is added on its own so one that is already there doesn't
+-- stop the rest, and all of them are built online so the tables can still be
+-- written to meanwhile.
+ALTER TABLE Messages ADD INDEX messageID (messageID), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages ADD INDEX authorDate (authorID, dateCreated), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages ADD INDEX dateCreated (dateCreated), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages ADD INDEX channelMessage (channelID, messageID), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages ADD INDEX attachmentID (attachmentID), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Members ADD INDEX memberName (memberName, discriminator), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE VoiceActivity ADD INDEX memberLeft (memberID, dateLeft), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE VoiceActivity ADD INDEX dateLeft (dateLeft), ALGORITHM=INPLACE, LOCK=NONE;
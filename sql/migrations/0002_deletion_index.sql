@@ -0,0 +1,3 @@
+-- Lets the latest deletion in a guild be found straight from an index, which
+-- is part of the watermark the export cache checks against.
+ALTER TABLE Messages ADD INDEX dateDeleted (dateDeleted), ALGORITHM=INPLACE, LOCK=NONE;
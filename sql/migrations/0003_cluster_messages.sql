@@ -0,0 +1,10 @@
+-- Stores messages in order of their messageID rather than the row ID. Message
+-- IDs start with when the message was sent, so looking messages up by date is
+-- a range of the primary key and the dateCreated index is no longer needed.
+-- The row ID keeps its own index as it's still counted up by AUTO_INCREMENT.
+-- The messageID index is dropped too as the primary key starts with it, and
+-- authorDate as the authorID index now keeps each author's messages in order.
+ALTER TABLE Messages DROP PRIMARY KEY, ADD PRIMARY KEY (messageID, ID), ADD INDEX rowID (ID), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages DROP INDEX dateCreated, ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages DROP INDEX messageID, ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE Messages DROP INDEX authorDate, ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,9 @@
+-- Partitioned tables can't have foreign keys, so they're dropped from Messages
+-- before it's split into monthly partitions. The indexes they used are kept.
+-- The keys are looked up by name rather than assuming the names MySQL gives
+-- them, since a database could have been created with them named otherwise.
+-- Once they're gone there's nothing to drop and the statement does nothing.
+SET @drop_keys = (SELECT IFNULL(CONCAT('ALTER TABLE Messages ', GROUP_CONCAT('DROP FOREIGN KEY `', CONSTRAINT_NAME, '`' SEPARATOR ', '), ', ALGORITHM=INPLACE, LOCK=NONE'), 'DO 0') FROM information_schema.REFERENTIAL_CONSTRAINTS WHERE CONSTRAINT_SCHEMA=DATABASE() AND TABLE_NAME='Messages');
+PREPARE drop_keys FROM @drop_keys;
+EXECUTE drop_keys;
+DEALLOCATE PREPARE drop_keys;
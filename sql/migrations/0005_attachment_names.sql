@@ -0,0 +1,6 @@
+-- An attachment's qualifiedName only ever names its file in the attachment
+-- store. Older versions set it to a name of their own before the file was
+-- saved, so any name outside the store is cleared until the file is moved into
+-- it. Pending attachments don't have a file yet, so they no longer get a name.
+UPDATE Messages SET qualifiedName=NULL WHERE qualifiedName IS NOT NULL AND LEFT(qualifiedName, 6)<>'blobs/';
+ALTER TABLE PendingAttachments DROP COLUMN qualifiedName, ALGORITHM=INPLACE, LOCK=NONE;
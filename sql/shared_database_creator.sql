@@ -0,0 +1,120 @@
+CREATE TABLE IF NOT EXISTS Channels (
+	guildID bigint NOT NULL,
+	channelID bigint NOT NULL,
+	channelName varchar(255) NOT NULL,
+	channelTopic varchar(1000),
+	channelType varchar(255) NOT NULL,
+	isNSFW boolean NOT NULL DEFAULT 0,
+	isNews boolean NOT NULL DEFAULT 0,
+	isDeleted boolean NOT NULL DEFAULT 0,
+	categoryID bigint,
+	PRIMARY KEY (guildID, channelID)
+);
+CREATE TABLE IF NOT EXISTS Members (
+	guildID bigint NOT NULL,
+	memberID bigint NOT NULL,
+	memberName varchar(255) NOT NULL,
+	discriminator bigint NOT NULL,
+	isBot boolean NOT NULL DEFAULT 0,
+	nickname varchar(255),
+	PRIMARY KEY (guildID, memberID),
+	KEY memberName (guildID, memberName, discriminator)
+);
+CREATE TABLE IF NOT EXISTS VoiceActivity (
+	guildID bigint NOT NULL,
+	ID bigint NOT NULL AUTO_INCREMENT,
+	memberID bigint NOT NULL,
+	channelID bigint NOT NULL,
+	dateEntered timestamp NOT NULL,
+	dateLeft timestamp,
+	PRIMARY KEY (guildID, ID),
+	KEY rowID (ID),
+	KEY memberLeft (guildID, memberID, dateLeft),
+	KEY dateLeft (guildID, dateLeft)
+);
+CREATE TABLE IF NOT EXISTS Messages (
+	guildID bigint NOT NULL,
+	ID bigint NOT NULL AUTO_INCREMENT,
+	messageID bigint NOT NULL,
+	channelID bigint NOT NULL,
+	authorID bigint NOT NULL,
+	dateCreated timestamp NOT NULL,
+	isEdited boolean NOT NULL DEFAULT 0,
+	dateEdited timestamp,
+	isDeleted boolean NOT NULL DEFAULT 0,
+	dateDeleted timestamp,
+	message varchar(10000),
+	hasAttachment boolean NOT NULL DEFAULT 0,
+	attachmentID bigint,
+	filename varchar(255),
+	qualifiedName varchar(255),
+	url varchar(255),
+	PRIMARY KEY (guildID, messageID, ID),
+	KEY rowID (ID),
+	KEY guildRow (guildID, ID),
+	KEY authorID (guildID, authorID),
+	KEY channelMessage (guildID, channelID, messageID),
+	KEY attachmentID (guildID, attachmentID),
+	KEY dateDeleted (guildID, dateDeleted)
+);
+CREATE TABLE IF NOT EXISTS ChannelCheckpoints (
+	guildID bigint NOT NULL,
+	channelID bigint NOT NULL,
+	lastMessageID bigint NOT NULL,
+	PRIMARY KEY (guildID, channelID)
+);
+CREATE TABLE IF NOT EXISTS PendingAttachments (
+	guildID bigint NOT NULL,
+	attachmentID bigint NOT NULL,
+	url varchar(1000) NOT NULL,
+	attempts int NOT NULL DEFAULT 0,
+	PRIMARY KEY (guildID, attachmentID)
+);
+CREATE TABLE IF NOT EXISTS MessageRevisions (
+	guildID bigint NOT NULL,
+	ID bigint NOT NULL AUTO_INCREMENT,
+	messageID bigint NOT NULL,
+	dateEdited timestamp NOT NULL,
+	message varchar(10000),
+	PRIMARY KEY (guildID, ID),
+	KEY rowID (ID),
+	KEY messageRevision (guildID, messageID, ID)
+);
+CREATE TABLE IF NOT EXISTS MessageTerms (
+	guildID bigint NOT NULL,
+	term varchar(64) NOT NULL,
+	messageID bigint NOT NULL,
+	PRIMARY KEY (guildID, term, messageID)
+);
+CREATE TABLE IF NOT EXISTS SearchIndexState (
+	guildID bigint NOT NULL,
+	ID int NOT NULL,
+	lastMessageRow bigint NOT NULL DEFAULT 0,
+	lastRevisionRow bigint NOT NULL DEFAULT 0,
+	endMessageRow bigint NOT NULL DEFAULT 0,
+	endRevisionRow bigint NOT NULL DEFAULT 0,
+	PRIMARY KEY (guildID, ID)
+);
+CREATE TABLE IF NOT EXISTS ArchivedDeletions (
+	guildID bigint NOT NULL,
+	messageID bigint NOT NULL,
+	dateDeleted timestamp NOT NULL,
+	PRIMARY KEY (guildID, messageID)
+);
+DROP TRIGGER IF EXISTS ChannelsGuild;
+DROP TRIGGER IF EXISTS MembersGuild;
+DROP TRIGGER IF EXISTS VoiceActivityGuild;
+DROP TRIGGER IF EXISTS MessagesGuild;
+DROP TRIGGER IF EXISTS ChannelCheckpointsGuild;
+DROP TRIGGER IF EXISTS PendingAttachmentsGuild;
+DROP TRIGGER IF EXISTS MessageRevisionsGuild;
+DROP TRIGGER IF EXISTS MessageTermsGuild;
+DROP TRIGGER IF EXISTS SearchIndexStateGuild;
+DROP TRIGGER IF EXISTS ArchivedDeletionsGuild;
+CREATE TABLE IF NOT EXISTS SchemaVersion (
+	version int NOT NULL,
+	name varchar(255) NOT NULL,
+	appliedOn datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY (version)
+);
+INSERT IGNORE INTO SchemaVersion (version, name) VALUES (1, 'lookup_indexes'), (2, 'deletion_index'), (3, 'cluster_messages'), (4, 'drop_message_keys');
@@ -1,15 +1,36 @@
+import asyncio
 import logging
 import os
 import sys
+import tempfile
 from datetime import datetime
 from getpass import getpass
 
 import discord
-import xlwt
 from discord.ext import commands
 from mysql.connector import (DatabaseError, IntegrityError, InterfaceError,
-                             MySQLConnection, OperationalError,
-                             ProgrammingError, connect)
+                             OperationalError, ProgrammingError)
+from mysql.connector.errors import PoolError
+
+from attachment_downloader import AttachmentDownloader
+from attachment_store import AttachmentStore
+from connection_pool import ConnectionPool, PooledConnection
+from database_executor import DatabaseExecutor
+from export_cache import ExportCache
+from export_jobs import ExportQueue, send_export
+from guild_changes import count_change, guild_changes, prepare_changes
+from guild_storage import GuildStorage
+from member_cache import MemberCache
+from message_archive import MessageArchive
+from message_export import export_formats
+from message_partitions import MessagePartitions
+from message_search import (backfill_search, index_messages, parse_search,
+                            search_messages)
+from message_writer import MessageWriter
+from reconciliation import EDITED, NEW, MessageIndex
+from schema_migrations import SchemaMigrator
+from snowflake import first_snowflake
+from voice_sessions import VoiceSessions
 
 if not os.path.isdir(os.getenv("log_path")):
     os.makedirs(os.getenv("log_path"))
@@ -81,6 +102,132 @@ if not os.path.isdir(log_path):
     logger.warning(f"\'{log_path}\' does not exist. Creating.")
     os.mkdir(log_path)
 
+# Get how many messages are fetched from a channel's history before they're
+# saved.
+history_chunk_size = int(os.getenv("history_chunk_size") or 1000)
+
+# Limit how many channel histories are fetched at once, across every guild, so
+# the bot stays well clear of Discord's rate limits.
+history_limiter = asyncio.Semaphore(int(os.getenv("history_concurrency") or 5))
+
+# The ID of the first message each channel has sent live since the bot
+# started. Everything before it is caught up from the channel's history, and
+# nothing from it on, as those have already been queued.
+live_floors = {}
+
+# The channels whose history has been caught up since the bot started. Until a
+# channel is, the messages it sends live don't move its checkpoint, so the ones
+# missed while the bot was offline are still fetched if the bot stops first.
+caught_up_channels = set()
+
+# Get the biggest each file of a gimme export can be, which needs to be under
+# Discord's upload limit, and how many rows are fetched for it at a time.
+export_part_size = int(os.getenv("export_part_size") or 8000000)
+export_fetch_size = int(os.getenv("export_fetch_size") or 1000)
+
+# Keep recent exports so the same request can be answered again straight away.
+export_cache = ExportCache(os.getenv("export_cache_path") or
+                           os.path.join(tempfile.gettempdir(), "gimme_cache"),
+                           int(os.getenv("export_cache_size") or 1073741824))
+
+# Get how many search results are sent at a time, and how many old rows of each
+# table are indexed for searching in each transaction.
+search_page_size = int(os.getenv("search_page_size") or 10)
+search_backfill_size = int(os.getenv("search_backfill_size") or 5000)
+
+# Set up the queue that gimme exports wait in to be run in their own processes.
+export_queue = ExportQueue(workers=int(os.getenv("export_workers") or 2),
+                           user_jobs=int(os.getenv("export_user_jobs") or 1),
+                           user_daily=int(os.getenv("export_user_daily") or 10),
+                           progress_interval=float(
+                               os.getenv("export_progress_interval") or 30),
+                           cache=export_cache)
+
+# Set up the pool of database connections that every function borrows from.
+pool = ConnectionPool(size=int(os.getenv("pool_size") or 10),
+                      timeout=float(os.getenv("pool_timeout") or 30),
+                      max_lifetime=float(os.getenv("pool_max_lifetime") or 3600),
+                      ping_interval=float(os.getenv("pool_ping_interval") or 60),
+                      stats_interval=float(os.getenv("pool_stats_interval") or
+                                           300),
+                      statements=int(os.getenv("pool_statements") or 64),
+                      host=os.getenv('database_address'),
+                      user=os.getenv('user'),
+                      password=os.getenv('password'))
+
+# Set up the worker threads that all of the blocking database work runs on so
+# the event loop is never held up by the database.
+database = DatabaseExecutor(int(os.getenv("database_workers") or pool.size))
+
+# Keep every guild's rows in one set of shared tables rather than a database
+# each, if asked to.
+guild_storage = GuildStorage((os.getenv("storage_mode") or "separate").lower()
+                             == "shared")
+
+# Set up the migrations that bring older guild databases up to date.
+schema_migrator = SchemaMigrator(pool, database,
+                                 lock_wait_timeout=int(
+                                     os.getenv("migration_lock_timeout") or 5),
+                                 retry_delay=float(
+                                     os.getenv("migration_retry_delay") or 60),
+                                 storage=guild_storage)
+
+# Set up the archive that old months of messages are moved to, and the monthly
+# partitions of the Messages tables they're moved from.
+message_archive = MessageArchive(os.getenv("archive_path") or "archive/")
+message_partitions = MessagePartitions(pool, database, message_archive,
+                                       months_ahead=int(
+                                           os.getenv("partition_months_ahead")
+                                           or 3),
+                                       archive_after=int(
+                                           os.getenv("archive_after_months")
+                                           or 0),
+                                       convert_rows=int(
+                                           os.getenv("partition_convert_rows")
+                                           or 1000000),
+                                       lock_wait_timeout=int(
+                                           os.getenv("migration_lock_timeout")
+                                           or 5),
+                                       storage=guild_storage)
+
+# Keep the last written version of recently seen members so they only need to
+# be written when something about them changes.
+member_cache = MemberCache(int(os.getenv("member_cache_size") or 100000))
+
+# Keep each distinct attachment once no matter how many times it was posted.
+attachment_store = AttachmentStore(attach_path)
+
+# Set up the workers that download attachments in the background once their
+# messages have been written.
+attachment_downloader = AttachmentDownloader(pool, database, attachment_store,
+                            workers=int(os.getenv("download_workers") or 4),
+                            retries=int(os.getenv("download_retries") or 5),
+                            backoff=float(os.getenv("download_backoff") or 1),
+                            chunk_size=int(os.getenv("download_chunk_size") or
+                                           65536),
+                            budget=int(os.getenv("download_budget") or
+                                       268435456),
+                            max_size=int(os.getenv("download_max_size") or
+                                         0),
+                            storage=guild_storage,
+                            max_attempts=int(os.getenv("download_max_attempts")
+                                             or 5))
+
+# Keep track of who is in which voice channel, so their sessions can be closed
+# by the row they were given.
+voice_sessions = VoiceSessions()
+
+# Set up the writer that new messages are queued on so they can be written to
+# the database in batches rather than one at a time.
+message_writer = MessageWriter(pool, database, member_cache,
+                               attachment_downloader,
+                               batch_size=int(os.getenv("batch_size") or 500),
+                               batch_interval=float(os.getenv("batch_interval")
+                                                    or 0.2),
+                               storage=guild_storage,
+                               voice_sessions=voice_sessions,
+                               retries=int(os.getenv("batch_retries") or 5))
+
 async def new_message(message: discord.Message):
     """
     Called when a new message is added to an audited server.\n
@@ -90,167 +237,65 @@ async def new_message(message: discord.Message):
                  f"\'{message.guild.name}\' in the \'{message.channel.name}\' "+
                  "channel.")
 
-    mydb = get_credentials()
-
-    # Set up the cursor.
-    cursor = ""
-
-    # Try to set up the cursor.
-    try:
-        cursor = mydb.cursor()
-    
-    except OperationalError:
-        logger.critical("The MySQL connection is unavailable.")
-
-    # Check if the database is already connected
-    if mydb.database != f'server{message.guild.id}':
-        # If the database is not currently the active one, then switch to the
-        # appropriate database.
-        logger.debug(f"Switching to \'server{message.guild.id}\'.")
-
-        # Try to use the guild database.
-        try:
-            cursor.execute(f"USE server{message.guild.id}")
-        
-        except ProgrammingError as err:
-            logger.critical(f"Could not connect to {message.guild.id}.\n{err}")
-
-    # Select only the members who have a matching memberID (Hint, there's only
-    # ever going to be one as it's the primary key of the member table).
-    sql = "SELECT * FROM Members WHERE memberID = %s"
-    val = (message.author.id,)
-
-    # Execute the command.
-    try:
-        cursor.execute(sql, val)
-    
-    except ProgrammingError as err:
-        logger.critical(f"Could not execute the command {sql}.\n{err}")
-
-    # Initialize the records so they can be in a try/except catch.
-    records = ""
-    
-    # Try to get all of the records.
-    try:
-        records = cursor.fetchall()
-
-    except InterfaceError as err:
-        logger.critical(f"Could not fetch the records.\n{err}")
-
-    # Fetch all of the information about the member in a digestable manner.
-    member_ID = message.author.id
-    member_name = message.author.name
-    member_discriminator = int(message.author.discriminator)
-    member_is_bot = int(message.author.bot)
-    member_nickname = message.author.nick
-
-    # Create a tuple out of the data.
-    member = (member_ID,member_name,member_discriminator,member_is_bot,
-              member_nickname)
-
-    sql=("UPDATE Members SET memberName=%s, discriminator=%s, nickname=%s "+
-         "WHERE memberID=%s")
-    vals = []
-
-    # Compare the information about the member on file against the information
-    # returned from Discord.
-    for row in records:
-        if row != member:
-            logger.info(f"Member \'{message.author.name}\' needs to be "+
-                         "updated.")
-            vals.append((member_name,member_discriminator,member_nickname,
-                        member_ID))
-
-    try:
-        cursor.executemany(sql,vals)
-    
-    except (ProgrammingError, InterfaceError) as err:
-        logger.critical(f"User {message.author.name} could not be updated.\n"+
-                        f"{err}")
-
-    mydb.commit()
-
-    # If there is no results, then the member doesn't exist in the table yet, so
-    # they need to be added.
-    if len(records) == 0:
-        logger.info(f"\'{message.author.id}\' has never written in "+
-                     f"\'{message.guild.name}\' before. Adding to Members.")
-
-        # Build the SQL command.
-        sql = ("INSERT INTO Members (memberID,memberName,discriminator,isBot,"+
-               "nickname) VALUES (%s,%s,%s,%s,%s)")
-        
-        # Add the values to a tuple.
-        val = (message.author.id,message.author.name,
-               message.author.discriminator,message.author.bot,
-               message.author.nick)
-        
-        # Execute the command.
-        try:
-            cursor.execute(sql, val)
-        
-        except ProgrammingError as err:
-            logger.critical(f"Could not execute the command {sql}.\n{err}")
-
-        mydb.commit()
-
-    # Create the command to add the message to the Messages table.
-    if message.attachments:
-        logger.debug("This message has an attachment.")
-
-        # Go through each attachment in the message.
-        for attachment in message.attachments:
-            sql = ("INSERT INTO Messages (messageID,channelID,authorID,"+
-                   "dateCreated,message,hasAttachment,attachmentID,filename,"+
-                   "qualifiedName,url) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
-
-            # Add the values of the message as a tuple.
-            qualified_name = str(attachment.id) + str(attachment.filename)
-            val = (message.id, message.channel.id, message.author.id,
-                   message.created_at, message.content, True, attachment.id,
-                   attachment.filename, qualified_name, attachment.url)
-
-            directory = ""
-            server = f"server{message.guild.id}/"
-
-            directory = attach_path + server
-            if not os.path.isdir(directory):
-                os.makedirs(attach_path + server)
-            
-            directory = (directory + str(message.attachments[0].id)+
-                            message.attachments[0].filename)
-
-            if not os.path.isfile(directory):
-                logger.debug(f"Saving {attachment.id} to {directory}")
-                await discord.Attachment.save(message.attachments[0],directory)
-
-    # If there are no attachments in the message.
-    else:
-        logger.debug("This message has no attachments.")
-
-        sql = ("INSERT INTO Messages (messageID, channelID, authorID,"+
-               "dateCreated, message) VALUES (%s,%s,%s,%s,%s)")
-        val = (message.id, message.channel.id, message.author.id,
-               message.created_at, message.content)
+    _queue_message(message, live=True)
 
-    # Execute the command, commit it to the database, and close the cursor.
-    try:
-        cursor.execute(sql, val)
-    
-    except ProgrammingError as err:
-        logger.critical(f"Could not execute the command {sql}.\n{err}")
-
-    mydb.commit()
-
-    logger.debug("Closing connection.")
-    cursor.close()
-    mydb.close()
-
-def edited_message(message: discord.Message):
+def _queue_message(message: discord.Message, live: bool = False):
+    """
+    Queues a message, along with its author if needed, to be written with the
+    next batch. Its attachments are downloaded once it has been written.\n
+    message: The message that is going to be added.\n
+    live: Whether the message was just sent, rather than fetched from the
+    channel's history.
+    """
+    # Build a row for each attachment, or a single row if there are none. An
+    # attachment's qualifiedName is left empty until its file is in the store.
+    rows = []
+    for attachment in message.attachments:
+        rows.append((message.id, message.channel.id, message.author.id,
+                     message.created_at, message.content, True, attachment.id,
+                     attachment.filename, None, attachment.url))
+
+    if not rows:
+        rows.append((message.id, message.channel.id, message.author.id,
+                     message.created_at, message.content, False, None, None,
+                     None, None))
+
+    # Authors from a channel's history may no longer be members, in which case
+    # they have no nickname.
+    member = (message.author.id, message.author.name,
+              int(message.author.discriminator), int(message.author.bot),
+              getattr(message.author, "nick", None))
+
+    # Only write the author if they're unknown or something has changed.
+    if member_cache.get(message.guild.id, member[0]) == member:
+        member = None
+
+    # A live message only moves the checkpoint once the channel is caught up,
+    # or it would skip over the messages sent while the bot was offline.
+    checkpoint = True
+    if live:
+        live_floors.setdefault(message.channel.id, message.id)
+        checkpoint = message.channel.id in caught_up_channels
+
+    # Queue the message and its author to be written with the next batch.
+    message_writer.add(message.guild.id, rows, member, checkpoint)
+
+async def edited_message(message: discord.Message):
     """
     Called when a message is edited in an audited server.\n
     message: The current version of the message that was edited.
     """
+    # Make sure the original message has been written before marking it.
+    await message_writer.ensure_written(message.guild.id, message.id)
+    await _edited_message(message)
+
+@database.task
+def _edited_message(message: discord.Message):
+    """
+    Marks a message as edited in the guild database. Runs on a database
+    worker.\n
+    message: The current version of the message that was edited.
+    """
 
     mydb = get_credentials()
 
@@ -265,27 +310,26 @@ def edited_message(message: discord.Message):
     
     if mydb.database != f'server{message.guild.id}':
         try:
-            cursor.execute(f"USE server{message.guild.id}")
+            guild_storage.use(cursor, message.guild.id)
         
         except ProgrammingError as err:
             logger.critical(f"The \'{message.guild.name}\' database could not "+
                             f"be accessed.\n{err}")
-            
-        logger.info(f"\'{message.author.name}\' edited a message in "+
-                    f"\'{message.guild.name}\' in the {message.channel.name} "+
-                    "channel.")
 
-    # Set the prepared statement to update the appropriate values.
-    sql = ("UPDATE Messages SET isEdited=%s, dateEdited=%s WHERE messageID=%s "+
-           "AND dateEdited IS NULL")
-    val = (True,message.edited_at,message.id)
+    logger.info(f"\'{message.author.name}\' edited a message in "+
+                f"\'{message.guild.name}\' in the {message.channel.name} "+
+                "channel.")
 
-    # Execute the command, commit it to the database, then close the cursor.
+    # Mark the original as edited and keep the new content as a revision of it.
+    # The statements are prepared once per connection as edits come in often.
     try:
-        cursor.execute(sql, val)
-    
+        _write_revisions(guild_storage.prepared(mydb, message.guild.id),
+                         [(message.id,message.edited_at,message.content)])
+        count_change(cursor, message.guild.id)
+
     except ProgrammingError as err:
-        logger.critical(f"Could not execute the command {sql}.\n{err}")
+        logger.critical(f"Could not save the edit to message {message.id}."+
+                        f"\n{err}")
 
     mydb.commit()
 
@@ -293,11 +337,47 @@ def edited_message(message: discord.Message):
     cursor.close()
     mydb.close()
 
-def deleted_message(message: discord.Message):
+def _write_revisions(cursor, revisions: list):
+    """
+    Saves edits to messages. The Messages rows keep the original content and
+    the date of the latest edit, while the new content is added to
+    MessageRevisions.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database.\n
+    revisions: The (messageID, dateEdited, message) of each edit, oldest first.
+    """
+    # A message edited before edited_at was recorded still needs a date.
+    now = datetime.utcnow().strftime(time_format)
+    revisions = [(message_id, date_edited or now, content)
+                 for message_id, date_edited, content in revisions]
+
+    cursor.executemany("UPDATE Messages SET isEdited=True,dateEdited=%s WHERE "+
+                       "messageID=%s", [(date_edited, message_id) for
+                                        message_id, date_edited, _ in
+                                        revisions])
+    cursor.executemany("INSERT INTO MessageRevisions (messageID,dateEdited,"+
+                       "message) VALUES (%s,%s,%s)", revisions)
+
+    # The message can be found by what it said before and after the edit.
+    index_messages(cursor, [(message_id, content)
+                            for message_id, _, content in revisions])
+
+async def deleted_message(message: discord.Message):
     """
     Called when a message is deleted from an audited server.\n
     message: The message that has been deleted.
     """
+    # Make sure the message has been written before marking it.
+    await message_writer.ensure_written(message.guild.id, message.id)
+    await _deleted_message(message)
+
+@database.task
+def _deleted_message(message: discord.Message):
+    """
+    Marks a message as deleted in the guild database. Runs on a database
+    worker.\n
+    message: The message that has been deleted.
+    """
 
     mydb = get_credentials()
 
@@ -312,25 +392,38 @@ def deleted_message(message: discord.Message):
 
     if mydb.database != f'server{message.guild.id}':
         try:
-            cursor.execute(f"USE server{message.guild.id}")
+            guild_storage.use(cursor, message.guild.id)
 
         except ProgrammingError as err:
             logger.critical(f"The \'{message.guild.name}\' database could not "+
                             f"be accessed.\n{err}")
 
-        # Get the current UTC time to record when the message was deleted.
-        current_time = datetime.utcnow().strftime(time_format)
+    # Get the current UTC time to record when the message was deleted.
+    current_time = datetime.utcnow().strftime(time_format)
 
-        logger.info(f"A message was deleted from \'{message.guild.name}\' in "+
-                    f"the {message.channel.name} channel.")
+    logger.info(f"A message was deleted from \'{message.guild.name}\' in "+
+                f"the {message.channel.name} channel.")
 
     # Set up the prepared statement set the message as deleted and by whom.
     sql = "UPDATE Messages SET isDeleted=%s, dateDeleted=%s WHERE messageID=%s"
     val = (True,current_time,message.id)
 
     # Execute the command, commit it to the database, then close the cursor.
+    # The statements are prepared once per connection as deletions come in
+    # often.
     try:
-        cursor.execute(sql, val)
+        prepared = guild_storage.prepared(mydb, message.guild.id)
+        prepared.execute(sql, val)
+
+        # An archived message isn't in the database to be marked, so the
+        # deletion is kept alongside it instead.
+        archived = message_archive.archived_before(message.guild.id)
+        if prepared.rowcount == 0 and archived and message.id < archived:
+            prepared.execute("INSERT IGNORE INTO ArchivedDeletions (messageID,"+
+                             "dateDeleted) VALUES (%s,%s)",
+                             (message.id, current_time))
+
+        count_change(cursor, message.guild.id)
     
     except ProgrammingError as err:
         logger.critical(f"Could not execute the command {sql}.\n{err}")
@@ -341,6 +434,7 @@ def deleted_message(message: discord.Message):
     cursor.close()
     mydb.close()
 
+@database.task
 def member_join(member: discord.Member):
     """
     Called when a new member joins a guild.\n
@@ -354,10 +448,10 @@ def member_join(member: discord.Member):
     cursor = mydb.cursor()
 
     if mydb.database != f'server{member.guild.id}':
-        sql = f"USE server{member.guild.id}"
-
         logger.debug(f"Switching to \'server{member.guild.id}\'.")
-        cursor.execute(sql)
+        guild_storage.use(cursor, member.guild.id)
+
+    cursor = guild_storage.cursor(cursor, member.guild.id)
 
     sql = ("INSERT INTO Members (memberID,memberName,discriminator,isBot,"+
           "nickname) VALUES (%s,%s,%s,%s,%s)")
@@ -379,10 +473,15 @@ def member_join(member: discord.Member):
 
     mydb.commit()
 
+    member_cache.put(member.guild.id, (member.id,member.name,
+                                       int(member.discriminator),
+                                       int(member.bot),member.nick))
+
     logger.debug("Closing connection.")
     cursor.close()
     mydb.close()
 
+@database.task
 def member_update(before: discord.Member, after: discord.Member):
     """
     Called when a member updates their nickname.\n
@@ -398,10 +497,10 @@ def member_update(before: discord.Member, after: discord.Member):
     cursor = mydb.cursor()
 
     if mydb.database != f'server{before.guild.id}':
-        sql = f"USE server{before.guild.id}"
-
         logger.debug(f"Switching to \'server{before.guild.id}\'.")
-        cursor.execute(sql)
+        guild_storage.use(cursor, before.guild.id)
+
+    cursor = guild_storage.cursor(cursor, before.guild.id)
 
     sql = ("UPDATE Members SET nickname=%s WHERE memberID=%s")
     
@@ -410,15 +509,33 @@ def member_update(before: discord.Member, after: discord.Member):
     cursor.execute(sql,val)
     mydb.commit()
 
+    member_cache.put(after.guild.id, (after.id,after.name,
+                                      int(after.discriminator),int(after.bot),
+                                      after.nick))
+
     logger.debug("Closing connection.")
     cursor.close()
     mydb.close()
 
-def user_update(before: discord.User, after: discord.User):
+async def user_update(before: discord.User, after: discord.User):
     """
-    Called when a user changes their username or discriminator.\n
-    before: The member before the change.\n
-    after:  The member after the change.
+    Called when a user changes their username or discriminator. A user isn't
+    tied to a guild, so every guild they share with the bot is updated.\n
+    before: The user before the change.\n
+    after:  The user after the change.
+    """
+    # The guilds are looked up on the event loop, where discord.py keeps them.
+    await _user_update(before, after,
+                       [guild.id for guild in after.mutual_guilds])
+
+@database.task
+def _user_update(before: discord.User, after: discord.User, guild_ids: list):
+    """
+    Updates a user's name and discriminator in the guilds they share with the
+    bot.\n
+    before: The user before the change.\n
+    after:  The user after the change.\n
+    guild_ids: The IDs of the guilds the user shares with the bot.
     """
 
     mydb = get_credentials()
@@ -426,77 +543,45 @@ def user_update(before: discord.User, after: discord.User):
     logger.info(f"User \'{before.name}#{before.discriminator}\' has been "+
                 f"changed to \'{after.name}#{after.discriminator}")
     
-    cursor = mydb.cursor()
-
-    if mydb.database != f'server{before.guild.id}':
-        sql = f"USE server{before.guild.id}"
-
-        logger.debug(f"Switching to \'server{before.guild.id}\'.")
-        cursor.execute(sql)
-
     sql = ("UPDATE Members SET memberName=%s,discriminator=%s WHERE "+
            "memberID=%s")
     
     val = (after.name, after.discriminator, before.id)
 
-    cursor.execute(sql,val)
+    for guild_id in guild_ids:
+        cursor = mydb.cursor()
+
+        if mydb.database != f'server{guild_id}':
+            logger.debug(f"Switching to \'server{guild_id}\'.")
+            guild_storage.use(cursor, guild_id)
+
+        cursor = guild_storage.cursor(cursor, guild_id)
+        cursor.execute(sql,val)
+        cursor.close()
+
     mydb.commit()
 
+    member_cache.update_user(after.id, after.name, int(after.discriminator))
+
     logger.debug("Closing connection.")
-    cursor.close()
     mydb.close()
 
-def voice_activity(member: discord.Member, before: discord.VoiceState,
-                 after: discord.VoiceState):
+async def voice_activity(member: discord.Member, before: discord.VoiceState,
+                         after: discord.VoiceState):
     """
-    Called when a user enters, leaves, or moves to another voice channel.\n
+    Called when a user enters, leaves, or moves to another voice channel. The
+    sessions opened and closed are written with the next batch.\n
     member: The member who entered or left the voice chat.\n
     before: The voice state. Will be None if the user is entering the channel
     and they were not in another voice channel previously.\n
     after: The voice state. Will be None if the user is leaving the channel.
     """
-
-    mydb = get_credentials()
-
-    # Set up the cursor.
-    cursor = ""
-    
-    try:
-        cursor = mydb.cursor()
-
-    except OperationalError:
-        logger.critical("The MySQL connection is unavailable.")
-
-    if mydb.database != f'server{member.guild.id}':
-        try:
-            cursor.execute(f"USE server{member.guild.id}")
-        
-        except ProgrammingError as err:
-            logger.critical(f"The \'{member.guild.name}\' database could not "+
-                            f"be accessed.\n{err}")
-    
-    # Initialize the SQL and value variables as well as get the current time.
-    sql = ""
-    val = ()
-    time_now = datetime.utcnow().strftime(time_format)
-
     # If the member is entering a voice channel from no voice channel.
     # Meaning if they were not currently in a voice channel and they enter one.
     if not before.channel and after.channel:
         logger.info(f"\'{member.name}\' has entered the "+
                     f"\'{after.channel.name}\' voice channel in "+
                     f"\'{after.channel.guild.name}\'.")
-
-        # Add a new line for this new entrance.
-        sql = ("INSERT INTO VoiceActivity (memberID,channelID,dateEntered)"+
-               "VALUES (%s,%s,%s)")
-        val = (member.id,after.channel.id,time_now)
-
-        try:
-            cursor.execute(sql, val)
-        
-        except ProgrammingError as err:
-            logger.critical(f"Could not execute the command {sql}.\n{err}")
     
     # If the member is entering a voice channel from another voice channel.
     # Meaning if they switch voice channels.
@@ -506,53 +591,131 @@ def voice_activity(member: discord.Member, before: discord.VoiceState,
                     f"\'{after.channel.name}\' voice channel in "+
                     f"\'{after.channel.guild.name}\'.")
 
-        # Update the previously null dateLeft for this user.
-        sql=("UPDATE VoiceActivity SET dateLeft=%s WHERE memberID=%s order by "+
-             "ID desc limit 1; ")
-        
-        # Insert a new line for this new entrance.
-        sql=sql+("INSERT INTO VoiceActivity (memberID,channelID,dateEntered) "+
-               "VALUES (%s,%s,%s)")
-        val=(time_now,member.id,member.id,after.channel.id,time_now)
-
-        # Since this is a multiline command, it needs special treatment.
-        try:
-            for cmd in cursor.execute(sql,val,multi=True):
-                cmd
-    
-        except ProgrammingError as err:
-            logger.critical(f"Could not execute the command {sql}.\n{err}")
-        
-
     # If the member is leaving a voice channel and not going to any other.
     else:
         logger.info(f"\'{member.name}\' has left the "+
                     f"\'{before.channel.name}\' voice channel in "+
                     f"\'{before.channel.guild.name}\'.")
 
-        sql=("UPDATE VoiceActivity SET dateLeft=%s WHERE memberID=%s order by "+
-             "ID desc limit 1")
-        val=(time_now,member.id)
+    if (not voice_sessions.loaded(member.guild.id) and
+            not await _load_voice_sessions(member.guild)):
+        return
 
-        try:
-            cursor.execute(sql,val)
-    
-        except ProgrammingError as err:
-            logger.critical(f"Could not execute the command {sql}.\n{err}")
-    
-    # Commit the command to the database and close the cursor.
-    mydb.commit()
+    # The sessions refer to the member, so they're written first if they're
+    # new or have changed.
+    member_row = (member.id, member.name, int(member.discriminator),
+                  int(member.bot), member.nick)
+    if member_cache.get(member.guild.id, member.id) != member_row:
+        message_writer.add(member.guild.id, [], member_row)
 
-    logger.debug("Closing connection.")
-    cursor.close()
-    mydb.close()
+    # Close the session they were in, if any, and open one for the channel
+    # they're in now.
+    time_now = datetime.utcnow().strftime(time_format)
+    closed, opened = voice_sessions.change(member.guild.id, member.id,
+                                           after.channel.id if after.channel
+                                           else None, time_now)
+    message_writer.add_voice(member.guild.id, closed, opened)
+
+async def voice_check(guild: discord.Guild):
+    """
+    Catches the voice sessions of a guild up with who is in its voice and
+    stage channels, closing the sessions of anyone who left while the bot was
+    stopped and opening them for anyone who joined.\n
+    guild: The guild to check.
+    """
+    if (not voice_sessions.loaded(guild.id) and
+            not await _load_voice_sessions(guild)):
+        return
+
+    members = {}
+    for channel in guild.channels:
+        if str(channel.type) in ("voice", "stage_voice"):
+            for member in channel.members:
+                members[member.id] = channel.id
+
+    closed, opened = voice_sessions.sync(guild.id, members,
+                                         datetime.utcnow().strftime(
+                                             time_format))
+    if closed or opened:
+        logger.info(f"Closed {len(closed)} and opened {len(opened)} voice "+
+                    f"sessions in \'{guild.name}\'.")
+        message_writer.add_voice(guild.id, closed, opened)
+
+async def _load_voice_sessions(guild: discord.Guild) -> bool:
+    """
+    Loads a guild's open voice sessions into voice_sessions, closing any that
+    were left open behind a newer one.\n
+    guild: The guild to load the sessions of.\n
+    Returns whether they could be loaded.
+    """
+    sessions = await _open_voice_sessions(guild)
+    if sessions is None:
+        return False
+    last_id, rows = sessions
+
+    stale = voice_sessions.load(guild.id, last_id, rows)
+    if stale:
+        time_now = datetime.utcnow().strftime(time_format)
+        message_writer.add_voice(guild.id, [(row_id, time_now)
+                                            for row_id in stale], [])
+
+    return True
+
+@database.task
+def _open_voice_sessions(guild: discord.Guild) -> tuple:
+    """
+    Gets the voice sessions of a guild that haven't been left for
+    _load_voice_sessions(). Runs on a database worker.\n
+    guild: The guild to get the sessions of.\n
+    Returns the highest ID in VoiceActivity, and the ID, memberID and
+    channelID of each open session in order of ID, or None if they couldn't
+    be read.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
+
+    try:
+        guild_storage.use(cursor, guild.id)
+
+        cursor.execute("SELECT COALESCE(MAX(ID),0) FROM VoiceActivity")
+        last_id = cursor.fetchall()[0][0]
+
+        cursor.execute("SELECT ID,memberID,channelID FROM VoiceActivity "+
+                       "WHERE dateLeft IS NULL ORDER BY ID")
+        return last_id, cursor.fetchall()
+
+    # The IDs can't be handed out without knowing the highest, so the voice
+    # changes aren't recorded until the sessions can be loaded.
+    except (DatabaseError, InterfaceError) as err:
+        logger.critical(f"Could not load the voice sessions of "+
+                        f"\'{guild.name}\'.\n{err}")
+        return None
+
+    finally:
+        cursor.close()
+        mydb.close()
 
 async def guild_join(guild: discord.Guild):
     """
     Called when a new guild is added.\n
     gulid: The new guild that has been enrolled.
     """
+    await _enroll_guild(guild)
 
+    # Get all of the channels, members, and messages in the new or reenrolled
+    # guild.
+    await channel_check(guild)
+    await member_check(guild)
+    await voice_check(guild)
+    await message_check(guild)
+
+@database.task
+def _enroll_guild(guild: discord.Guild):
+    """
+    Adds a new guild to the guildList database and builds its database, or
+    marks it as enrolled again if it has been enrolled before.\n
+    guild: The new guild that has been enrolled.
+    """
     mydb = get_credentials()
 
     logger.info(f"\'{guild.name}\' has been enrolled.")
@@ -605,12 +768,7 @@ async def guild_join(guild: discord.Guild):
     cursor.close()
     mydb.close()
 
-    # Get all of the channels, members, and messages in the new or reenrolled
-    # guild.
-    channel_check(guild)
-    member_check(guild)
-    await message_check(guild)
-
+@database.task
 def guild_update(guild: discord.Guild):
     """
     Called when a guild is updated.\n
@@ -653,14 +811,32 @@ def guild_update(guild: discord.Guild):
     cursor.close()
     mydb.close()
 
-def guild_leave(guild: discord.Guild):
+async def guild_leave(guild: discord.Guild):
     """
     Called when the bot leaves a guild, either due to being kicked or told to
     leave.\n
     guild: The guild that the bot is no longer enrolled in.
     """
+    # The guild's channels will need catching up if it comes back. These are
+    # only touched from the event loop.
+    for channel in guild.channels:
+        caught_up_channels.discard(channel.id)
+        live_floors.pop(channel.id, None)
+
+    await _guild_leave(guild)
+
+@database.task
+def _guild_leave(guild: discord.Guild):
+    """
+    Marks a guild as no longer enrolled in the guildList database. Runs on a
+    database worker.\n
+    guild: The guild that the bot is no longer enrolled in.
+    """
     logger.info(f"\'{guild.name}\' has been unenrolled.")
 
+    # Nobody's voice is followed in the guild any more.
+    voice_sessions.forget(guild.id)
+
     mydb = get_credentials()
 
     # Set up the cursor.
@@ -696,9 +872,20 @@ def guild_leave(guild: discord.Guild):
     cursor.close()
     mydb.close()
 
-def new_channel(channel: discord.TextChannel):
+async def new_channel(channel: discord.TextChannel):
     """
     Called when a new channel is added to an audited server.\n
+    channel: the channel that has been created.
+    """
+    # A new channel has no history to catch up on.
+    caught_up_channels.add(channel.id)
+
+    await _new_channel(channel)
+
+@database.task
+def _new_channel(channel: discord.TextChannel):
+    """
+    Adds a new channel to the guild database. Runs on a database worker.\n
     channel: the channel that has been created.    
     """
     logger.info(f"The \'{channel.name}\' channel has been created in the "+
@@ -718,12 +905,14 @@ def new_channel(channel: discord.TextChannel):
     # Connect to the appropriate database.
     if mydb.database != f'server{channel.guild.id}':
         try:
-            cursor.execute(f"USE server{channel.guild.id}")
+            guild_storage.use(cursor, channel.guild.id)
 
         except ProgrammingError as err:
             logger.critical(f"Could not access the \'{channel.guild.name}\' "+
                             "database.\n{err}")
 
+    cursor = guild_storage.cursor(cursor, channel.guild.id)
+
     # Insert the new channel.
     sql=("INSERT INTO Channels (channelID,channelName,channelTopic,"+
          "channelType,isNSFW,isNews,categoryID) VALUES (%s,%s,%s,%s,%s,%s,%s)")
@@ -744,6 +933,7 @@ def new_channel(channel: discord.TextChannel):
     cursor.close()
     mydb.close()
 
+@database.task
 def update_channel(channel: discord.TextChannel):
     """
     Called when a channel is updated.\n
@@ -766,12 +956,14 @@ def update_channel(channel: discord.TextChannel):
     # Connect to the appropriate database.
     if mydb.database != f'server{channel.guild.id}':
         try:
-            cursor.execute(f"USE server{channel.guild.id}")
+            guild_storage.use(cursor, channel.guild.id)
         
         except ProgrammingError as err:
             logger.critical(f"Could not access the \'{channel.guild.name}\' "+
                             f"database.\n{err}")
 
+    cursor = guild_storage.cursor(cursor, channel.guild.id)
+
     # Update the channel with the new information.
     sql = ("UPDATE Channels SET channelName=%s,channelTopic=%s,isNSFW=%s,"+
            "isNews=%s,categoryID=%s WHERE channelID=%s")
@@ -791,6 +983,7 @@ def update_channel(channel: discord.TextChannel):
     cursor.close()
     mydb.close()
 
+@database.task
 def delete_channel(channel: discord.TextChannel):
     """
     Called when a channel is deleted.\n
@@ -811,12 +1004,14 @@ def delete_channel(channel: discord.TextChannel):
     # Connect to the appropriate database.
     if mydb.database != f'server{channel.guild.id}':
         try:
-            cursor.execute(f"USE server{channel.guild.id}")
+            guild_storage.use(cursor, channel.guild.id)
         
         except ProgrammingError as err:
             logger.critical(f"Could not access the \'{channel.guild.name}\' "+
                             f"database.\n{err}")
 
+    cursor = guild_storage.cursor(cursor, channel.guild.id)
+
     # Mark the appropriate channel as deleted.
     sql = ("UPDATE Channels SET isDeleted=True WHERE channelID=%s")
     val = (channel.id,)
@@ -869,6 +1064,12 @@ def build_server_database(guildID: str, cursor):
     """
     logger.debug(f"Building the {guildID} database.")
 
+    # When the storage is shared the database only holds views, which
+    # build_server_tables() makes.
+    if guild_storage.shared:
+        build_server_tables(guildID, cursor)
+        return
+
     # Create the new database.
     try:
         cursor.execute(f"CREATE DATABASE {guildID}")
@@ -878,7 +1079,38 @@ def build_server_database(guildID: str, cursor):
                      f"\n{err}")
 
     # Switch to the new database.
-    cursor.execute(f"USE {guildID}")
+    guild_storage.use(cursor, guildID[len("server"):])
+
+    build_server_tables(guildID, cursor)
+
+    # The tables are empty, so the migrations can run straight away.
+    try:
+        schema_migrator.migrate(guildID, cursor)
+        message_partitions.maintain(guildID, cursor)
+
+    except DatabaseError as err:
+        logger.critical(f"There was an issue migrating the {guildID} "+
+                        f"database.\n{err}")
+
+def build_server_tables(guildID: str, cursor):
+    """
+    Creates any of a guild database's tables that don't exist yet. Safe to run
+    against a database that already has them, which is how older databases
+    pick up new tables.\n
+    guildID: The ID for the guild in the "server + ID" format.\n
+    cursor: The cursor for the MySQL connection, already using the guild's
+    database unless the storage is shared.
+    """
+    # The shared tables are already there, so only the views need making.
+    if guild_storage.shared:
+        try:
+            guild_storage.build_views(cursor, guildID[len("server"):])
+            guild_storage.use(cursor, guildID[len("server"):])
+
+        except DatabaseError as err:
+            logger.critical(f"There was an issue creating the {guildID} "+
+                            f"views.\n{err}")
+        return
 
     command = ""
 
@@ -897,6 +1129,7 @@ def build_server_database(guildID: str, cursor):
         logger.critical(f"There was an issue creating the {guildID} database."+
                      f"\n{err}")
 
+@database.task
 def guild_check(client: discord.Client):
     """
     Run when there's a need to check the current guilds.\n
@@ -929,6 +1162,9 @@ def guild_check(client: discord.Client):
         new_guilds.append(guild.id)
         
 
+    # Make sure the shared tables exist if every guild is kept in them.
+    guild_storage.prepare(cursor)
+
     # Try to connect to the guildList database.
     try:
         cursor.execute("USE guildList")
@@ -937,6 +1173,12 @@ def guild_check(client: discord.Client):
     except ProgrammingError:
         logger.warning("Guild database does not exist. Creating.")
         build_guild_database(cursor)
+
+    # Make sure the table counting the stored attachments exists.
+    attachment_store.prepare(cursor)
+
+    # Make sure the table counting the changes to each guild's messages exists.
+    prepare_changes(cursor)
      
     # Get all of the guilds and whether or not they're currently enrolled
     # according to the guildList database.
@@ -1079,6 +1321,7 @@ def guild_check(client: discord.Client):
     mydb.close()
     logger.info("Guild check complete.")
 
+@database.task
 def channel_check(guild: discord.Guild):
     """
     Run when there's a need to check a guild's channels.\n
@@ -1103,7 +1346,10 @@ def channel_check(guild: discord.Guild):
 
     # Try to connect to the database.
     try:
-        cursor.execute(f"USE {database}")
+        guild_storage.use(cursor, guild.id)
+
+        # Add any tables that are newer than the database.
+        build_server_tables(database, cursor)
 
     # If it doesn't exist, build it.
     except ProgrammingError:
@@ -1111,67 +1357,13 @@ def channel_check(guild: discord.Guild):
                        "Creating.")
         build_server_database(database, cursor)
 
+    cursor = guild_storage.cursor(cursor, guild.id)
+
+    # The members in voice are caught up separately by voice_check().
     for channel in guild.channels:
         # Only grab the IDs of the channels.
         channel_list.append(channel.id)
 
-        # If this channel is a voice channel, get all of the members in it
-        # currently.
-        users_in_voice = []
-        if str(channel.type) == "voice":
-            users_in_voice = channel.members
-        
-        # Get a list of the user IDs as that's all that is necessary.
-        users_in_voice_list = []
-        for user in users_in_voice:
-            users_in_voice_list.append(user.id)
-
-        # Get the list of members who are currently listed as being in a voice
-        # channel.
-        try:
-            cursor.execute("SELECT memberID FROM VoiceActivity WHERE dateLeft "+
-                           "IS NULL")
-
-        except ProgrammingError as err:
-            logger.critical(f"There was an error selecting members.\n{err}")
-
-        try:
-            records = cursor.fetchall()
-        
-        except InterfaceError as err:
-            logger.critical(f"There was an error retrieving records.\n{err}")
-
-        # Go through each user that's marked as in a voice channel.
-        for row in records:
-            # If they are not currently in a voice channel, update them as
-            # left with the current time.
-            if row[0] not in users_in_voice_list:
-                sql=("UPDATE VoiceActivity SET dateLeft=%s WHERE memberID=%s "+
-                     "order by ID desc limit 1")
-                val=(datetime.utcnow().strftime(time_format),guild.
-                     get_member(row[0]).id)
-                try:
-                    cursor.execute(sql,val)
-
-                except Exception as err:
-                    logger.critical(f"There was an error executing a command."+
-                                    f"\n{err}")
-
-        # If there are users in the voice channel, then add them to the
-        # database.
-        for user in users_in_voice:
-            sql = ("INSERT INTO VoiceActivity (memberID,channelID,dateEntered)"+
-               "VALUES (%s,%s,%s)")
-            val = (user.id,channel.id,datetime.utcnow().strftime(time_format))
-            try:
-                cursor.execute(sql,val)
-
-            except Exception as err:
-                logger.critical(f"There was an error executing a command."+
-                                f"\n{err}")
-
-        mydb.commit()
-
     # Get all of the chennel IDs from the Channels table.
     sql = "SELECT * FROM Channels"
 
@@ -1283,6 +1475,7 @@ def channel_check(guild: discord.Guild):
     mydb.close()
     logger.info(f"Channel check in \'{guild.name}\' complete.")
 
+@database.task
 def member_check(guild: discord.Guild):
     """
     Run when there's a need to check for new members.\n
@@ -1310,11 +1503,13 @@ def member_check(guild: discord.Guild):
     
     # Specify which database will be used.
     try:
-        cursor.execute(f"USE server{guild.id}")
+        guild_storage.use(cursor, guild.id)
     
     except ProgrammingError as err:
         logger.critical(f"There was an issue connecting to the {guild.name} "+
                         f"database.\n{err}")
+
+    cursor = guild_storage.cursor(cursor, guild.id)
     
     # Execute the command to get all of the member IDs from that database.
     try:
@@ -1327,6 +1522,10 @@ def member_check(guild: discord.Guild):
 
     updated_members = []
 
+    # The members whose rows are known to match them, which are the only ones
+    # that are remembered.
+    written_members = []
+
     # Go through each record returned and remove it from the ID list if it
     # exists.
     for row in records:
@@ -1341,6 +1540,8 @@ def member_check(guild: discord.Guild):
                 updated_members.append((member_tuple[1],member_tuple[2],
                                     member_tuple[3],member_tuple[4],
                                     member_tuple[0]))
+            else:
+                written_members.append(member_tuple)
 
         if row[0] in members_id:
             members_id.remove(row[0])
@@ -1364,11 +1565,15 @@ def member_check(guild: discord.Guild):
 
         try:
             cursor.executemany(sql,members)
+            mydb.commit()
+
+            written_members.extend((member[0],member[1],int(member[2]),
+                                    int(member[3]),member[4])
+                                   for member in members)
 
         except Exception as err:
             logger.critical(f"There was an error executing a command.\n{err}")
-
-        mydb.commit()
+            mydb.rollback()
 
     else:
         logger.debug(f"No new members have joined \'{guild.name}\' since "+
@@ -1381,29 +1586,229 @@ def member_check(guild: discord.Guild):
         sql=("UPDATE Members SET memberName=%s,discriminator=%s,isBot=%s,"+
              "nickname=%s WHERE memberID=%s")
 
-        cursor.executemany(sql,updated_members)
-        mydb.commit()
+        try:
+            cursor.executemany(sql,updated_members)
+            mydb.commit()
+
+            written_members.extend((member[4],member[0],member[1],member[2],
+                                    member[3]) for member in updated_members)
+
+        except Exception as err:
+            logger.critical(f"There was an error executing a command.\n{err}")
+            mydb.rollback()
 
     else:
         logger.debug(f"No members have been updated in \'{guild.name}\' since "+
                      "reawakening.")
 
+    # Remember the members that are known to be written so their messages
+    # don't need to look them up. Any that failed are written with their next
+    # message instead.
+    for member in written_members:
+        member_cache.put(guild.id, member)
+
     logger.debug("Closing connection.")
     cursor.close()
     mydb.close()
     logger.info(f"Member check complete in \'{guild.name}\' complete.")
 
-async def message_check(guild: discord.Guild):
+async def message_check(guild: discord.Guild, full: bool = False):
     """
-    Run when there's a need to check a guild's messages.\n
+    Run when there's a need to check a guild's messages. Normally only the
+    messages sent since each channel's checkpoint are fetched, which catches up
+    on anything missed while the bot was offline. A full check fetches every
+    message instead so that edits and deletions are found as well.\n
     guild: The guild that the bot will get the messages for.\n
+    full: Whether to fetch and compare every message in the guild.
     """
     logger.info(f"Checking for message changes in \'{guild.name}\'.")
 
-    mydb = get_credentials()
+    # Get the newest message that has been saved from each channel.
+    checkpoints = {}
+    archived = None
+    if not full:
+        checkpoints = await _channel_checkpoints(guild, dict(live_floors))
+
+    # Archived messages aren't in the database to be compared against, so a
+    # full check starts after them.
+    else:
+        archived = message_archive.archived_before(guild.id)
+
+    # Check the text channels at the same time, as most of the time is spent
+    # waiting on Discord. history_limiter keeps how many run at once in check.
+    channel_checks = []
+    for channel in guild.channels:
+        # Only worry about text channels.
+        if type(channel) == discord.channel.TextChannel:
+            channel_checks.append(_channel_message_check(channel, full,
+                                                checkpoints.get(channel.id),
+                                                archived))
+
+    await asyncio.gather(*channel_checks)
+
+    # Only the channels that are still there are compared, so the messages of
+    # any that have gone are marked as deleted separately.
+    if full:
+        await _gone_channel_messages(guild, [channel.id for channel in
+                                             guild.channels if type(channel) ==
+                                             discord.channel.TextChannel])
 
-    # Instantiate a list for the raw messages.
-    raw_messages = []
+    logger.info(f"Message check in \'{guild.name}\' complete.")
+
+async def _channel_message_check(channel: discord.TextChannel, full: bool,
+                                 checkpoint: int, archived: int = None):
+    """
+    Checks a channel's messages once one of the history_limiter slots is free.
+    Any problem with the channel is logged so the other channels can carry on.\n
+    channel: The channel that the bot will get the messages for.\n
+    full: Whether to fetch and compare every message in the channel.\n
+    checkpoint: The ID of the newest message saved from the channel, if any.\n
+    archived: The first message ID that hasn't been archived, if any have.
+    """
+    async with history_limiter:
+        try:
+            await _channel_history(channel, full, checkpoint, archived)
+
+        # Channels the bot can't read are skipped rather than stopping the
+        # rest of the guild from being checked.
+        except discord.Forbidden:
+            logger.warning(f"Not allowed to read the history of the "+
+                           f"\'{channel.name}\' channel in "+
+                           f"\'{channel.guild.name}\'.")
+
+        except Exception as err:
+            logger.critical(f"There was an issue checking the "+
+                            f"\'{channel.name}\' channel in "+
+                            f"\'{channel.guild.name}\'.\n{err}")
+
+async def _channel_history(channel: discord.TextChannel, full: bool,
+                           checkpoint: int, archived: int = None):
+    """
+    Streams a channel's history in chunks of history_chunk_size messages,
+    saving each chunk before fetching the next one so only a chunk is ever held
+    at once.\n
+    channel: The channel that the bot will get the messages for.\n
+    full: Whether to fetch and compare every message in the channel.\n
+    checkpoint: The ID of the newest message saved from the channel, if any.\n
+    archived: The first message ID that hasn't been archived, if any have.
+    """
+    logger.debug(f"Getting messages from the \'{channel.name}\' channel.")
+
+    # Only get what's newer than the checkpoint, or everything if there isn't
+    # one or every message is being checked.
+    after = None
+    if not full and checkpoint is not None:
+        after = discord.Object(id=checkpoint)
+    elif full and archived is not None:
+        after = discord.Object(id=archived - 1)
+
+    # Stop at the first message the channel sent live, as everything from it
+    # on has already been queued.
+    before = None
+    if channel.id in live_floors:
+        before = discord.Object(id=live_floors[channel.id])
+
+    # The newest message ID the database has been compared up to.
+    checked = after.id if after is not None else 0
+
+    chunk = []
+    async for mess in channel.history(limit=None, after=after, before=before,
+                                      oldest_first=True):
+        # The first live message may have only come in since the fetch began.
+        if mess.id >= live_floors.get(channel.id, mess.id + 1):
+            break
+
+        chunk.append(mess)
+
+        if len(chunk) >= history_chunk_size:
+            checked = await _message_chunk(channel, chunk, full, checked)
+            chunk = []
+
+    if chunk:
+        checked = await _message_chunk(channel, chunk, full, checked)
+
+    # The channel's live messages can move its checkpoint from now on.
+    caught_up_channels.add(channel.id)
+
+    # Anything in the database newer than the last fetched message has been
+    # deleted, other than what was sent live, which the fetch stopped short
+    # of. Without a live message yet, anything sent from now on is left alone.
+    if full:
+        floor = live_floors.get(channel.id,
+                                first_snowflake(datetime.utcnow()))
+        await _message_chunk(channel, [], full, checked, floor)
+
+async def _message_chunk(channel: discord.TextChannel, chunk: list, full: bool,
+                         checked: int, until: int = None) -> int:
+    """
+    Saves a chunk of messages fetched from a channel's history. On a full
+    check, the chunk is compared against the messages in the database from
+    just after the last chunk up to the end of this one, so only a chunk's
+    worth of the database is ever held at once, and anything in that range
+    that isn't in the chunk has been deleted.\n
+    channel: The channel the messages are from.\n
+    chunk: The messages, oldest first.\n
+    full: Whether the messages are being compared against the database, as
+    otherwise every message is new.\n
+    checked: The newest message ID the database has been compared up to.\n
+    until: The first message ID past the range to compare, if not just past
+    the end of the chunk.\n
+    Returns the newest message ID the database has now been compared up to.
+    """
+    guild = channel.guild
+    edited_messages = []
+    deleted_messages = []
+
+    message_index = None
+    if full:
+        if until is None:
+            until = chunk[-1].id + 1
+
+        message_index = MessageIndex(await _message_records(channel, checked,
+                                                            until))
+
+    # Go through each message that was obtained from the channel.
+    for mess in chunk:
+        if message_index is not None:
+            state = message_index.reconcile(mess.id, mess.content)
+
+            # If the message is in the database but the contents are different.
+            if state == EDITED:
+                edited_messages.append((mess.id,mess.edited_at,mess.content))
+
+            # Only new messages need to be added.
+            if state != NEW:
+                continue
+
+        _queue_message(mess)
+
+    if message_index is not None:
+        deleted_at = datetime.utcnow().strftime(time_format)
+        deleted_messages = [(True, deleted_at, message_id)
+                            for message_id in message_index.unseen()]
+
+    # Write the new messages, then the changes to the existing ones.
+    if chunk:
+        await message_writer.flush(guild.id)
+
+    if edited_messages or deleted_messages:
+        await _message_changes(guild, edited_messages, deleted_messages)
+
+    return until - 1 if until is not None else checked
+
+@database.task
+def _message_records(channel: discord.TextChannel, after: int,
+                     before: int) -> list:
+    """
+    Gets a range of the messages from a channel that are already in the
+    guild's database so they can be compared against what is in the channel.\n
+    channel: The channel that the bot will get the records for.\n
+    after: Only get the messages newer than this ID.\n
+    before: Only get the messages older than this ID.
+    """
+    guild = channel.guild
+
+    mydb = get_credentials()
 
     # Set up the cursor.
     try:
@@ -1413,156 +1818,122 @@ async def message_check(guild: discord.Guild):
 
     # Specify which database to use.
     try:
-        cursor.execute(f"USE server{guild.id}")
+        guild_storage.use(cursor, guild.id)
     except ProgrammingError as err:
         logger.critical(f"There was an issue accessing {guild.name}.\n{err}")
 
-    # Go through each channel
-    for channel in guild.channels:
-        # Only worry about text channels.
-        if type(channel) == discord.channel.TextChannel:
-            logger.debug(f"Getting messages from the \'{channel.name}\' "+
-                         "channel.")
-            raw_messages = (raw_messages +
-                            await channel.history(limit=None).flatten())
-
-    # Reverse the raw messages so they're in order from oldest to newest.
-    raw_messages.reverse()
-
-    # Get a list of messages that are already in the server.
+    # Get a list of messages that are already in the server, followed by their
+    # revisions oldest first so the latest content of each message comes last.
     message_records = []
     try:
-        cursor.execute("SELECT messageID,hasAttachment,qualifiedName,message "+
-                       "FROM Messages WHERE isDeleted=0")
+        cursor.execute("SELECT messageID,message FROM Messages WHERE "+
+                       "channelID=%s AND isDeleted=0 AND messageID>%s AND "+
+                       "messageID<%s ORDER BY ID", (channel.id, after, before))
         message_records = cursor.fetchall()
+
+        cursor.execute("SELECT messageID,message FROM MessageRevisions WHERE "+
+                       "messageID IN (SELECT messageID FROM Messages WHERE "+
+                       "channelID=%s AND isDeleted=0 AND messageID>%s AND "+
+                       "messageID<%s) ORDER BY ID", (channel.id, after, before))
+        message_records.extend(cursor.fetchall())
     except Exception as err:
         logger.critical(f"There was an issue selecting messages.\n{err}")
 
-    # A slew of lists to hold the values for all of the messages that need to
-    # be adjusted in one way or another.
-    to_upload_attach = []
-    to_upload_no_attach = []
-    edited_messages = []
-    deleted_messages = []
-    new_members = []
+    logger.debug("Closing connection.")
+    cursor.close()
+    mydb.close()
+
+    return message_records
+
+@database.task
+def _channel_checkpoints(guild: discord.Guild, floors: dict) -> dict:
+    """
+    Gets the ID of the newest message saved from each of a guild's channels.\n
+    guild: The guild that the bot will get the checkpoints for.\n
+    floors: The ID of the first message each channel has sent live, which
+    a channel without a checkpoint starts from below.
+    """
+    mydb = get_credentials()
 
-    # Get all of the memberIDs of everyone that is currently listed as being
-    # in this guild.
-    sql = "SELECT memberID FROM Members"
-    user_records = []
+    # Set up the cursor.
     try:
-        cursor.execute(sql)
-        user_records = cursor.fetchall()
+        cursor = mydb.cursor()
+    except OperationalError:
+        logger.critical("The MySQL connection is unavailable.")
+
+    # Specify which database to use.
+    try:
+        guild_storage.use(cursor, guild.id)
+    except ProgrammingError as err:
+        logger.critical(f"There was an issue accessing {guild.name}.\n{err}")
+
+    checkpoints = {}
+    try:
+        cursor.execute("SELECT channelID,lastMessageID FROM ChannelCheckpoints")
+        checkpoints = dict(cursor.fetchall())
+
+        # Channels without a checkpoint, such as in databases from before they
+        # were kept, start from the newest message they have saved. Anything
+        # sent live is skipped over, as the messages before it still need
+        # fetching.
+        for channel in guild.text_channels:
+            if channel.id in checkpoints:
+                continue
+
+            cursor.execute("SELECT MAX(messageID) FROM Messages WHERE "+
+                           "channelID=%s AND messageID<%s",
+                           (channel.id, floors.get(channel.id, 2**63 - 1)))
+            newest = cursor.fetchall()[0][0]
+
+            if newest is not None:
+                logger.info(f"The \'{channel.name}\' channel in "+
+                            f"\'{guild.name}\' has no checkpoint yet. "+
+                            "Starting from its newest saved message.")
+                checkpoints[channel.id] = newest
+
     except Exception as err:
-        logger.critical(f"There was an issue selecting members.\n{err}")
-
-    # Set up the directory for the attachments to be saved to.
-    directory = f"{attach_path}server{guild.id}/"
-
-    # Create the directory if it does not exist.
-    if not os.path.isdir(directory):
-        logger.debug(f"{directory} does not exist. Creating now.")
-        os.mkdir(directory)
-
-    # Go through each message that was obtained from the guild.
-    for mess in raw_messages:
-        # If the message is not yet in the database.
-        if not next((value for index,value in enumerate(message_records) if
-                    value[0]==mess.id),None):
-
-            # If the message has one or more attachments.
-            if mess.attachments:
-                for attachment in mess.attachments:
-                    # Get the full path and filename for it.
-                    filename = (directory + str(attachment.id) +
-                                attachment.filename)
-                    if not os.path.isfile(filename):
-                        await discord.Attachment.save(attachment,filename)
-
-                    to_upload_attach.append((mess.id, mess.channel.id,
-                            mess.author.id, mess.created_at,
-                            mess.content, True, attachment.id,
-                            attachment.filename, str(mess.id) +
-                            attachment.filename, attachment.url))
-                    
-            # If the message has no attachments.
-            else:
-                to_upload_no_attach.append((mess.id, mess.channel.id,
-                        mess.author.id, mess.created_at, mess.content))
-
-        # If the message is in the database but the contents are different.
-        elif not next((value for index,value in enumerate(message_records) if 
-                    value[3]==mess.content),None):
-            edited_messages.append((True,mess.edited_at,mess.id))
-
-        # If the author is not yet in the Members database and not yet in the
-        # new_members list.
-        if (not next((value for index,value in enumerate(user_records) if
-                     value[0]==mess.author.id),None) and 
-            not next((value for index,value in enumerate(new_members) if
-                      value[0]==mess.author.id),None)):
-            new_members.append((mess.author.id,mess.author.name,
-                         mess.author.discriminator,mess.author.bot,
-                         mess.author.display_name))
-
-    # Go through each of the records from the database to see what is in it but
-    # not in the messages from the guild.
-    for row in message_records:
-        if not next((value for index,value in enumerate(raw_messages) if
-                    value.id==row[0]),None):
-            deleted_messages.append((True,
-                                    datetime.utcnow().strftime(time_format),
-                                    row[0]))
-
-    # Add the new members to the Members database.
-    if len(new_members) > 0:
-        try:
-            sql = ("INSERT INTO Members (memberID,memberName,discriminator,"+
-                   "isBot,nickname) VALUES (%s,%s,%s,%s,%s)")
-            cursor.executemany(sql,new_members)
-        except Exception as err:
-            logger.critical("There was an error adding users to the database."+
-                            f"\n{err}")
-        mydb.commit()
+        logger.critical(f"There was an issue selecting checkpoints.\n{err}")
 
-    # If there are attachment messages to add to the database.
-    if len(to_upload_attach) > 0:
-        logger.debug(f"There are {len(to_upload_attach)} messages with "+
-                     f"attachments to upload in \'{guild.name}\'.")
-        sql = ("INSERT INTO Messages (messageID, channelID, authorID,"+
-                "dateCreated, message, hasAttachment, attachmentID,"+
-                "filename, qualifiedName, url) VALUES"+
-                "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
-        
-        try:
-            cursor.executemany(sql,to_upload_attach)
-        except Exception as err:
-            logger.critical(f"There was an error executing a command.\n{err}")
-        mydb.commit()
+    logger.debug("Closing connection.")
+    cursor.close()
+    mydb.close()
 
-    # If there are non-attachment messages to add to the database.
-    if len(to_upload_no_attach) > 0:
-        logger.debug(f"There are {len(to_upload_no_attach)} messages with no "+
-                     f"attachments to upload in \'{guild.name}\'.")
-        sql = ("INSERT INTO Messages (messageID, channelID, authorID,"+
-                "dateCreated, message) VALUES (%s,%s,%s,%s,%s)")
-        
-        try:
-            cursor.executemany(sql,to_upload_no_attach)
-        except Exception as err:
-            logger.critical(f"There was an error executing a command.\n{err}")
-        mydb.commit()
+    return checkpoints
+
+@database.task
+def _message_changes(guild: discord.Guild, edited_messages: list,
+                     deleted_messages: list):
+    """
+    Writes the edits and deletions found by a full message check to a guild's
+    database.\n
+    guild: The guild that was checked.\n
+    edited_messages: The messages that have been edited.\n
+    deleted_messages: The messages that have been deleted.
+    """
+    mydb = get_credentials()
+
+    # Set up the cursor.
+    try:
+        cursor = mydb.cursor()
+    except OperationalError:
+        logger.critical("The MySQL connection is unavailable.")
+
+    # Specify which database to use.
+    try:
+        guild_storage.use(cursor, guild.id)
+    except ProgrammingError as err:
+        logger.critical(f"There was an issue accessing {guild.name}.\n{err}")
+
+    cursor = guild_storage.cursor(cursor, guild.id)
 
     # If there are edited messages to update.
     if len(edited_messages) > 0:
         logger.info(f"There have been {len(edited_messages)} messages edited "+
                     f"in \'{guild.name}\' since reawakening. Updating them "+
                     "now.")  
-        sql = ("UPDATE Messages SET isEdited=%s,dateEdited=%s WHERE "+
-               "messageID=%s AND dateEdited IS NULL")
-        
         try:
-            cursor.executemany(sql,edited_messages)
+            _write_revisions(cursor, edited_messages)
+            count_change(cursor, guild.id)
         except Exception as err:
             logger.critical(f"There was an error executing a command.\n{err}")
         mydb.commit()
@@ -1580,6 +1951,7 @@ async def message_check(guild: discord.Guild):
 
         try:
             cursor.executemany(sql,deleted_messages)
+            count_change(cursor, guild.id)
         except Exception as err:
             logger.critical(f"There was an error executing a command.\n{err}")
         mydb.commit()
@@ -1591,22 +1963,178 @@ async def message_check(guild: discord.Guild):
     logger.debug("Closing connection.")
     cursor.close()
     mydb.close()
-    logger.info(f"Message check in \'{guild.name}\' complete.")
 
-def get_credentials() -> MySQLConnection:
+@database.task
+def _gone_channel_messages(guild: discord.Guild, channel_ids: list):
+    """
+    Marks the messages of a guild's channels that are no longer text channels,
+    such as ones deleted while the bot was offline, as deleted.\n
+    guild: The guild that was checked.\n
+    channel_ids: The IDs of the guild's text channels.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
+
+    try:
+        guild_storage.use(cursor, guild.id)
+        cursor = guild_storage.cursor(cursor, guild.id)
+
+        sql = ("UPDATE Messages SET isDeleted=%s,dateDeleted=%s WHERE "+
+               "isDeleted=0")
+        val = [True, datetime.utcnow().strftime(time_format)]
+        if channel_ids:
+            sql += (" AND channelID NOT IN ("+
+                    ",".join(["%s"] * len(channel_ids))+")")
+            val += channel_ids
+
+        cursor.execute(sql, val)
+        gone = cursor.rowcount
+        if gone > 0:
+            count_change(cursor, guild.id)
+        mydb.commit()
+
+        if gone > 0:
+            logger.info(f"{gone} messages in \'{guild.name}\' were "+
+                        "in channels that are gone. Marking them as deleted.")
+
+    except (DatabaseError, InterfaceError) as err:
+        logger.critical(f"Could not mark the messages of the channels that "+
+                        f"are gone from \'{guild.name}\'.\n{err}")
+
+    finally:
+        cursor.close()
+        mydb.close()
+
+@database.task
+def compact_revisions(guild: discord.Guild, batch_size: int = 1000) -> tuple:
+    """
+    Turns the extra copies of edited messages that older versions of the bot
+    saved, a whole new Messages row for every edit, into MessageRevisions. The
+    first row of each message is kept as the original. Safe to run more than
+    once as a guild with no copies left is left alone.\n
+    guild: The guild to compact.\n
+    batch_size: How many edited messages are compacted in each transaction.\n
+    Returns how many messages were compacted and how many rows were removed.
+    """
+    mydb = get_credentials()
+
+    # Set up the cursor.
+    try:
+        cursor = mydb.cursor()
+    except OperationalError:
+        logger.critical("The MySQL connection is unavailable.")
+
+    # Specify which database to use.
+    try:
+        guild_storage.use(cursor, guild.id)
+    except ProgrammingError as err:
+        logger.critical(f"There was an issue accessing {guild.name}.\n{err}")
+
+    cursor = guild_storage.cursor(cursor, guild.id)
+
+    messages = 0
+    removed = 0
+    last_id = 0
+
+    try:
+        while True:
+            # Find the next batch of messages with more than one copy of the
+            # same row. A message with several attachments has a row for each,
+            # so only copies of the same attachment count.
+            cursor.execute("SELECT messageID FROM Messages WHERE messageID>%s "+
+                           "GROUP BY messageID,attachmentID HAVING COUNT(*)>1 "+
+                           "ORDER BY messageID LIMIT %s", (last_id, batch_size))
+            message_ids = sorted({row[0] for row in cursor.fetchall()})
+
+            if not message_ids:
+                break
+
+            placeholders = ",".join(["%s"] * len(message_ids))
+
+            cursor.execute("SELECT ID,messageID,attachmentID,dateCreated,"+
+                           "dateEdited,message FROM Messages WHERE messageID IN "+
+                           f"({placeholders}) ORDER BY ID", message_ids)
+            rows = {}
+            for row in cursor.fetchall():
+                rows.setdefault(row[1], []).append(row)
+
+            # Any edits saved since the bot stopped making copies came after
+            # the copies, so they're put back after them to stay in order.
+            cursor.execute("SELECT messageID,dateEdited,message FROM "+
+                           f"MessageRevisions WHERE messageID IN ({placeholders})"+
+                           " ORDER BY ID", message_ids)
+            later = {}
+            for message_id, date_edited, content in cursor.fetchall():
+                later.setdefault(message_id, []).append((message_id,
+                                                         date_edited, content))
+
+            cursor.execute("DELETE FROM MessageRevisions WHERE messageID IN "+
+                           f"({placeholders})", message_ids)
+
+            revisions = []
+            copies = []
+            for message_id in message_ids:
+                group = rows[message_id]
+
+                # Each copy holds the content after an edit, and the edit was
+                # dated on the copy before it.
+                versions = [row for row in group if row[2] == group[0][2]]
+                for previous, row in zip(versions, versions[1:]):
+                    revisions.append((message_id, previous[4] or row[3],
+                                      row[5]))
+
+                revisions.extend(later.get(message_id, []))
+
+                # Only the first row for each attachment is kept.
+                seen = set()
+                for row in group:
+                    if row[2] in seen:
+                        copies.append(row[0])
+                    seen.add(row[2])
+
+            _write_revisions(cursor, revisions)
+
+            cursor.execute("DELETE FROM Messages WHERE ID IN ("+
+                           ",".join(["%s"] * len(copies))+")", copies)
+            count_change(cursor, guild.id)
+            mydb.commit()
+
+            messages += len(message_ids)
+            removed += len(copies)
+            last_id = message_ids[-1]
+
+            logger.info(f"Compacted {messages} edited messages in "+
+                        f"\'{guild.name}\' so far.")
+
+    # Returning the connection to the pool rolls back the unfinished batch.
+    except (DatabaseError, InterfaceError) as err:
+        logger.critical(f"There was an error compacting \'{guild.name}\'."+
+                        f"\n{err}")
+
+    logger.debug("Closing connection.")
+    cursor.close()
+    mydb.close()
+
+    return messages, removed
+
+def get_credentials() -> PooledConnection:
     """
-    A helper function used to get the credentials for the server, simplifying
-    the process.\n
+    A helper function used to borrow a connection to the server from the
+    connection pool, simplifying the process. Closing the connection returns it
+    to the pool.\n
     """
     try:
-        logger.debug("Establishing a connection to the database server.")
-        mydb=connect(
-            host=os.getenv('database_address'),
-            user=os.getenv('user'),
-            password=os.getenv('password'))
-        logger.debug("Database server connection established.")
+        logger.debug("Borrowing a connection from the pool.")
+        mydb=pool.get_connection()
+        logger.debug("Database server connection borrowed.")
         return mydb
 
+    # If no connection frees up in time, let the caller deal with it rather
+    # than shutting the whole bot down.
+    except PoolError as err:
+        logger.critical(f"No database connection was available.\n{err}")
+        raise
+
     # If the connection cannot be established due to input error, log and quit.
     except ProgrammingError:
         logger.critical("There was an error with the credentials. "+
@@ -1622,7 +2150,8 @@ def get_credentials() -> MySQLConnection:
         logger.critical(f"Connection failed due to unknown reason.\n{err}")
         exit()
 
-async def command_gimme(ctx: commands.Context, request: tuple):
+async def command_gimme(ctx: commands.Context, request: tuple,
+                        export_format: str = "csv"):
     """
     Called whenever a user whispers the bot to get the noted messages.\n
     ctx: The context in which the message was sent.\n
@@ -1631,8 +2160,17 @@ async def command_gimme(ctx: commands.Context, request: tuple):
     <user/all> \\<guild> \\<between> \\<date1> \\<date2>\n
     <user/all> \\<guild> \\<before/after> \\<date1>\n
     <user/all> \\<guild> \\<latest> \\<date1>\n
-    All dates must be in either the YYYY/MM/DD or YYYY/MM/DD HH:MM:SS format.
+    All dates must be in either the YYYY/MM/DD or YYYY/MM/DD HH:MM:SS format.\n
+    export_format: Which of the export_formats to send the messages as.
     """
+    export_format=export_format.lower()
+
+    if export_format not in export_formats:
+        await ctx.send(f"\'{export_format}\' isn't a format I can export as. "+
+                       "It must be one of the following: "+
+                       ", ".join(f"\'{name}\'" for name in export_formats)+
+                       ", without the single quotes.")
+        return
 
     # Get the user requesting the information.
     requesting_user=ctx.author.id
@@ -1692,191 +2230,307 @@ async def command_gimme(ctx: commands.Context, request: tuple):
         # get.
         date1=int(request[3])
 
-    cursor=mydb.cursor()
+    # If nothing has changed since the same thing was last asked for, send
+    # that export again.
+    guild_id, watermark = await _export_watermark(guild, requesting_user)
+    cache_key = None
 
-    # Check if the guild is given as an ID.
-    try:
-        guild=int(guild)
-    except ValueError:
-        # If it isn't, get the guildID from the guildList.
-        cursor.execute("USE guildList")
-        sql="SELECT guildID FROM Guilds WHERE guildName=%s"
-        cursor.execute(sql,(guild,))
-        guild=cursor.fetchall()
-        if len(guild)==0:
-            await ctx.send(f"Sorry, I could not find the {request[1]} server "+
-                           "in my database. Please double check that it's "+
-                           "spelled correctly.")
+    if watermark is not None:
+        cache_key = export_cache.key(guild_id, str(user).lower(),
+                                     request_range.lower(), date1, date2,
+                                     export_format)
+        export_paths = export_cache.checkout(cache_key, watermark)
+
+        if export_paths is not None:
+            logger.info(f"Sending {requesting_user} a cached export.")
+
+            try:
+                await send_export(ctx.send, export_paths)
+            finally:
+                export_cache.release(cache_key)
             return
-        else:
-            guild=guild[0][0]
 
-    # Use the guild.
-    cursor.execute(f"USE server{guild}")
+    # Run the export in its own process so it doesn't hold up the bot.
+    job = {"format": export_format, "request": request,
+           "requesting_user": requesting_user, "user": user, "guild": guild,
+           "range": request_range,
+           "date1": (date1.strftime(time_format) if isinstance(date1,datetime)
+                     else date1),
+           "date2": (date2.strftime(time_format) if isinstance(date2,datetime)
+                     else date2),
+           "part_size": export_part_size, "fetch_size": export_fetch_size}
 
-    # Check to see if the requesting user is a current or former member of this
-    # guild.
-    cursor.execute("SELECT memberID FROM Members WHERE memberID="+
-                   f"{requesting_user}")
-    requesting_user=cursor.fetchall()
-
-    # If they are not either a current or previous member of a guild.
-    if len(requesting_user)==0:
-        # Let them know that they can't request that information.
-        ctx.send("You must be either a current or former member of the guild "+
-                 "that you are trying to get messages from.")
+    if cache_key is not None:
+        job.update(cache_key=cache_key, watermark=watermark)
+
+    ahead, error = export_queue.submit(requesting_user, job, ctx.send)
+
+    # If the request couldn't be queued, let the requester know why.
+    if error:
+        await ctx.send(error)
         return
 
-    # Build the initial SQL statement.
-    sql=("SELECT messageID,Channels.channelName,authorID,"+
-         "CONCAT(Members.memberName,'#',Members.discriminator),dateCreated,"+
-         "dateEdited,dateDeleted,message,filename,url FROM Messages "+
-	    "LEFT JOIN Channels ON (Messages.channelID=Channels.channelID) "+
-	    "LEFT JOIN Members ON (Messages.authorID=Members.memberID) ")
+    if ahead:
+        await ctx.send(f"Your export is queued behind {ahead} others. I'll "+
+                       "let you know when it starts.")
 
-    # If there is some sort of limiting factor, add "WHERE".
-    if str(user).lower()!="all" or isinstance(date1,datetime):
-        sql+="WHERE "
+@database.task
+def _export_watermark(guild: str, requesting_user: int) -> tuple:
+    """
+    Gets a guild's watermark, which changes whenever a message is added, edited
+    or deleted, so a cached export can be checked as still being up to date.
+    Runs on a database worker.\n
+    guild: The ID or name of the guild the messages are being requested from.\n
+    requesting_user: The ID of the user that made the request.\n
+    Returns the ID of the guild and its watermark, or None for both if the
+    guild can't be found or the user isn't allowed its messages, in which case
+    the export itself explains why.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
 
-    # Check if the user is given as an ID.
     try:
-        user=int(user)
-    except ValueError:
-        # If it isn't, get the user's ID from the Members table.
-        if user.lower()!="all":
-            user=user.split("#")
-            user[1]=int(user[1])
-            get_user=("SELECT memberID FROM Members where memberName=%s AND "+
-                "discriminator=%s")
-            cursor.execute(get_user,user)
-            user=cursor.fetchall()
-            if len(user)==0:
-                await ctx.send(f"Sorry, I could not find user {request[0]} in "+
-                               f"{request[1]}. Either the name was misspelled "+
-                               "or they are not in this server.")
-                return
-            else:
-                user=user[0][0]
-                sql+="authorID=%s "
-    
-    # If The first date is an actual date (as opposed to being an integer) and
-    # the user is a userID (as opposed to the string "all"), then append "AND"
-    if isinstance(date1,datetime) and isinstance(user,int):
-        sql+="AND "
-    
-    # If the first date is instead an integer, then set the limiting.
-    elif isinstance(date1,int):
-        sql+= "ORDER BY dateCreated DESC LIMIT %s"
-
-    # If the range is "between", then set the ranges.
-    if request_range.lower()=="between":
-        sql+=("dateCreated BETWEEN CAST(%s AS DATETIME) AND "+
-                 "CAST(%s AS DATETIME)")
-    
-    # If the range is "before", set the range to be less than the set date.
-    elif request_range.lower()=="before":
-        sql+="dateCreated <= %s"
-        date1=date1.replace(hour=23,minute=59,second=59)
-    
-    # If the range is "after", set the range to be greater than the set date.
-    elif request_range.lower()=="after":
-        sql=sql+"dateCreated >= %s"
-
-    # If the length is 5.
-    if len(request)==5:
-        # and the user is a number (as opposed to "all").
-        if isinstance(user,int):
-            cursor.execute(sql,(user,date1,date2))
-        # If the user is "all".
-        else:
-            cursor.execute(sql,(date1,date2))
-
-    # If the length is 4.
-    elif len(request)==4:
-        # and the user is a number (as opposed to "all").
-        if isinstance(user,int):
-            cursor.execute(sql,(user,date1))            
-        # If the user is "all".
-        else:
-            cursor.execute(sql,(date1,))
-    
-    # If the length is anything else, just execute the command as it is.
-    else:
-        cursor.execute(sql)
+        # Check if the guild is given as an ID.
+        try:
+            guild_id = int(guild)
+        except ValueError:
+            cursor.execute("SELECT guildID FROM guildList.Guilds WHERE "+
+                           "guildName=%s", (guild,))
+            records = cursor.fetchall()
+            if len(records) == 0:
+                return None, None
+            guild_id = records[0][0]
+
+        guild_storage.use(cursor, guild_id)
+
+        # Only current or former members of the guild can have its messages.
+        cursor.execute("SELECT memberID FROM Members WHERE memberID=%s",
+                       (requesting_user,))
+        if len(cursor.fetchall()) == 0:
+            return None, None
+
+        # Every write to the guild's messages counts a change in the same
+        # transaction, so unlike the newest ID or deletion date the count
+        # moves for every change however old the message or however close
+        # together the changes come.
+        return guild_id, [guild_changes(cursor, guild_id)]
+
+    except (DatabaseError, InterfaceError) as err:
+        logger.warning(f"Could not get the watermark of {guild}.\n{err}")
+        return None, None
+
+    finally:
+        cursor.close()
+        mydb.close()
+
+async def command_search(ctx: commands.Context, guild: str, query: str,
+                         page: int = 1):
+    """
+    Called whenever a user whispers the bot to search a guild's messages.\n
+    ctx: The context in which the message was sent.\n
+    guild: The ID or name of the guild to search.\n
+    query: What to search for. Every word has to be in a message for it to be
+    found, and anything in double quotes has to appear exactly.\n
+    page: Which page of results to send, starting at 1.
+    """
+    terms, phrases = parse_search(query)
 
-    # Get all of the records.
-    message_records=cursor.fetchall()
+    if not terms:
+        await ctx.send("Please search for at least one word of "+
+                       "two or more letters.")
+        return
 
-    # Instantiate the workbook so the data can be exported as an Excel doc.
-    test_workbook=xlwt.Workbook()
+    if page < 1:
+        await ctx.send("The page must be 1 or more.")
+        return
 
-    # Add a worksheet.
-    test_worksheet=test_workbook.add_sheet("output")
-    
-    # Set hte date format for the dates.
-    date_format=xlwt.easyxf(num_format_str="YYYY/MM/DD HH:MM:SS")
-    
-    # Set the top rows so it's easy to distinguish which column is which/
-    test_worksheet.write(0,0,"Message ID")
-    test_worksheet.write(0,1,"Channel Name")
-    test_worksheet.write(0,2,"Author ID")
-    test_worksheet.write(0,3,"Author Name")
-    test_worksheet.write(0,4,"Date Created")
-    test_worksheet.write(0,5,"Date Edited")
-    test_worksheet.write(0,6,"Date Deleted")
-    test_worksheet.write(0,7,"Message")
-    test_worksheet.write(0,8,"Filename")
-    test_worksheet.write(0,9,"URL")
-
-    # Begin counting rows.
-    row=1
-    
-    # Go through each record returned and write them to the appropriate column.
-    for record in message_records:
-        test_worksheet.write(row,0,str(record[0]))
-        test_worksheet.write(row,1,record[1])
-        test_worksheet.write(row,2,str(record[2]))
-        test_worksheet.write(row,3,record[3])
-        test_worksheet.write(row,4,record[4],date_format)
-        test_worksheet.write(row,5,record[5],date_format)
-        test_worksheet.write(row,6,record[6],date_format)
-        test_worksheet.write(row,7,record[7])
-        test_worksheet.write(row,8,record[8])
-        test_worksheet.write(row,9,record[9])
-        row+=1
-
-    # Build an appropriate name for the file.
-    workbook_name = str(user)
-
-    # Append the guild and the range.
-    workbook_name+="_from_"+str(guild)+"_"+request_range+"_"
-
-    # If the range is "between".
-    if request_range.lower()=="between":
-        # Append both of the dates.
-        workbook_name+=str(date1)+"_and_"+str(date2)+".xls"
-    
-    # If it's anything else.
-    else:
-        # Append the date or number.
-        workbook_name+=str(date1)+".xls"
+    results, has_more, error = await _search_messages(guild, ctx.author.id,
+                                                      terms, phrases, page)
+
+    # If the search couldn't be run, let the requester know why.
+    if error:
+        await ctx.send(error)
+        return
+
+    if not results:
+        await ctx.send("No messages were found." if page == 1 else
+                       f"There are no results on page {page}.")
+        return
+
+    lines = [f"Results {(page - 1) * search_page_size + 1} to "+
+             f"{(page - 1) * search_page_size + len(results)}:"]
+
+    for (message_id, channel, author, date_created, is_edited, is_deleted,
+         content) in results:
+        flags = ""
+        if is_edited:
+            flags += " (edited)"
+        if is_deleted:
+            flags += " (deleted)"
+
+        content = (content or "").replace("\n", " ")
+        if len(content) > 150:
+            content = content[:147]+"..."
+
+        lines.append(f"`{date_created}` #{channel} {author}{flags}: "+
+                     f"{discord.utils.escape_mentions(content)}")
+
+    if has_more:
+        lines.append(f"Add \"page {page + 1}\" to the end of the search to "+
+                     "see more.")
+
+    # Keep under Discord's message length limit.
+    message = ""
+    for line in lines:
+        if len(message) + len(line) + 1 > 2000:
+            await ctx.send(message)
+            message = ""
+        message += line+"\n"
+
+    await ctx.send(message)
+
+@database.task
+def _search_messages(guild: str, requesting_user: int, terms: list,
+                     phrases: list, page: int) -> tuple:
+    """
+    Searches a guild's messages for command_search(). Runs on a database
+    worker.\n
+    guild: The ID or name of the guild to search.\n
+    requesting_user: The ID of the user that made the request.\n
+    terms: The words from parse_search().\n
+    phrases: The phrases from parse_search().\n
+    page: Which page of results to get.\n
+    Returns the results, whether there are more, and the reason the search
+    couldn't be run, if it couldn't.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
 
-    # Replace the colons from the datetime and make them hyphens so the text is
-    # appropriate for a filename.
-    workbook_name=str(workbook_name).replace(":","-")
+    try:
+        # Check if the guild is given as an ID.
+        try:
+            guild_id = int(guild)
+        except ValueError:
+            cursor.execute("SELECT guildID FROM guildList.Guilds WHERE "+
+                           "guildName=%s", (guild,))
+            records = cursor.fetchall()
+            if len(records) == 0:
+                return None, False, (f"Sorry, I could not find the {guild} "+
+                                     "server in my database. Please double "+
+                                     "check that it's spelled correctly.")
+            guild_id = records[0][0]
 
-    # Save the output.
-    test_workbook.save(workbook_name)
+        try:
+            guild_storage.use(cursor, guild_id)
+        except ProgrammingError:
+            return None, False, (f"Sorry, I could not find the {guild} "+
+                                 "server in my database. Please double check "+
+                                 "that it's spelled correctly.")
+
+        # Only current or former members of the guild can search its messages.
+        cursor.execute("SELECT memberID FROM Members WHERE memberID=%s",
+                       (requesting_user,))
+        if len(cursor.fetchall()) == 0:
+            return None, False, ("You must be either a current or former "+
+                                 "member of the guild that you are trying to "+
+                                 "search.")
+
+        logger.info(f"{requesting_user} searched {guild_id}.")
+
+        results, has_more = search_messages(cursor, terms, phrases, page,
+                                            search_page_size, message_archive,
+                                            guild_id)
+        return results, has_more, None
+
+    except (DatabaseError, InterfaceError, OSError) as err:
+        logger.critical(f"Could not search {guild}.\n{err}")
+        return None, False, ("Sorry, something went wrong while searching. "+
+                             "Please try again later.")
+
+    finally:
+        cursor.close()
+        mydb.close()
+
+async def upgrade_schema(guild_ids: list):
+    """
+    Brings every guild's tables up to date with the migrations in the
+    background. When the storage is shared the views of each guild are then
+    rebuilt, so they show any columns the migrations added.\n
+    guild_ids: The IDs of the guilds to migrate.
+    """
+    await schema_migrator.upgrade_all(guild_ids)
 
-    # Load the file as a Discord File.
-    discord_file=discord.File(workbook_name)
+    if guild_storage.shared:
+        for guild_id in guild_ids:
+            await _build_views(guild_id)
 
-    # Send the file to the user from the given context.
-    await ctx.send(content="Here's the content you requested!",
-                   file=discord_file)
+@database.task
+def _build_views(guild_id: int):
+    """
+    Rebuilds a guild's views onto the shared tables for upgrade_schema(). Runs
+    on a database worker.\n
+    guild_id: The ID of the guild.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
 
-    # Delete the file from the hard drive.
-    os.remove(workbook_name)
+    try:
+        guild_storage.build_views(cursor, guild_id)
 
-    cursor.close()
-    mydb.close()
\ No newline at end of file
+    except (DatabaseError, InterfaceError) as err:
+        logger.critical(f"Could not rebuild the views of server{guild_id}."+
+                        f"\n{err}")
+
+    finally:
+        cursor.close()
+        mydb.close()
+
+async def search_backfill(guild_ids: list):
+    """
+    Indexes the messages saved before searching was added, one guild and batch
+    at a time in the background. Messages saved from now on are indexed as
+    they're written.\n
+    guild_ids: The IDs of the guilds to index.
+    """
+    for guild_id in guild_ids:
+        indexed = 0
+
+        while True:
+            rows = await _search_backfill_batch(guild_id)
+            if not rows:
+                break
+            indexed += rows
+
+        if indexed:
+            logger.info(f"Indexed {indexed} old messages and revisions in "+
+                        f"server{guild_id} for searching.")
+
+@database.task
+def _search_backfill_batch(guild_id: int) -> int:
+    """
+    Indexes the next batch of old messages in a guild for search_backfill().
+    Runs on a database worker.\n
+    guild_id: The ID of the guild.\n
+    Returns how many rows were indexed, which is 0 once there are none left or
+    the guild couldn't be indexed.
+    """
+    mydb = get_credentials()
+    cursor = mydb.cursor()
+
+    try:
+        guild_storage.use(cursor, guild_id)
+        rows = backfill_search(guild_storage.cursor(cursor, guild_id),
+                               search_backfill_size)
+        mydb.commit()
+        return rows
+
+    # Returning the connection to the pool rolls the batch back. It's picked
+    # up again on the next start.
+    except (DatabaseError, InterfaceError) as err:
+        logger.critical(f"Could not index the messages of server{guild_id} "+
+                        f"for searching.\n{err}")
+        return 0
+
+    finally:
+        cursor.close()
+        mydb.close()
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import discord
+
+from sql_interface import (attachment_downloader, channel_check, logger,
+                           member_check, message_check, voice_check)
+
+def startup_order(guilds: list, priority: list) -> list:
+    """
+    Orders the guilds to be checked. The guilds in the priority list go first,
+    in the order given, then the rest go from the fewest members to the most so
+    the most guilds are being audited as soon as possible.\n
+    guilds: The guilds the bot is in.\n
+    priority: The IDs of the guilds to check first.
+    """
+    first = []
+    for guild_id in priority:
+        first.extend(guild for guild in guilds if guild.id == guild_id)
+
+    rest = [guild for guild in guilds if guild.id not in priority]
+    rest.sort(key=lambda guild: guild.member_count or 0)
+
+    return first + rest
+
+async def check_guild(guild: discord.Guild) -> dict:
+    """
+    Catches a guild's channels, members, voice sessions, and messages up with
+    any changes since the bot was restarted.\n
+    guild: The guild to check.\n
+    Returns how many seconds each part of the check took.
+    """
+    timings = {}
+
+    # Check for any new channels within the guild since the bot was restarted.
+    start = time.monotonic()
+    await channel_check(guild)
+    timings["channels"] = time.monotonic() - start
+
+    # Pick back up any attachments that hadn't finished downloading.
+    await attachment_downloader.resume(guild.id)
+
+    # Check for any new members within the guild since the bot was restarted.
+    start = time.monotonic()
+    await member_check(guild)
+    timings["members"] = time.monotonic() - start
+
+    # Close the voice sessions of anyone who left while the bot was stopped,
+    # and open them for anyone who joined.
+    start = time.monotonic()
+    await voice_check(guild)
+    timings["voice"] = time.monotonic() - start
+
+    # Catch up on any new messages within the guild since the bot was
+    # restarted.
+    start = time.monotonic()
+    await message_check(guild)
+    timings["messages"] = time.monotonic() - start
+
+    return timings
+
+async def startup_check(guilds: list, workers: int, priority: list):
+    """
+    Checks every guild, several at a time, logging how long each one took.\n
+    guilds: The guilds the bot is in.\n
+    workers: How many guilds to check at once.\n
+    priority: The IDs of the guilds to check first.
+    """
+    queue = asyncio.Queue()
+    for guild in startup_order(guilds, priority):
+        queue.put_nowait(guild)
+
+    total = queue.qsize()
+    finished = 0
+    started = time.monotonic()
+
+    async def worker():
+        nonlocal finished
+
+        while not queue.empty():
+            guild = queue.get_nowait()
+            logger.info(f"Checking the \'{guild.name}\' guild.")
+
+            try:
+                timings = await check_guild(guild)
+
+            # A guild that fails is logged so the rest can still be checked.
+            except Exception as err:
+                finished += 1
+                logger.critical(f"Guild check of \'{guild.name}\' failed "+
+                                f"({finished}/{total}).\n{err}")
+                continue
+
+            finished += 1
+            logger.info(f"Guild check of \'{guild.name}\' complete "+
+                        f"({finished}/{total}) in "+
+                        f"{sum(timings.values()):.1f}s: channels "+
+                        f"{timings['channels']:.1f}s, members "+
+                        f"{timings['members']:.1f}s, voice "+
+                        f"{timings['voice']:.1f}s, messages "+
+                        f"{timings['messages']:.1f}s.")
+
+    await asyncio.gather(*(worker() for _ in range(max(workers, 1))))
+
+    logger.info(f"Checked {total} guilds in "+
+                f"{time.monotonic() - started:.1f}s.")
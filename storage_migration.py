@@ -0,0 +1,197 @@
+"""
+Moves every guild's server{id} database into the shared tables of the guildData
+database, for switching an existing bot over to storage_mode=shared. Run it
+while the bot is stopped, then start the bot with storage_mode set to shared.
+
+Each table is copied in batches of its primary key, committing as it goes, so
+a migration that's stopped part way through can just be run again. A guild's
+own tables are only dropped once every one of them has been copied in full,
+and are then replaced with the views the bot reads them through.
+
+    python storage_migration.py [batch size]
+"""
+import logging
+import os
+import sys
+
+import mysql.connector
+
+from guild_storage import GuildStorage, guild_tables, shared_database
+
+logger = logging.getLogger("sql_interface").getChild("storage_migration")
+
+def copy_table(cursor, guild_id: int, table: str, batch_size: int) -> bool:
+    """
+    Copies one of a guild's tables into the shared table of the same name.\n
+    cursor: The cursor for the MySQL connection.\n
+    guild_id: The ID of the guild.\n
+    table: The name of the table.\n
+    batch_size: How many rows are copied in each transaction.\n
+    Returns whether every row is in the shared table.
+    """
+    source = f"server{guild_id}.{table}"
+
+    # Only the columns the shared table has are copied, so a guild database
+    # that's behind on its migrations can still be moved.
+    cursor.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE "+
+                   "TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME IN "+
+                   "(SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE "+
+                   "TABLE_SCHEMA=%s AND TABLE_NAME=%s) ORDER BY "+
+                   "ORDINAL_POSITION",
+                   (f"server{guild_id}", table, shared_database, table))
+    columns = ",".join(row[0] for row in cursor.fetchall())
+
+    cursor.execute("SELECT COLUMN_NAME FROM information_schema.STATISTICS "+
+                   "WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND "+
+                   "INDEX_NAME='PRIMARY' ORDER BY SEQ_IN_INDEX",
+                   (f"server{guild_id}", table))
+    key = ",".join(row[0] for row in cursor.fetchall())
+    key_values = ",".join(["%s"] * len(key.split(",")))
+
+    copied = 0
+    last = None
+    while True:
+        after = ""
+        after_values = []
+        if last is not None:
+            after = f"WHERE ({key})>({key_values}) "
+            after_values = list(last)
+
+        # Find where the batch ends, so it can be copied as a range of the
+        # primary key.
+        cursor.execute(f"SELECT {key} FROM {source} {after}ORDER BY {key} "+
+                       "LIMIT 1 OFFSET %s", after_values+[batch_size - 1])
+        end = cursor.fetchall()
+
+        sql = (f"INSERT IGNORE INTO {shared_database}.{table} (guildID,"+
+               f"{columns}) SELECT %s,{columns} FROM {source} {after}")
+        values = [guild_id]+after_values
+        if end:
+            sql += ("AND " if after else "WHERE ")+f"({key})<=({key_values})"
+            values += list(end[0])
+
+        cursor.execute(sql, values)
+        copied += cursor.rowcount
+        cursor.execute("COMMIT")
+
+        if not end:
+            break
+        last = end[0]
+
+    cursor.execute(f"SELECT COUNT(*) FROM {source}")
+    expected = cursor.fetchall()[0][0]
+    cursor.execute(f"SELECT COUNT(*) FROM {shared_database}.{table} WHERE "+
+                   "guildID=%s", (guild_id,))
+    found = cursor.fetchall()[0][0]
+
+    logger.info(f"Copied {copied} rows of {source}.")
+
+    if found != expected:
+        logger.critical(f"{source} has {expected} rows but only {found} were "+
+                        "found in the shared table.")
+        return False
+
+    return True
+
+def migrate_guild(cursor, storage: GuildStorage, guild_id: int,
+                  batch_size: int) -> bool:
+    """
+    Moves a guild's database into the shared tables, then replaces it with
+    views.\n
+    cursor: The cursor for the MySQL connection.\n
+    storage: The shared storage the guild is moved to.\n
+    guild_id: The ID of the guild.\n
+    batch_size: How many rows are copied in each transaction.\n
+    Returns whether the guild was moved.
+    """
+    cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE "+
+                   "TABLE_SCHEMA=%s AND TABLE_TYPE='BASE TABLE'",
+                   (f"server{guild_id}",))
+    tables = [row[0] for row in cursor.fetchall()]
+
+    # The months archived by older versions are only listed in that table, so
+    # they need moving into the current archive format before it's dropped.
+    if "ArchivedPartitions" in tables:
+        logger.critical(f"server{guild_id} still has an archive in the old "+
+                        "format. Start the bot once with storage_mode="+
+                        "separate to convert it, then run the migration "+
+                        "again.")
+        return False
+
+    for table in guild_tables:
+        if table in tables and not copy_table(cursor, guild_id, table,
+                                              batch_size):
+            logger.critical(f"Leaving server{guild_id} as it is.")
+            return False
+
+    # The old tables refer to each other, so the checks are turned off while
+    # they're dropped.
+    cursor.execute("SET SESSION foreign_key_checks=0")
+    try:
+        for table in tables:
+            cursor.execute(f"DROP TABLE server{guild_id}.{table}")
+    finally:
+        cursor.execute("SET SESSION foreign_key_checks=1")
+
+    storage.build_views(cursor, guild_id)
+
+    logger.info(f"Moved server{guild_id} into the shared tables.")
+    return True
+
+def main():
+    logging.basicConfig(stream=sys.stderr,
+                        level=os.getenv("log_level") or "INFO",
+                        format="%(levelname)s; %(filename)s; %(funcName)s; "+
+                        "%(message)s")
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    try:
+        mydb = mysql.connector.connect(host=os.getenv('database_address'),
+                                       user=os.getenv('user'),
+                                       password=os.getenv('password'))
+
+    except mysql.connector.Error as err:
+        logger.critical(f"Could not connect to the database server.\n{err}")
+        sys.exit(1)
+
+    cursor = mydb.cursor()
+    storage = GuildStorage(True)
+
+    try:
+        storage.prepare(cursor)
+
+        # Only the databases that still have their own tables need moving.
+        cursor.execute("SELECT DISTINCT TABLE_SCHEMA FROM information_schema."+
+                       "TABLES WHERE TABLE_SCHEMA LIKE 'server%' AND "+
+                       "TABLE_TYPE='BASE TABLE'")
+        guild_ids = sorted(int(row[0][len("server"):])
+                           for row in cursor.fetchall()
+                           if row[0][len("server"):].isdigit())
+
+        logger.info(f"Moving {len(guild_ids)} guild databases into "+
+                    f"{shared_database}.")
+
+        failed = 0
+        for guild_id in guild_ids:
+            if not migrate_guild(cursor, storage, guild_id, batch_size):
+                failed += 1
+
+    except mysql.connector.Error as err:
+        logger.critical(f"The migration failed. It can be run again to carry "+
+                        f"on.\n{err}")
+        sys.exit(1)
+
+    finally:
+        cursor.close()
+        mydb.close()
+
+    if failed:
+        logger.critical(f"{failed} guild databases could not be moved.")
+        sys.exit(1)
+
+    logger.info("Every guild database is in the shared tables. Start the bot "+
+                "with storage_mode=shared.")
+
+if __name__ == "__main__":
+    main()
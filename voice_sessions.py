@@ -0,0 +1,124 @@
+import threading
+
+class VoiceSessions:
+    """
+    Keeps track of the open voice session of every member, which is the
+    VoiceActivity row of the channel they're in that hasn't been left yet. A
+    guild's sessions are loaded from the rows without a dateLeft the first
+    time they're needed, and kept up to date from then on as members join,
+    move and leave.\n
+    The IDs of the rows are handed out here rather than by the database, so a
+    session can be written and closed by its primary key in the same batch
+    without waiting to find out what it was given. That makes the bot the only
+    thing that should add rows to VoiceActivity.
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._next_ids = {}
+        self._lock = threading.Lock()
+
+    def loaded(self, guild_id: int) -> bool:
+        """
+        Gets whether a guild's sessions have been loaded.\n
+        guild_id: The ID of the guild.
+        """
+        with self._lock:
+            return guild_id in self._sessions
+
+    def load(self, guild_id: int, last_id: int, rows: list) -> list:
+        """
+        Takes in a guild's open sessions, unless they've already been loaded.
+        Only a member's newest open session is kept, as any older ones were
+        left open by the bot stopping before they were closed.\n
+        guild_id: The ID of the guild.\n
+        last_id: The highest ID in the guild's VoiceActivity table.\n
+        rows: The ID, memberID and channelID of each row without a dateLeft,
+        in order of ID.\n
+        Returns the IDs of the older sessions that need closing.
+        """
+        sessions = {}
+        stale = []
+        for row_id, member_id, channel_id in rows:
+            if member_id in sessions:
+                stale.append(sessions[member_id][0])
+            sessions[member_id] = (row_id, channel_id)
+
+        with self._lock:
+            if guild_id in self._sessions:
+                return []
+
+            self._sessions[guild_id] = sessions
+            self._next_ids[guild_id] = (last_id or 0) + 1
+
+        return stale
+
+    def forget(self, guild_id: int):
+        """
+        Drops a guild's sessions, so they're loaded again the next time
+        they're needed.\n
+        guild_id: The ID of the guild.
+        """
+        with self._lock:
+            self._sessions.pop(guild_id, None)
+            self._next_ids.pop(guild_id, None)
+
+    def change(self, guild_id: int, member_id: int, channel_id: int,
+               when) -> tuple:
+        """
+        Moves a member to another voice channel, or out of voice entirely. The
+        guild's sessions must already be loaded.\n
+        guild_id: The ID of the guild.\n
+        member_id: The ID of the member.\n
+        channel_id: The ID of the channel they're in now, or None if they're
+        not in one.\n
+        when: When it happened.\n
+        Returns the (ID, dateLeft) of the sessions to close and the
+        (ID, memberID, channelID, dateEntered) of the sessions to open.
+        """
+        with self._lock:
+            sessions = self._sessions[guild_id]
+            closed = []
+            opened = []
+
+            session = sessions.get(member_id)
+            if session is not None:
+                # Nothing has changed for them.
+                if session[1] == channel_id:
+                    return closed, opened
+
+                closed.append((session[0], when))
+                del sessions[member_id]
+
+            if channel_id is not None:
+                row_id = self._next_ids[guild_id]
+                self._next_ids[guild_id] += 1
+
+                sessions[member_id] = (row_id, channel_id)
+                opened.append((row_id, member_id, channel_id, when))
+
+        return closed, opened
+
+    def sync(self, guild_id: int, members: dict, when) -> tuple:
+        """
+        Brings a guild's sessions in line with who is actually in voice, such
+        as after the bot was stopped. The guild's sessions must already be
+        loaded.\n
+        guild_id: The ID of the guild.\n
+        members: The channelID of every member in a voice channel, by
+        memberID.\n
+        when: When the changes are being recorded.\n
+        Returns the sessions to close and open, the same as change().
+        """
+        with self._lock:
+            member_ids = set(self._sessions[guild_id]) | set(members)
+
+        closed = []
+        opened = []
+        for member_id in member_ids:
+            member_closed, member_opened = self.change(guild_id, member_id,
+                                                       members.get(member_id),
+                                                       when)
+            closed.extend(member_closed)
+            opened.extend(member_opened)
+
+        return closed, opened